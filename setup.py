@@ -3,6 +3,17 @@ import sys, os
 
 version = '0.1'
 
+install_requires = [
+    'SQLAlchemy',
+    'transaction',
+    'python-daemon==1.6.1',
+    'zope.sqlalchemy',
+    'importlib',
+    'supervisor',
+]
+if sys.version_info < (2, 7):
+    install_requires.append('ordereddict')
+
 setup(name='sqla-taskq',
       version=version,
       description="Simple task queue executed by a daemon",
@@ -23,14 +34,12 @@ setup(name='sqla-taskq',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=False,
-      install_requires=[
-          'SQLAlchemy',
-          'transaction',
-          'python-daemon==1.6.1',
-          'zope.sqlalchemy',
-          'importlib',
-          'supervisor',
-      ],
+      install_requires=install_requires,
+      extras_require={
+          'threads': ['futures'],
+          'coroutines': ['futures', 'trollius'],
+          'msgpack': ['msgpack'],
+      },
       setup_requires=[
           'nose',
       ],
@@ -38,11 +47,14 @@ setup(name='sqla-taskq',
       tests_require=[
           'mock',
           'coverage',
+          'futures',
+          'trollius',
       ],
       entry_points="""
       # -*- Entry points: -*-
       [console_scripts]
       sqla_taskq_daemon = sqla_taskq.run_daemon:main
       sqla_taskq_initializedb = sqla_taskq.scripts.initializedb:main
+      sqla_taskq_purge = sqla_taskq.scripts.purge:main
       """,
       )
@@ -0,0 +1,224 @@
+import datetime
+import traceback
+import logging
+import transaction
+from sqla_taskq import timelimit
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+
+log = logging.getLogger(__name__)
+
+
+def iscoroutinefunction(func):
+    return asyncio is not None and asyncio.iscoroutinefunction(func)
+
+
+def iscoroutine(obj):
+    return asyncio is not None and asyncio.iscoroutine(obj)
+
+
+def run_coroutine(coro):
+    """Run the coroutine in a new event loop, used when a coroutine task is
+    performed by a synchronous worker.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def _format_exception(exc):
+    tb = getattr(exc, '__traceback__', None)
+    return ''.join(traceback.format_exception(type(exc), exc, tb))
+
+
+def _load(models, idtask):
+    """Get the function and the parameters of the task. The task is not
+    attached to any session when returned.
+    """
+    try:
+        task = models.Task.get_with_payload(idtask)
+        func = task.get_func()
+        return task, func
+    finally:
+        models.DBSession.remove()
+
+
+def _save(models, idtask, start_date, result=None, error=None,
+          exception=None):
+    """Set the result of a coroutine task"""
+    try:
+        with transaction.manager:
+            task = models.Task.query.get(idtask)
+            task.start_date = start_date
+            if error is None:
+                task.set_finished(result)
+            else:
+                task.set_failed(error, exception)
+            models.DBSession.add(task)
+    finally:
+        models.DBSession.remove()
+
+
+class AsyncioWorker(object):
+    """Run many coroutine tasks concurrently on one event loop.
+
+    The DB calls (claim, load and save) are done in a thread to not block the
+    loop. The tasks which are not coroutines are run in a thread pool.
+    """
+
+    def __init__(self, models, limit, threads=1):
+        if asyncio is None or futures is None:
+            raise ImportError(
+                'asyncio (or trollius) and futures are required to run '
+                'coroutine tasks')
+        self.models = models
+        self.limit = limit
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(
+            futures.ThreadPoolExecutor(max(threads, 1)))
+        self.db_executor = futures.ThreadPoolExecutor(1)
+        self.running = set()
+
+    def _in_db_thread(self, func, *args):
+        return self.loop.run_in_executor(self.db_executor, func, *args)
+
+    def _start(self, idtask):
+        """Run the task, the returned future is done when the task result is
+        saved.
+        """
+        from sqla_taskq import command
+        loop = self.loop
+        done = asyncio.Future(loop=loop)
+        start_date = datetime.datetime.utcnow()
+        # The timer of the timeout and the timeout once the task has been
+        # interrupted
+        timers = []
+        expired = []
+
+        def saved(future):
+            if future.exception():
+                log.error('Can\'t save the task %i: %s' % (
+                    idtask, _format_exception(future.exception())))
+            command._forget([idtask])
+            done.set_result(None)
+
+        def finished(future):
+            for timer in timers:
+                timer.cancel()
+            if future.cancelled() and expired:
+                error = timelimit.TaskTimeout(
+                    'The task has run more than %ss' % expired[0])
+            elif future.cancelled():
+                # Cancelled by the task itself
+                error = asyncio.CancelledError('The task has been cancelled')
+            else:
+                error = future.exception()
+            if error is not None:
+                log.error('The task %i has failed' % idtask)
+                save = self._in_db_thread(
+                    _save, self.models, idtask, start_date, None,
+                    _format_exception(error), error)
+            else:
+                save = self._in_db_thread(
+                    _save, self.models, idtask, start_date, future.result())
+            save.add_done_callback(saved)
+
+        def loaded(future):
+            if future.exception():
+                # Can't get the function, perform will store the error
+                performed = loop.run_in_executor(
+                    None, command._perform_in_thread, self.models, idtask)
+                performed.add_done_callback(saved)
+                return
+            task, func = future.result()
+            if not iscoroutinefunction(func):
+                performed = loop.run_in_executor(
+                    None, command._perform_in_thread, self.models, idtask)
+                performed.add_done_callback(saved)
+                return
+            log.debug('Performing coroutine task %i: %s' % (
+                idtask, task.description))
+            try:
+                coro = func(*(task._args or []), **(task._kw or {}))
+                running = asyncio.ensure_future(coro, loop=loop)
+            except Exception as e:
+                running = asyncio.Future(loop=loop)
+                running.set_exception(e)
+            timeout = task.timeout or command.default_timeout
+
+            def expire():
+                expired.append(timeout)
+                running.cancel()
+            if timeout:
+                timers.append(loop.call_later(timeout, expire))
+            running.add_done_callback(finished)
+
+        self._in_db_thread(_load, self.models, idtask).add_done_callback(
+            loaded)
+        return done
+
+    def run_once(self):
+        """Claim tasks for the free slots. Return True if some tasks have
+        been claimed.
+        """
+        from sqla_taskq import command
+        self.running = set([f for f in self.running if not f.done()])
+        free = self.limit - len(self.running)
+        if free <= 0:
+            return False
+        idtasks = self.loop.run_until_complete(
+            self._in_db_thread(command.lock_tasks, self.models, free))
+        for idtask in idtasks:
+            self.running.add(self._start(idtask))
+        return bool(idtasks)
+
+    def wait(self, waiter, timeout):
+        """Run the loop until a task is finished, the waiter is woken up or
+        the timeout is reached. Return True if there is no need to wait more.
+        """
+        woken = asyncio.Future(loop=self.loop)
+
+        def readable():
+            if not woken.done():
+                woken.set_result(True)
+
+        fileno = waiter.fileno()
+        if fileno is not None:
+            self.loop.add_reader(fileno, readable)
+        try:
+            self.loop.run_until_complete(asyncio.wait(
+                list(self.running) + [woken], timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED))
+        finally:
+            if fileno is not None:
+                self.loop.remove_reader(fileno)
+        if woken.done():
+            # Read the pending wakeups
+            waiter.wait(0)
+            return True
+        return any(f.done() for f in self.running)
+
+    def close(self, wait=True):
+        if wait and self.running:
+            log.info('Waiting for %i running tasks' % len(self.running))
+            self.loop.run_until_complete(asyncio.wait(list(self.running)))
+        from sqla_taskq import command
+        # The connection used to claim the tasks
+        self.db_executor.submit(command.close_connection)
+        self.db_executor.shutdown(wait=wait)
+        self.loop.close()
@@ -0,0 +1,97 @@
+import datetime
+import logging
+from sqlalchemy import (
+    select,
+    func,
+    and_,
+)
+from sqla_taskq import results
+
+
+log = logging.getLogger(__name__)
+
+# The number of tasks moved in one transaction
+BATCH_SIZE = 1000
+
+
+def _size(table):
+    """The approximative size in bytes of the blob and text columns"""
+    return (func.coalesce(func.length(table.c.func), 0) +
+            func.coalesce(func.length(table.c.description), 0) +
+            func.coalesce(func.length(table.c.result), 0))
+
+
+def purge_status(connection, models, status, before, batch_size=BATCH_SIZE,
+                 delete=False):
+    """Move the tasks with the given status finished before the given date to
+    the task_archive table (or delete them) in batches. Each batch is done in
+    its own short transaction.
+
+    Return a dict with the number of rows and of bytes removed from the task
+    table.
+    """
+    table = models.Task.__table__
+    stats = {'rows': 0, 'bytes': 0}
+    while True:
+        query = select([table.c.idtask, table.c.result_ref]).where(and_(
+            table.c.status == status,
+            table.c.end_date < before,
+        )).order_by(table.c.idtask).limit(batch_size)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        idtasks = [row[0] for row in rows]
+
+        condition = table.c.idtask.in_(idtasks)
+        trans = connection.begin()
+        try:
+            size = connection.execute(
+                select([func.sum(_size(table))]).where(condition)).scalar()
+            if not delete:
+                connection.execute(models.task_archive.insert().from_select(
+                    [c.name for c in table.columns],
+                    select([table]).where(condition)))
+            else:
+                # The archived tasks keep their large result
+                result_table = models.TaskResult.__table__
+                connection.execute(result_table.delete().where(
+                    result_table.c.idtask.in_(idtasks)))
+            connection.execute(table.delete().where(condition))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        if delete:
+            # The files can't be restored, they are deleted after the commit
+            for row in rows:
+                name = results.file_name(row[1])
+                if name is not None:
+                    results.delete_file(name)
+        stats['rows'] += len(idtasks)
+        stats['bytes'] += size or 0
+        if len(idtasks) < batch_size:
+            break
+    return stats
+
+
+def purge(engine, models, retention, batch_size=BATCH_SIZE, delete=False):
+    """Apply the retention policy: a dict {status: days}.
+
+    Return a dict {status: stats} (see purge_status).
+    """
+    result = {}
+    now = datetime.datetime.utcnow()
+    with engine.connect() as connection:
+        for status, days in sorted(retention.items()):
+            if status in (models.TASK_STATUS_WAITING,
+                          models.TASK_STATUS_IN_PROGRESS):
+                raise ValueError('The %s tasks can\'t be purged' % status)
+            before = now - datetime.timedelta(days=days)
+            stats = purge_status(connection, models, status, before,
+                                 batch_size, delete)
+            log.info('%i %s tasks %s (%i bytes)' % (
+                stats['rows'], status,
+                'deleted' if delete else 'archived',
+                stats['bytes']))
+            result[status] = stats
+    return result
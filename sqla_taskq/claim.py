@@ -0,0 +1,531 @@
+import os
+import socket
+import datetime
+from sqlalchemy import (
+    text,
+    bindparam,
+    select,
+    func,
+    and_,
+    DateTime,
+)
+from sqlalchemy.exc import IntegrityError
+
+
+# A task can only be claimed when its not_before date is passed. A task with
+# a unique_key can only be claimed if its key is not locked in task_key_lock
+# and if it's the oldest waiting task of its key: the tasks with the same key
+# are run one after the other.
+# The status is not a bound parameter to let sqlite use the partial index on
+# the waiting tasks. The queues filter is empty when the worker runs the tasks
+# of all the queues. The blocked filter skips the tasks exceeding a rate limit.
+ELIGIBLE_QUERY = """
+    %(queues)s status = '%(waiting)s'
+    AND pid IS NULL
+    AND (not_before IS NULL OR not_before <= :now)
+    AND (
+      unique_key IS NULL
+      OR (
+        NOT EXISTS (
+          SELECT 1
+            FROM task_key_lock
+           WHERE task_key_lock.unique_key = task.unique_key
+        )
+        AND NOT EXISTS (
+          SELECT 1
+            FROM task AS other
+           WHERE other.unique_key = task.unique_key
+             AND other.status = '%(waiting)s'
+             AND other.idtask < task.idtask
+        )
+      )
+    )
+    %(blocked)s
+"""
+
+
+def _queue_names(queues):
+    return ['queue_%i' % i for i in range(len(queues or []))]
+
+
+def _blocked_names(blocked):
+    """Get the parameter names of the blocked values by column"""
+    return [(column, ['blocked_%s_%i' % (column, i)
+                      for i in range(len(blocked[column]))])
+            for column in sorted(blocked or {}) if blocked[column]]
+
+
+def _eligible_query(models, queues=None, blocked=None):
+    queues_filter = ''
+    if queues:
+        queues_filter = 'queue IN (%s) AND' % ', '.join(
+            [':' + name for name in _queue_names(queues)])
+    blocked_filter = ' '.join([
+        'AND (%s IS NULL OR %s NOT IN (%s))' % (
+            column, column, ', '.join([':' + name for name in names]))
+        for column, names in _blocked_names(blocked)])
+    return ELIGIBLE_QUERY % {
+        'waiting': models.TASK_STATUS_WAITING,
+        'inprogress': models.TASK_STATUS_IN_PROGRESS,
+        'queues': queues_filter,
+        'blocked': blocked_filter,
+    }
+
+
+def _select_query(models, lock_clause='', columns='idtask', queues=None,
+                  blocked=None):
+    return """
+        SELECT %s
+          FROM task
+         WHERE %s
+      ORDER BY priority, idtask
+         LIMIT :limit
+        %s
+    """ % (columns, _eligible_query(models, queues, blocked), lock_clause)
+
+
+# The claimed tasks are leased to the worker for LEASE_DURATION seconds. The
+# heartbeat of the worker renews the lease while it's alive, the tasks of the
+# expired leases are reaped.
+LEASE_DURATION = 60
+# A reaped task is failed instead of requeued when it has been run
+# REAP_ATTEMPTS times: it's probably killing the workers
+REAP_ATTEMPTS = 3
+# The number of tasks reaped in one transaction
+REAP_BATCH_SIZE = 100
+
+_worker = {}
+
+
+def worker_id():
+    """Get the identity of this process stored in the claimed tasks: the host,
+    the pid and the start time since the pid is not unique across the hosts.
+    """
+    pid = os.getpid()
+    if _worker.get('pid') != pid:
+        _worker['pid'] = pid
+        _worker['id'] = '%s:%i:%s' % (
+            socket.gethostname(), pid,
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+    return _worker['id']
+
+
+def _claim_params(models, limit, lease=LEASE_DURATION, queues=None,
+                  blocked=None):
+    now = datetime.datetime.utcnow()
+    params = dict(zip(_queue_names(queues), queues or []))
+    for column, names in _blocked_names(blocked):
+        params.update(zip(names, blocked[column]))
+    params.update({
+        'waiting': models.TASK_STATUS_WAITING,
+        'inprogress': models.TASK_STATUS_IN_PROGRESS,
+        'pid': os.getpid(),
+        'worker': worker_id(),
+        'lock_date': now,
+        'lease_expires': now + datetime.timedelta(seconds=lease),
+        'now': now,
+        'limit': limit,
+    })
+    return params
+
+
+def _text(query):
+    """The query with its date parameters typed to be compared as the
+    stored dates"""
+    return text(query).bindparams(*[
+        bindparam(name, type_=DateTime())
+        for name in ('now', 'lock_date', 'lease_expires', 'before')
+        if ':' + name in query])
+
+
+def _in_clause(idtasks):
+    return '(%s)' % ', '.join(['%i' % idtask for idtask in idtasks])
+
+
+# Take the write lock of sqlite at the start of the transaction: the busy
+# timeout applies instead of failing when a read lock can't be upgraded
+SQLITE_BEGIN = 'BEGIN IMMEDIATE'
+
+
+def _begin(connection, begin_statement=None):
+    trans = connection.begin()
+    if begin_statement:
+        try:
+            connection.execute(begin_statement)
+        except:
+            trans.rollback()
+            raise
+    return trans
+
+
+def _lock_keys(connection, models, rows):
+    """Lock the unique keys of the claimed tasks. The primary key of
+    task_key_lock makes sure a key can't be locked twice.
+    """
+    lock_date = datetime.datetime.utcnow()
+    locks = [{'unique_key': unique_key,
+              'idtask': idtask,
+              'lock_date': lock_date}
+             for idtask, unique_key in rows if unique_key is not None]
+    if locks:
+        connection.execute(models.TaskKeyLock.__table__.insert(), locks)
+
+
+def _write_begin_statement(connection):
+    if connection.dialect.name == 'sqlite':
+        return SQLITE_BEGIN
+    return None
+
+
+def release(connection, models, idtasks):
+    """Put back in the queue the given tasks claimed by this process but not
+    started.
+    """
+    if not idtasks:
+        return 0
+    lock_query = """
+    DELETE FROM task_key_lock
+     WHERE idtask IN %s
+    """ % _in_clause(idtasks)
+    query = """
+    UPDATE task
+       SET pid = NULL,
+           worker = NULL,
+           status = :waiting,
+           lock_date = NULL,
+           lease_expires = NULL
+     WHERE idtask IN %s
+       AND pid = :pid
+       AND status = :inprogress
+    """ % _in_clause(idtasks)
+    trans = _begin(connection, _write_begin_statement(connection))
+    try:
+        result = connection.execute(
+            text(query), _claim_params(models, len(idtasks)))
+        connection.execute(text(lock_query))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    return result.rowcount
+
+
+def age(connection, models, aging, priority):
+    """Give the priority to the waiting tasks created more than aging seconds
+    ago if it's higher than their priority, the tasks with a low priority
+    are not waiting forever. Return the number of updated tasks.
+    """
+    query = """
+    UPDATE task
+       SET priority = :priority
+     WHERE status = :waiting
+       AND pid IS NULL
+       AND priority > :priority
+       AND creation_date < :before
+    """
+    before = datetime.datetime.utcnow() - datetime.timedelta(seconds=aging)
+    result = connection.execute(
+        _text(query).execution_options(autocommit=True),
+        priority=priority, waiting=models.TASK_STATUS_WAITING, before=before)
+    return result.rowcount
+
+
+def renew(connection, models, idtasks, lease=LEASE_DURATION):
+    """Extend the lease of the given tasks in progress of this worker. Return
+    the number of renewed tasks.
+    """
+    if not idtasks:
+        return 0
+    query = """
+    UPDATE task
+       SET lease_expires = :lease_expires
+     WHERE idtask IN %s
+       AND status = :inprogress
+       AND worker = :worker
+    """ % _in_clause(idtasks)
+    result = connection.execute(
+        _text(query).execution_options(autocommit=True),
+        _claim_params(models, 0, lease))
+    return result.rowcount
+
+
+def reap(connection, models, attempts=REAP_ATTEMPTS,
+         batch_size=REAP_BATCH_SIZE):
+    """Requeue a batch of the tasks in progress whose lease has expired: their
+    worker is dead. The tasks run attempts times are failed. Return the
+    number of reaped tasks.
+    """
+    params = {
+        'waiting': models.TASK_STATUS_WAITING,
+        'inprogress': models.TASK_STATUS_IN_PROGRESS,
+        'failed': models.TASK_STATUS_FAILED,
+        'now': datetime.datetime.utcnow(),
+        'limit': batch_size,
+        'error': 'The lease of the worker has expired',
+    }
+    rows = connection.execute(_text("""
+    SELECT idtask, attempts
+      FROM task
+     WHERE status = :inprogress
+       AND lease_expires < :now
+  ORDER BY idtask
+     LIMIT :limit
+    """), params).fetchall()
+    if not rows:
+        return 0
+    requeued = [idtask for idtask, count in rows if count + 1 < attempts]
+    failed = [idtask for idtask, count in rows if count + 1 >= attempts]
+    # The lease can have been renewed since the select
+    expired = """
+     WHERE idtask IN %s
+       AND status = :inprogress
+       AND lease_expires < :now
+    """
+    count = 0
+    trans = _begin(connection, _write_begin_statement(connection))
+    try:
+        if requeued:
+            count += connection.execute(_text("""
+            UPDATE task
+               SET pid = NULL,
+                   worker = NULL,
+                   status = :waiting,
+                   lock_date = NULL,
+                   lease_expires = NULL,
+                   attempts = attempts + 1
+            """ + expired % _in_clause(requeued)), params).rowcount
+        if failed:
+            count += connection.execute(_text("""
+            UPDATE task
+               SET status = :failed,
+                   result = :error,
+                   end_date = :now,
+                   lease_expires = NULL,
+                   attempts = attempts + 1
+            """ + expired % _in_clause(failed)), params).rowcount
+        connection.execute(_text("""
+        DELETE FROM task_key_lock
+         WHERE idtask IN %s
+           AND NOT EXISTS (
+             SELECT 1
+               FROM task
+              WHERE task.idtask = task_key_lock.idtask
+                AND task.status = :inprogress
+           )
+        """ % _in_clause([row[0] for row in rows])), params)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    return count
+
+
+def count_claimed(connection, models):
+    """Get the number of tasks in progress of this worker by queue"""
+    query = """
+    SELECT queue, COUNT(*)
+      FROM task
+     WHERE status = :inprogress
+       AND worker = :worker
+  GROUP BY queue
+    """
+    return dict(connection.execute(text(query), {
+        'inprogress': models.TASK_STATUS_IN_PROGRESS,
+        'worker': worker_id(),
+    }).fetchall())
+
+
+def next_due(connection, models, queues=None):
+    """Get the date of the next waiting task of the given queues (all the
+    queues by default) which is not due yet
+    """
+    conditions = [
+        models.Task.status == models.TASK_STATUS_WAITING,
+        models.Task.not_before > datetime.datetime.utcnow(),
+    ]
+    if queues:
+        conditions.append(models.Task.queue.in_(queues))
+    return connection.execute(
+        select([func.min(models.Task.not_before)]).where(
+            and_(*conditions))).scalar()
+
+
+class GenericClaimer(object):
+    """Claim the tasks with a SELECT then an UPDATE by task, it works with
+    all the dialects but many workers can fight for the same rows.
+    """
+
+    def __init__(self, begin_statement=None):
+        self.begin_statement = begin_statement
+
+    def claim(self, connection, models, limit=1, lease=LEASE_DURATION,
+              queues=None, blocked=None):
+        idtasks = []
+        # Some candidates can be taken by the other workers
+        params = _claim_params(models, max(5, limit), lease, queues, blocked)
+        rows = connection.execute(
+            _text(_select_query(models, columns='idtask, unique_key',
+                                queues=queues, blocked=blocked)),
+            params).fetchall()
+        query = """
+        UPDATE task
+           SET pid = :pid,
+               worker = :worker,
+               status = :inprogress,
+               lock_date = :lock_date,
+               lease_expires = :lease_expires
+         WHERE idtask = :idtask
+           AND pid IS NULL"""
+        for row in rows:
+            idtask = row[0]
+            unique_key = row[1]
+
+            trans = _begin(connection, self.begin_statement)
+            try:
+                # Fails if the key is already locked by a task in progress
+                _lock_keys(connection, models, [(idtask, unique_key)])
+                updated_rows = connection.execute(
+                    _text(query), dict(params, idtask=idtask))
+                if not updated_rows.rowcount:
+                    trans.rollback()
+                    continue
+                trans.commit()
+            except IntegrityError:
+                trans.rollback()
+                continue
+            except Exception:
+                trans.rollback()
+                if not idtasks:
+                    raise
+                # The claimed tasks are committed, return them. The error is
+                # raised again by the next claim.
+                break
+            except:
+                trans.rollback()
+                raise
+            idtasks.append(idtask)
+            if len(idtasks) >= limit:
+                break
+        return idtasks
+
+
+class ReturningClaimer(object):
+    """Claim the tasks in a single UPDATE ... RETURNING statement, the
+    writes are serialized by the DB lock.
+    """
+    lock_clause = ''
+    begin_statement = None
+
+    def claim(self, connection, models, limit=1, lease=LEASE_DURATION,
+              queues=None, blocked=None):
+        query = """
+        UPDATE task
+           SET pid = :pid,
+               worker = :worker,
+               status = :inprogress,
+               lock_date = :lock_date,
+               lease_expires = :lease_expires
+         WHERE idtask IN (%s)
+           AND pid IS NULL
+     RETURNING idtask, unique_key
+        """ % _select_query(models, self.lock_clause, queues=queues,
+                            blocked=blocked)
+
+        rows = []
+        trans = _begin(connection, self.begin_statement)
+        try:
+            result = connection.execute(
+                _text(query),
+                _claim_params(models, limit, lease, queues, blocked))
+            # Some drivers (like python 2 sqlite3) don't describe a RETURNING
+            # statement without row.
+            if result.returns_rows:
+                rows = result.fetchall()
+            _lock_keys(connection, models, rows)
+            trans.commit()
+        except IntegrityError:
+            # A key has been locked by another worker, try again later
+            trans.rollback()
+            return []
+        except:
+            trans.rollback()
+            raise
+        return sorted([row[0] for row in rows])
+
+
+class SQLiteClaimer(ReturningClaimer):
+    """Same as ReturningClaimer but the transaction takes the write lock
+    immediately.
+
+    Used for sqlite >= 3.35.
+    """
+    begin_statement = SQLITE_BEGIN
+
+
+class SkipLockedClaimer(ReturningClaimer):
+    """Same as ReturningClaimer but the rows locked by the other workers are
+    skipped instead of waited for.
+
+    Used for postgresql.
+    """
+    lock_clause = 'FOR UPDATE SKIP LOCKED'
+
+
+class MySQLSkipLockedClaimer(object):
+    """MySQL doesn't support UPDATE ... RETURNING, the rows are selected with
+    SKIP LOCKED and updated in the same transaction.
+
+    Used for mysql >= 8.0.1.
+    """
+
+    def claim(self, connection, models, limit=1, lease=LEASE_DURATION,
+              queues=None, blocked=None):
+        params = _claim_params(models, limit, lease, queues, blocked)
+        trans = connection.begin()
+        try:
+            rows = connection.execute(
+                _text(_select_query(models, 'FOR UPDATE SKIP LOCKED',
+                                    'idtask, unique_key', queues, blocked)),
+                params).fetchall()
+            idtasks = [row[0] for row in rows]
+            if idtasks:
+                connection.execute(_text("""
+                UPDATE task
+                   SET pid = :pid,
+                       worker = :worker,
+                       status = :inprogress,
+                       lock_date = :lock_date,
+                       lease_expires = :lease_expires
+                 WHERE idtask IN %s
+                """ % _in_clause(idtasks)), params)
+                _lock_keys(connection, models, rows)
+            trans.commit()
+        except IntegrityError:
+            # A key has been locked by another worker, try again later
+            trans.rollback()
+            return []
+        except:
+            trans.rollback()
+            raise
+        return idtasks
+
+
+def get_claimer(connection):
+    """Get the claim strategy to use according to the dialect of the given
+    connection.
+    """
+    dialect = connection.dialect
+    version = dialect.server_version_info or ()
+    if dialect.name == 'postgresql' and version >= (9, 5):
+        return SkipLockedClaimer()
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            if version >= (10, 6):
+                return MySQLSkipLockedClaimer()
+        elif version >= (8, 0, 1):
+            return MySQLSkipLockedClaimer()
+    if dialect.name == 'sqlite':
+        if dialect.dbapi.sqlite_version_info >= (3, 35):
+            return SQLiteClaimer()
+        return GenericClaimer(SQLITE_BEGIN)
+    return GenericClaimer()
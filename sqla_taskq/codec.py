@@ -0,0 +1,152 @@
+import os
+import json
+import zlib
+import pickle
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+from sqlalchemy.types import (
+    TypeDecorator,
+    LargeBinary,
+)
+
+
+# The first byte of the encoded payloads. A pickle never starts with it, the
+# payloads without it have been stored by the previous versions (PickleType).
+MAGIC = b'\x00'
+COMPRESSED = b'z'
+NOT_COMPRESSED = b'-'
+
+
+class PickleCodec(object):
+    """Any python object, the only codec supporting the bound methods"""
+    name = 'pickle'
+    code = b'p'
+
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonCodec(object):
+    """Plain data only: the tuples are loaded as lists and the str as
+    unicode"""
+    name = 'json'
+    code = b'j'
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """Plain data only, more compact and faster than json"""
+    name = 'msgpack'
+    code = b'm'
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {}
+CODECS_BY_CODE = {}
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+    CODECS_BY_CODE[codec.code] = codec
+
+
+register(PickleCodec())
+register(JsonCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
+
+
+settings = {
+    # The codec used to encode the new payloads
+    'codec': os.environ.get('SQLA_TASKQ_CODEC') or 'pickle',
+    # The codec used when the payload can't be encoded by codec (ex: a
+    # bound method with json), None to raise the error
+    'fallback': 'pickle',
+    # The payloads bigger than this size (in bytes) are compressed with zlib,
+    # None to never compress
+    'compress_threshold': 1024,
+}
+
+
+def _get_codec(name):
+    if name not in CODECS:
+        raise ValueError('Unknown codec %s, the available codecs are: %s' % (
+            name, ', '.join(sorted(CODECS))))
+    return CODECS[name]
+
+
+def configure(**kw):
+    """Change the settings used to encode the new payloads, see settings
+    for the parameters. The existing payloads are always readable.
+    """
+    for key, value in kw.items():
+        if key not in settings:
+            raise TypeError('Unknown setting %s' % key)
+        if key in ('codec', 'fallback') and value is not None:
+            _get_codec(value)
+        settings[key] = value
+
+
+def encode(data):
+    codec = _get_codec(settings['codec'])
+    try:
+        payload = codec.dumps(data)
+    except (TypeError, ValueError):
+        fallback = settings['fallback']
+        if fallback is None or fallback == codec.name:
+            raise
+        codec = _get_codec(fallback)
+        payload = codec.dumps(data)
+
+    flag = NOT_COMPRESSED
+    threshold = settings['compress_threshold']
+    if threshold is not None and len(payload) > threshold:
+        payload = zlib.compress(payload)
+        flag = COMPRESSED
+    return MAGIC + codec.code + flag + payload
+
+
+def decode(value):
+    value = bytes(value)
+    if not value.startswith(MAGIC):
+        # Stored by PickleType
+        return pickle.loads(value)
+    code = value[1:2]
+    if code not in CODECS_BY_CODE:
+        raise ValueError('The payload codec %r is not available' % code)
+    payload = value[3:]
+    if value[2:3] == COMPRESSED:
+        payload = zlib.decompress(payload)
+    return CODECS_BY_CODE[code].loads(payload)
+
+
+class PayloadType(TypeDecorator):
+    """Store the payload of the tasks with the configured codec. It replaces
+    PickleType, the payloads it has stored are still readable.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode(value)
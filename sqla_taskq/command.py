@@ -1,16 +1,28 @@
 import os
+import re
 import sys
 import time
+import random
+import datetime
 import ConfigParser
 import signal
+import threading
 from optparse import OptionParser
 import logging.config
 import logging
 import transaction
-from sqlalchemy import text
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
 from sqlalchemy.exc import OperationalError
-import datetime
-import sys
+from sqla_taskq import claim
+from sqla_taskq import wakeup
+from sqla_taskq import aio
+from sqla_taskq import timelimit
+from sqla_taskq import results
+from sqla_taskq import ratelimit
+from sqla_taskq.compat import total_seconds
 
 
 log = logging.getLogger(__name__)
@@ -22,6 +34,77 @@ log.addHandler(ch)
 
 loop = True
 
+# The tasks claimed by this process which are not started yet
+prefetched = []
+
+# The tasks claimed by this process until they are done, only their leases
+# are renewed by the heartbeat
+claimed = set()
+_claimed_lock = threading.Lock()
+
+# Default polling delays in seconds when the queue is empty
+POLL_MIN = 0.1
+POLL_MAX = 5
+BACKOFF_FACTOR = 2
+
+# The maximum delay in seconds between two agings of the waiting tasks
+AGING_INTERVAL = 60
+
+# The delay in seconds between two reapings of the expired leases
+REAP_INTERVAL = 10
+
+# The lease duration in seconds of the tasks claimed by this process, set by
+# run
+lease_duration = claim.LEASE_DURATION
+
+# The timeout in seconds of the tasks without timeout and how they are
+# interrupted, set by run
+default_timeout = None
+default_timeout_mode = timelimit.SIGNAL
+
+# The queues run by this process in order with their concurrency (None for no
+# limit), set by run. All the queues are run when it's empty.
+subscriptions = []
+
+# The options of parse_options and parse_config_file passed to
+# models.configure_engine
+ENGINE_OPTIONS = ['pool_size', 'pool_pre_ping', 'pool_recycle',
+                  'sqlite_journal_mode', 'sqlite_busy_timeout',
+                  'sqlite_synchronous', 'sqlite_tuned']
+
+# The options of parse_options and parse_config_file passed to
+# results.configure with their setting name
+RESULT_OPTIONS = {
+    'result_store': 'store',
+    'result_path': 'path',
+    'result_inline_max': 'inline_max',
+    'result_ttl': 'ttl',
+}
+
+# The DB calls failing with an OperationalError (ex: sqlite locked) are
+# retried after a random delay up to RETRY_BASE_DELAY * 2 ** attempt seconds
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 1
+
+# The counters of this process
+metrics = {
+    # The DB calls retried
+    'retries': 0,
+    # The DB calls which have failed after all the attempts
+    'failures': 0,
+}
+_metrics_lock = threading.Lock()
+
+# The connection of each thread, reused to claim and to run the tasks
+_local = threading.local()
+
+# The options of parse_options and parse_config_file passed to run
+RUN_OPTIONS = ['kill', 'prefetch', 'poll_min', 'poll_max', 'backoff_factor',
+               'concurrency', 'threads', 'coroutines', 'preload', 'aging',
+               'aging_priority', 'lease', 'reap_attempts', 'task_timeout',
+               'timeout_mode', 'queues']
+
 
 def sigterm_handler(signal_number, stack_frame):
     global loop
@@ -37,91 +120,408 @@ def sigterm_kill_handler(signal_number, stack_frame):
 
 
 def _lock_task(connection, models):
-    select_query = """
-    SELECT MIN(idtask) AS idtask, unique_key
-     FROM task
-    WHERE status='%s'
-      AND pid IS NULL
- GROUP BY COALESCE(unique_key, CAST(idtask AS VARCHAR(255)))
-    LIMIT 5
-    """ % (
-        models.TASK_STATUS_WAITING
-    )
-
-    rows = connection.execute(select_query)
-    for row in rows:
-        idtask = row[0]
-        unique_key = row[1]
-
-        unique_key_extra_query = ''
-        if unique_key:
-            unique_key_extra_query = '''
-          AND unique_key NOT IN (
-            SELECT unique_key
-              FROM task
-             WHERE status = '%s'
-               AND unique_key = '%s'
-          )''' % (
-                models.TASK_STATUS_IN_PROGRESS,
-                unique_key)
-
-        query = """
-        UPDATE task
-           SET pid = %i,
-               status = '%s',
-               lock_date = '%s'
-        WHERE idtask = %i
-          AND pid IS NULL
-          %s""" % (
-            os.getpid(),
-            models.TASK_STATUS_IN_PROGRESS,
-            datetime.datetime.utcnow(),
-            idtask,
-            unique_key_extra_query
-        )
-
-        updated_rows = connection.execute(text(query).execution_options(autocommit=True))
-        if updated_rows.rowcount:
-            return idtask
+    idtasks = _lock_tasks(connection, models)
+    if idtasks:
+        return idtasks[0]
+
+
+def _claim_tasks(connection, models, limit=1, blocked=None):
+    claimer = claim.get_claimer(connection)
+    if not subscriptions:
+        return claimer.claim(connection, models, limit, lease_duration,
+                             blocked=blocked)
+
+    running = {}
+    if any(concurrency is not None for _, concurrency in subscriptions):
+        running = claim.count_claimed(connection, models)
+    idtasks = []
+    # The first queues are served first
+    for queue, concurrency in subscriptions:
+        free = limit - len(idtasks)
+        if concurrency is not None:
+            free = min(free, concurrency - running.get(queue, 0))
+        if free <= 0:
+            continue
+        try:
+            idtasks += claimer.claim(connection, models, free,
+                                     lease_duration, [queue], blocked)
+        except Exception:
+            if not idtasks:
+                raise
+            # The tasks of the previous queues are committed, don't lose
+            # them. The error is raised again by the next claim.
+            log.exception('Can\'t claim the tasks of the queue %s' % queue)
+            break
+        if len(idtasks) >= limit:
+            break
+    return idtasks
+
+
+def _lock_tasks(connection, models, limit=1):
+    # The tasks of the empty buckets are skipped, the claimed tasks which
+    # would exceed a limit are put back in the queue
+    limits = ratelimit.load(connection, models)
+    idtasks = _claim_tasks(connection, models, limit, limits.blocked())
+    try:
+        idtasks, denied = limits.acquire_tasks(connection, idtasks)
+    except:
+        # The claimed tasks would be lost when the call is retried
+        claim.release(connection, models, idtasks)
+        raise
+    if denied:
+        claim.release(connection, models, denied)
+        log.debug('Tasks %s released: rate limit exceeded' % denied)
+    return idtasks
+
+
+def get_connection(models):
+    """Get the connection of this thread, it's kept open to not connect to
+    the DB for each claim.
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        if _local.pid != os.getpid():
+            # Inherited from the parent process, don't touch it
+            connection = None
+        elif connection.closed or connection.engine is not models.engine:
+            close_connection()
+            connection = None
+    if connection is None:
+        connection = models.engine.connect()
+        _local.connection = connection
+        _local.pid = os.getpid()
+    return connection
+
+
+def close_connection():
+    """Close the connection of this thread"""
+    connection = getattr(_local, 'connection', None)
+    _local.connection = None
+    if connection is not None and _local.pid == os.getpid():
+        connection.close()
+
+
+def _count(name):
+    with _metrics_lock:
+        metrics[name] += 1
+
+
+def _end_transaction(connection):
+    """End the transaction opened by the driver for the SELECTs, SQLAlchemy
+    only autocommits the writes. The idle workers don't keep their locks and
+    snapshot while the connection is kept open.
+    """
+    if (connection.closed or connection.invalidated or
+            connection.in_transaction()):
+        return
+    try:
+        connection.connection.rollback()
+    except Exception:
+        log.exception('Can\'t end the transaction')
+        close_connection()
 
 
-def lock_task(models):
-    for i in range(5):
+def _with_retries(func, models, *args):
+    for attempt in range(RETRY_ATTEMPTS):
         # Make many tries since when we use sqlite the DB can be locked.
+        connection = None
         try:
-            connection = models.engine.connect()
-            idtask = _lock_task(connection, models)
-            connection.close()
-            return idtask
+            connection = get_connection(models)
+            result = func(connection, models, *args)
+            _end_transaction(connection)
+            return result
         except OperationalError:
-            pass
+            if connection is not None:
+                if connection.invalidated:
+                    # Lost connection, get a new one
+                    close_connection()
+                else:
+                    _end_transaction(connection)
+            if attempt == RETRY_ATTEMPTS - 1:
+                _count('failures')
+                log.warning('The DB call has failed %i times' %
+                            RETRY_ATTEMPTS)
+                break
+            _count('retries')
+            # Random delay to not retry at the same time as the other workers
+            time.sleep(random.uniform(
+                0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
 
     return None
 
 
-def _run(models):
-    idtask = lock_task(models)
-    if not idtask:
+def _hold(idtasks):
+    with _claimed_lock:
+        claimed.update(idtasks)
+
+
+def _forget(idtasks):
+    with _claimed_lock:
+        claimed.difference_update(idtasks)
+
+
+def lock_task(models):
+    idtask = _with_retries(_lock_task, models)
+    if idtask is not None:
+        _hold([idtask])
+    return idtask
+
+
+def lock_tasks(models, limit=1):
+    idtasks = _with_retries(_lock_tasks, models, limit) or []
+    _hold(idtasks)
+    return idtasks
+
+
+def release_tasks(models):
+    """Put back in the queue the prefetched tasks which are not started
+    """
+    if not prefetched:
+        return
+    idtasks = prefetched[:]
+    del prefetched[:]
+    _with_retries(claim.release, models, idtasks)
+    _forget(idtasks)
+    log.info('%i prefetched tasks released' % len(idtasks))
+
+
+def age_tasks(models, aging, priority):
+    """Give the priority to the tasks waiting for more than aging seconds"""
+    count = _with_retries(claim.age, models, aging, priority)
+    if count:
+        log.info('%i waiting tasks aged' % count)
+    return count
+
+
+def renew_leases(models, lease):
+    """Extend the lease of the tasks claimed by this process"""
+    with _claimed_lock:
+        idtasks = sorted(claimed)
+    if not idtasks:
+        return 0
+    return _with_retries(claim.renew, models, idtasks, lease)
+
+
+def reap_tasks(models, attempts=claim.REAP_ATTEMPTS):
+    """Requeue (or fail) the tasks of the dead workers by batches"""
+    total = 0
+    while True:
+        count = _with_retries(claim.reap, models, attempts) or 0
+        total += count
+        if count < claim.REAP_BATCH_SIZE:
+            break
+    if total:
+        log.warning('%i tasks of dead workers reaped' % total)
+    return total
+
+
+class Heartbeat(threading.Thread):
+    """Renew the leases of the tasks claimed by this process while it's
+    alive, the tasks are renewed at least 3 times by lease.
+    """
+
+    def __init__(self, models, lease):
+        super(Heartbeat, self).__init__(name='sqla-taskq-heartbeat')
+        self.daemon = True
+        self.models = models
+        self.lease = lease
+        self.interval = lease / 3.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            # Event.wait returns None in python 2.6
+            while not self.stopped.is_set():
+                self.stopped.wait(self.interval)
+                if self.stopped.is_set():
+                    break
+                renew_leases(self.models, self.lease)
+        finally:
+            close_connection()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def next_due_date(models):
+    """Get the date of the next delayed task of the subscribed queues, None
+    if there is no delayed task
+    """
+    return _with_retries(claim.next_due, models,
+                         [queue for queue, _ in subscriptions])
+
+
+def _due_delay(due):
+    if due is None:
+        return None
+    return max(total_seconds(due - datetime.datetime.utcnow()), 0)
+
+
+def next_due_delay(models):
+    """Get the number of seconds before the next delayed task is due, None if
+    there is no delayed task
+    """
+    return _due_delay(next_due_date(models))
+
+
+def _run(models, prefetch=1):
+    if not prefetched:
+        prefetched.extend(lock_tasks(models, prefetch))
+    if not prefetched:
         return False
 
-    task = models.Task.query.get(idtask)
-    with transaction.manager:
-        task.perform()
-        models.DBSession.add(task)
+    _perform(models, prefetched.pop(0), get_connection(models))
     return True
 
 
-def run(models, kill=False):
+def _perform(models, idtask, connection=None):
+    """Run the task. The session uses the given connection if any, it should
+    not be in a transaction.
+    """
+    session = models.DBSession()
+    bind = session.bind
+    if connection is not None:
+        session.bind = connection
+    try:
+        with transaction.manager:
+            task = models.Task.get_with_payload(idtask)
+            task.perform(default_timeout, default_timeout_mode)
+            models.DBSession.add(task)
+    finally:
+        session.bind = bind
+        _forget([idtask])
+
+
+def _perform_in_thread(models, idtask):
+    try:
+        _perform(models, idtask)
+    finally:
+        # Each thread has its own session
+        models.DBSession.remove()
+
+
+def _run_threads(models, executor, running, threads, timeout=1):
+    """Claim tasks for the free threads of the executor. Return True if there
+    is no need to wait for a new task.
+    """
+    running.difference_update([f for f in running if f.done()])
+    if len(running) >= threads:
+        # All the threads are busy
+        futures.wait(running, timeout=timeout,
+                     return_when=futures.FIRST_COMPLETED)
+        return True
+
+    idtasks = lock_tasks(models, threads - len(running))
+    for idtask in idtasks:
+        running.add(executor.submit(_perform_in_thread, models, idtask))
+    return bool(idtasks)
+
+
+def run(models, kill=False, prefetch=1, poll_min=POLL_MIN, poll_max=POLL_MAX,
+        backoff_factor=BACKOFF_FACTOR, threads=1, coroutines=0,
+        preload=None, aging=0, aging_priority=0, lease=claim.LEASE_DURATION,
+        reap_attempts=claim.REAP_ATTEMPTS, task_timeout=None,
+        timeout_mode=timelimit.SIGNAL, queues=None):
+    global lease_duration, default_timeout, default_timeout_mode
+    global subscriptions
+    if timeout_mode not in timelimit.MODES:
+        raise ValueError('Unknown timeout mode %s' % timeout_mode)
+    if (task_timeout and timeout_mode == timelimit.SIGNAL and
+            (threads > 1 or coroutines > 0)):
+        raise ValueError('The signal timeout mode can\'t interrupt the tasks '
+                         'run by threads, use the process mode')
+    if timeout_mode == timelimit.SIGNAL and (threads > 1 or coroutines > 0):
+        # The timeouts given to Task.create are enforced by a child process
+        log.info('The tasks with a timeout are run in a child process')
+        timeout_mode = timelimit.PROCESS
+    subscriptions = parse_queues(queues)
+    if preload:
+        # Before claiming anything
+        models.preload(preload)
+    lease_duration = lease
+    default_timeout = task_timeout
+    default_timeout_mode = timeout_mode
+
+    executor = None
+    aio_worker = None
+    if coroutines > 0:
+        # The threads are used for the tasks which are not coroutines
+        aio_worker = aio.AsyncioWorker(models, coroutines, threads)
+    elif threads > 1:
+        if futures is None:
+            raise ImportError(
+                'The futures package is required to run the tasks in threads')
+        executor = futures.ThreadPoolExecutor(threads)
+        running = set()
+
     if kill:
         signal.signal(signal.SIGTERM, sigterm_kill_handler)
     else:
         signal.signal(signal.SIGTERM, sigterm_handler)
 
-    log.info('Process started')
-    while loop:
-        _run(models)
-        time.sleep(1)
-    log.info('Process stopped')
+    log.info('Process started (worker %s)' % claim.worker_id())
+    waiter = wakeup.get_waiter(models.engine)
+    heartbeat = Heartbeat(models, lease)
+    heartbeat.start()
+    delay = poll_min
+    next_aging = 0
+    next_reaping = 0
+    # The date of the next delayed task, queried again when the worker has
+    # done some work, when it's passed or every poll_max seconds
+    due_date = None
+    next_due_query = 0
+    try:
+        while loop:
+            if time.time() >= next_reaping:
+                reap_tasks(models, reap_attempts)
+                next_reaping = time.time() + min(lease, REAP_INTERVAL)
+            if aging and time.time() >= next_aging:
+                age_tasks(models, aging, aging_priority)
+                next_aging = time.time() + min(aging, AGING_INTERVAL)
+            if aio_worker:
+                busy = aio_worker.run_once()
+            elif executor:
+                busy = _run_threads(models, executor, running, threads)
+            else:
+                busy = _run(models, prefetch) or prefetched
+            if busy:
+                # There is some work, don't wait to run the next task
+                delay = poll_min
+                next_due_query = 0
+                continue
+            # Wait for a new task or poll again after the timeout. The
+            # timeout increases while the queue is empty.
+            timeout = delay
+            due = _due_delay(due_date)
+            if due == 0 or time.time() >= next_due_query:
+                due_date = next_due_date(models)
+                due = _due_delay(due_date)
+                next_due_query = time.time() + poll_max
+            if due is not None and due < timeout:
+                # Don't wait more than the next delayed task
+                timeout = due
+            if aio_worker:
+                woken = aio_worker.wait(waiter, timeout)
+            else:
+                woken = waiter.wait(timeout)
+            if woken:
+                delay = poll_min
+                next_due_query = 0
+            else:
+                delay = min(delay * backoff_factor, poll_max)
+    finally:
+        release_tasks(models)
+        heartbeat.stop()
+        if aio_worker:
+            aio_worker.close(wait=not kill)
+        waiter.close()
+        if executor:
+            # The running threads can't be killed
+            executor.shutdown(wait=True)
+        close_connection()
+    log.info('Process stopped (DB retries: %(retries)i, failures: '
+             '%(failures)i)' % metrics)
 
 
 def parse_config_file(filename):
@@ -155,9 +555,167 @@ def parse_config_file(filename):
     else:
         dic['timeout'] = 60
 
+    if 'prefetch' in items:
+        dic['prefetch'] = config.getint('sqla_taskq', 'prefetch')
+    else:
+        dic['prefetch'] = 1
+
+    if 'concurrency' in items:
+        dic['concurrency'] = config.getint('sqla_taskq', 'concurrency')
+    else:
+        dic['concurrency'] = 1
+
+    if 'threads' in items:
+        dic['threads'] = config.getint('sqla_taskq', 'threads')
+    else:
+        dic['threads'] = 1
+
+    if 'coroutines' in items:
+        dic['coroutines'] = config.getint('sqla_taskq', 'coroutines')
+    else:
+        dic['coroutines'] = 0
+
+    for option, default in [('poll_min', POLL_MIN),
+                            ('poll_max', POLL_MAX),
+                            ('backoff_factor', BACKOFF_FACTOR)]:
+        if option in items:
+            dic[option] = config.getfloat('sqla_taskq', option)
+        else:
+            dic[option] = default
+
+    if 'aging' in items:
+        dic['aging'] = config.getfloat('sqla_taskq', 'aging')
+    else:
+        dic['aging'] = 0
+
+    if 'aging_priority' in items:
+        dic['aging_priority'] = config.getint('sqla_taskq', 'aging_priority')
+    else:
+        dic['aging_priority'] = 0
+
+    if 'lease' in items:
+        dic['lease'] = config.getfloat('sqla_taskq', 'lease')
+    else:
+        dic['lease'] = claim.LEASE_DURATION
+
+    if 'reap_attempts' in items:
+        dic['reap_attempts'] = config.getint('sqla_taskq', 'reap_attempts')
+    else:
+        dic['reap_attempts'] = claim.REAP_ATTEMPTS
+
+    if 'task_timeout' in items:
+        dic['task_timeout'] = config.getfloat('sqla_taskq', 'task_timeout')
+    else:
+        dic['task_timeout'] = None
+
+    if 'timeout_mode' in items:
+        dic['timeout_mode'] = config.get('sqla_taskq', 'timeout_mode')
+    else:
+        dic['timeout_mode'] = timelimit.SIGNAL
+
+    if 'preload' in items:
+        dic['preload'] = parse_list(config.get('sqla_taskq', 'preload'))
+    else:
+        dic['preload'] = []
+
+    if 'queues' in items:
+        dic['queues'] = parse_list(config.get('sqla_taskq', 'queues'))
+    else:
+        dic['queues'] = []
+
+    for option, getter in [('pool_size', config.getint),
+                           ('pool_pre_ping', config.getboolean),
+                           ('pool_recycle', config.getint),
+                           ('sqlite_journal_mode', config.get),
+                           ('sqlite_busy_timeout', config.getint),
+                           ('sqlite_synchronous', config.get),
+                           ('sqlite_tuned', config.getboolean),
+                           ('result_store', config.get),
+                           ('result_path', config.get),
+                           ('result_inline_max', config.getint),
+                           ('result_ttl', config.getfloat)]:
+        if option in items:
+            dic[option] = getter('sqla_taskq', option)
+
+    # The retention policy used by sqla_taskq_purge: retention_<status> = days
+    retention = {}
+    for option in items:
+        if option.startswith('retention_'):
+            retention[option[len('retention_'):]] = config.getfloat(
+                'sqla_taskq', option)
+    if retention:
+        dic['retention'] = retention
+
     return dic
 
 
+def parse_queues(queues):
+    """Get the list of (queue, concurrency) from the list of names with an
+    optional concurrency: ['emails', 'reports:2']
+    """
+    subscriptions = []
+    for queue in queues or []:
+        if isinstance(queue, tuple):
+            subscriptions.append(queue)
+            continue
+        name, sep, concurrency = queue.partition(':')
+        if sep:
+            try:
+                concurrency = int(concurrency)
+            except ValueError:
+                raise ValueError('Invalid concurrency for the queue %s' %
+                                 queue)
+            if concurrency < 1:
+                raise ValueError('Invalid concurrency for the queue %s' %
+                                 queue)
+        else:
+            concurrency = None
+        subscriptions.append((name, concurrency))
+    return subscriptions
+
+
+def parse_list(value):
+    """Get the list of names separated by commas or spaces"""
+    return [name for name in re.split(r'[\s,]+', value or '') if name]
+
+
+def get_engine_options(dic):
+    """Get the parameters to pass to models.configure_engine from the parsed
+    options
+    """
+    return dict([(k, dic[k]) for k in ENGINE_OPTIONS
+                 if dic.get(k) is not None])
+
+
+def configure_engine(models, dic):
+    """Configure the engine of models if some engine options are given"""
+    options = get_engine_options(dic)
+    if options:
+        models.configure_engine(**options)
+
+
+def get_result_options(dic):
+    """Get the parameters to pass to results.configure from the parsed
+    options
+    """
+    return dict([(setting, dic[k]) for k, setting in RESULT_OPTIONS.items()
+                 if dic.get(k) is not None])
+
+
+def configure_results(dic):
+    """Configure the storage of the results if some result options are
+    given"""
+    options = get_result_options(dic)
+    if options:
+        results.configure(**options)
+
+
+def get_run_options(dic):
+    """Get the parameters to pass to run from the parsed options
+    """
+    return dict([(k, dic[k]) for k in RUN_OPTIONS if k in dic])
+
+
 def parse_options(argv=sys.argv, parse_timeout=False):
     parser = OptionParser()
     parser.add_option(
@@ -175,6 +733,165 @@ def parse_options(argv=sys.argv, parse_timeout=False):
         default=False,
         help="Don't wait the process in progress to be finished, kill it")
 
+    parser.add_option(
+        "-p", "--prefetch", dest="prefetch",
+        help=("The number of tasks claimed at once by the process. "
+              "By default the tasks are claimed one by one"),
+        type="int", default=1,
+        metavar="number")
+
+    parser.add_option(
+        "-n", "--concurrency", dest="concurrency",
+        help=("The number of worker processes. "
+              "By default the tasks are run in the main process"),
+        type="int", default=1,
+        metavar="number")
+
+    parser.add_option(
+        "--threads", dest="threads",
+        help=("The number of threads running the tasks in each worker "
+              "process. Useful for the I/O-bound tasks"),
+        type="int", default=1,
+        metavar="number")
+
+    parser.add_option(
+        "--coroutines", dest="coroutines",
+        help=("Run the coroutine tasks on an asyncio event loop with at most "
+              "this number of tasks in progress. Disabled by default"),
+        type="int", default=0,
+        metavar="number")
+
+    parser.add_option(
+        "--poll-min", dest="poll_min",
+        help=("The delay in second before polling again the DB when the "
+              "queue is empty. Default: %s" % POLL_MIN),
+        type="float", default=POLL_MIN,
+        metavar="time")
+
+    parser.add_option(
+        "--poll-max", dest="poll_max",
+        help=("The maximum delay in second between two polls of the DB. "
+              "Default: %s" % POLL_MAX),
+        type="float", default=POLL_MAX,
+        metavar="time")
+
+    parser.add_option(
+        "--backoff-factor", dest="backoff_factor",
+        help=("The delay between two polls is multiplied by this factor "
+              "while the queue is empty. Default: %s" % BACKOFF_FACTOR),
+        type="float", default=BACKOFF_FACTOR,
+        metavar="factor")
+
+    parser.add_option(
+        "--aging", dest="aging",
+        help=("Give the aging priority to the tasks waiting for more than "
+              "this number of seconds. Disabled by default"),
+        type="float", default=0,
+        metavar="time")
+
+    parser.add_option(
+        "--aging-priority", dest="aging_priority",
+        help="The priority given to the old waiting tasks. Default: 0",
+        type="int", default=0,
+        metavar="priority")
+
+    parser.add_option(
+        "--lease", dest="lease",
+        help=("The tasks of a worker which hasn't shown a sign of life for "
+              "this number of seconds are reaped. Default: %s" %
+              claim.LEASE_DURATION),
+        type="float", default=claim.LEASE_DURATION,
+        metavar="time")
+
+    parser.add_option(
+        "--reap-attempts", dest="reap_attempts",
+        help=("A reaped task is failed instead of requeued when it has been "
+              "run this number of times. Default: %s" % claim.REAP_ATTEMPTS),
+        type="int", default=claim.REAP_ATTEMPTS,
+        metavar="number")
+
+    parser.add_option(
+        "--task-timeout", dest="task_timeout",
+        help=("Interrupt the tasks running for more than this number of "
+              "seconds, the timeout given to Task.create has the priority. "
+              "Disabled by default"),
+        type="float", metavar="time")
+
+    parser.add_option(
+        "--timeout-mode", dest="timeout_mode",
+        help=("How the tasks are interrupted: signal (SIGALRM in the main "
+              "thread) or process (the task is run in a child process "
+              "killed at the timeout). Default: %s" % timelimit.SIGNAL),
+        type="choice", choices=timelimit.MODES, default=timelimit.SIGNAL,
+        metavar="mode")
+
+    parser.add_option(
+        "--queues", dest="queues",
+        help=("The queues run by the workers separated by commas, the first "
+              "ones are served first. A queue can have a concurrency: the "
+              "maximum number of its tasks in progress by worker process "
+              "(ex: emails,reports:2). By default all the queues are run"),
+        default='',
+        metavar="queues")
+
+    parser.add_option(
+        "--preload", dest="preload",
+        help=("The modules or functions imported by the workers before "
+              "running the tasks, separated by commas"),
+        default='',
+        metavar="names")
+
+    parser.add_option(
+        "--pool-size", dest="pool_size",
+        help="The number of connections kept in the pool of the engine",
+        type="int", metavar="number")
+    parser.add_option(
+        "--pool-pre-ping", dest="pool_pre_ping",
+        action="store_true",
+        help="Test the connections when they are taken from the pool")
+    parser.add_option(
+        "--pool-recycle", dest="pool_recycle",
+        help="Reconnect the connections older than this number of seconds",
+        type="int", metavar="time")
+    parser.add_option(
+        "--sqlite-journal-mode", dest="sqlite_journal_mode",
+        help="The journal_mode pragma of the sqlite connections (ex: wal)",
+        metavar="mode")
+    parser.add_option(
+        "--sqlite-busy-timeout", dest="sqlite_busy_timeout",
+        help=("The busy_timeout pragma of the sqlite connections in "
+              "millisecond"),
+        type="int", metavar="time")
+    parser.add_option(
+        "--sqlite-synchronous", dest="sqlite_synchronous",
+        help="The synchronous pragma of the sqlite connections (ex: normal)",
+        metavar="mode")
+    parser.add_option(
+        "--sqlite-tuned", dest="sqlite_tuned",
+        action="store_true",
+        help=("Set the sqlite pragmas to share the DB between many workers: "
+              "wal journal, busy timeout of 5s and normal synchronous"))
+
+    parser.add_option(
+        "--result-store", dest="result_store",
+        help=("Where the large results are stored: db (task_result table) or "
+              "file (result-path directory)"),
+        type="choice", choices=results.STORES, metavar="store")
+    parser.add_option(
+        "--result-path", dest="result_path",
+        help="The directory of the file result store",
+        metavar="path")
+    parser.add_option(
+        "--result-inline-max", dest="result_inline_max",
+        help=("The results longer than this number of characters are stored "
+              "out of the task table"),
+        type="int", metavar="size")
+    parser.add_option(
+        "--result-ttl", dest="result_ttl",
+        help=("The number of seconds the large results are kept. "
+              "They are deleted by sqla_taskq_purge"),
+        type="float", metavar="time")
+
     if parse_timeout:
         parser.add_option(
             "-t", "--timeout", dest="timeout",
@@ -182,12 +899,22 @@ def parse_options(argv=sys.argv, parse_timeout=False):
                   "By default it waits 60 seconds the process to finish"),
             type="int", default=60,
             metavar="time")
+        parser.add_option(
+            "--json", dest="json",
+            action="store_true",
+            default=False,
+            help="Display the status as JSON")
 
     (options, args) = parser.parse_args(argv)
+    options.preload = parse_list(options.preload)
+    options.queues = parse_list(options.queues)
 
     dic = None
     if options.config_filename:
         dic = parse_config_file(options.config_filename)
+        if dic is not None and parse_timeout:
+            # Not a setting of the config file
+            dic['json'] = options.json
 
     if dic is None:
         dic = vars(options)
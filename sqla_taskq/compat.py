@@ -0,0 +1,12 @@
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    # python 2.6
+    from ordereddict import OrderedDict
+
+
+def total_seconds(delta):
+    """The number of seconds of the timedelta, timedelta.total_seconds is
+    new in python 2.7
+    """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
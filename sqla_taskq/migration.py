@@ -0,0 +1,83 @@
+import logging
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn
+
+
+log = logging.getLogger(__name__)
+
+
+def add_column(connection, table, column):
+    """Add the column to an existing table. The new columns should be nullable
+    or have a server default.
+    """
+    connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+        table.name, CreateColumn(column).compile(dialect=connection.dialect)))
+    log.info('Column %s.%s added' % (table.name, column.name))
+
+
+def drop_index(connection, table, name):
+    # An Index needs a column, don't add it to the table of the models
+    column = table.primary_key.columns.values()[0]
+    other = sqlalchemy.Table(
+        table.name, sqlalchemy.MetaData(),
+        sqlalchemy.Column(column.name, column.type))
+    sqlalchemy.Index(name, other.c[column.name]).drop(connection)
+    log.info('Index %s dropped' % name)
+
+
+def upgrade(engine, models):
+    """Create the missing tables, columns and indexes of an existing
+    database. It can be run many times.
+    """
+    metadata = models.Base.metadata
+    with engine.connect() as connection:
+        has_key_lock = engine.dialect.has_table(
+            connection, models.TaskKeyLock.__tablename__)
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        if not has_key_lock:
+            lock_key_in_progress(connection, models)
+        inspector = sqlalchemy.inspect(connection)
+        for table in metadata.sorted_tables:
+            columns = set([c['name']
+                           for c in inspector.get_columns(table.name)])
+            for column in table.columns:
+                if column.name not in columns:
+                    add_column(connection, table, column)
+
+            indexes = set([i['name']
+                           for i in inspector.get_indexes(table.name)])
+            if table is models.Task.__table__:
+                for name in models.OBSOLETE_INDEXES:
+                    if name in indexes:
+                        drop_index(connection, table, name)
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    log.info('Index %s created' % index.name)
+
+            if table is not models.Task.__table__:
+                continue
+            if connection.dialect.name not in models.PARTIAL_INDEX_DIALECTS:
+                continue
+            for name, ddl in models.PARTIAL_INDEXES.items():
+                if name not in indexes:
+                    connection.execute(ddl)
+                    log.info('Index %s created' % name)
+
+
+def lock_key_in_progress(connection, models):
+    """Lock the unique keys of the tasks in progress, used when the
+    task_key_lock table is created on an existing database.
+    """
+    result = connection.execute(sqlalchemy.text("""
+    INSERT INTO task_key_lock (unique_key, idtask, lock_date)
+    SELECT unique_key, MIN(idtask), MIN(lock_date)
+      FROM task
+     WHERE status = :inprogress
+       AND unique_key IS NOT NULL
+     GROUP BY unique_key
+    """).execution_options(autocommit=True),
+        inprogress=models.TASK_STATUS_IN_PROGRESS)
+    if result.rowcount:
+        log.info('%i unique keys locked' % result.rowcount)
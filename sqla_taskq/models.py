@@ -1,17 +1,25 @@
 import os
+import re
+import sys
 import traceback
 from sqlalchemy import (
     Column,
     Integer,
     Text,
     String,
+    Float,
     Boolean,
-    PickleType,
     DateTime,
     UnicodeText,
+    LargeBinary,
+    Index,
+    DDL,
+    Table,
     create_engine,
+    event,
 )
 
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import (
     scoped_session,
     sessionmaker,
@@ -19,12 +27,23 @@ from sqlalchemy.orm import (
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import (
+    ZopeTransactionExtension,
+    mark_changed,
+)
 import transaction
 import inspect
 import importlib
+import threading
 import logging
 import datetime
+from sqla_taskq import wakeup
+from sqla_taskq import aio
+from sqla_taskq.codec import PayloadType
+from sqla_taskq import retry
+from sqla_taskq import timelimit
+from sqla_taskq import results
+from sqla_taskq.compat import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -39,28 +58,144 @@ DBSession.configure(bind=engine)
 Base.metadata.bind = engine
 Base.query = DBSession.query_property()
 
+# The pragmas set by configure_engine(sqlite_tuned=True) to share a sqlite
+# file between many workers: the readers don't block the writer and the
+# writers wait for the lock
+SQLITE_TUNED_PRAGMAS = {
+    'journal_mode': 'wal',
+    'busy_timeout': 5000,
+    'synchronous': 'normal',
+}
+
+
+def _sqlite_pragmas_listener(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return connect
+
+
+def configure_engine(url=None, pool_size=None, pool_pre_ping=None,
+                     pool_recycle=None, sqlite_journal_mode=None,
+                     sqlite_busy_timeout=None, sqlite_synchronous=None,
+                     sqlite_tuned=None):
+    """Replace the engine with a new one created with the given pool
+    settings. The sqlite_* pragmas are set on each new sqlite connection,
+    sqlite_tuned gives them the values of SQLITE_TUNED_PRAGMAS by default.
+    """
+    global engine
+    url = url or sqlalchemy_url
+    is_sqlite = make_url(url).get_backend_name() == 'sqlite'
+    kw = {'echo': False}
+    if pool_pre_ping:
+        kw['pool_pre_ping'] = True
+    if pool_recycle is not None:
+        kw['pool_recycle'] = pool_recycle
+    if pool_size is not None:
+        if is_sqlite:
+            # Not supported by the sqlite pools
+            log.warning('pool_size is ignored with sqlite')
+        else:
+            kw['pool_size'] = pool_size
+
+    pragmas = []
+    for name, value in [('journal_mode', sqlite_journal_mode),
+                        ('busy_timeout', sqlite_busy_timeout),
+                        ('synchronous', sqlite_synchronous)]:
+        if value is None and sqlite_tuned:
+            value = SQLITE_TUNED_PRAGMAS[name]
+        if value is None:
+            continue
+        if not re.match(r'^\w+$', str(value)):
+            raise ValueError('Invalid value for the pragma %s: %s' % (
+                name, value))
+        pragmas.append((name, value))
+    if pragmas and not is_sqlite:
+        log.warning('The sqlite pragmas are ignored with %s' % url)
+        pragmas = []
+
+    new_engine = create_engine(url, **kw)
+    if pragmas:
+        event.listen(new_engine, 'connect',
+                     _sqlite_pragmas_listener(pragmas))
+    engine.dispose()
+    engine = new_engine
+    DBSession.remove()
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    return engine
+
 
 TASK_STATUS_WAITING = 'waiting'
 TASK_STATUS_IN_PROGRESS = 'inprogress'
 TASK_STATUS_FINISHED = 'finished'
 TASK_STATUS_FAILED = 'failed'
+TASK_STATUS_TIMED_OUT = 'timedout'
+
+# The tasks with the smallest priority are run first
+PRIORITY_DEFAULT = 0
+# The queue of the tasks created without queue
+QUEUE_DEFAULT = 'default'
+
+# The parameters of Task.create, used for the tuple specs of create_many
+CREATE_PARAMS = ['func', 'args', 'kw', 'description', 'owner', 'unique_key',
+                 'priority', 'run_after', 'retry', 'timeout', 'queue']
+# The number of tasks inserted in one transaction by create_many
+CREATE_CHUNK_SIZE = 1000
+# The maximum length of a unique_key, it's locked in task_key_lock
+UNIQUE_KEY_MAX_LENGTH = 255
+# The number of functions kept in the cache of import_func
+FUNC_CACHE_SIZE = 1000
+# The functions by name, the most recently used are at the end
+_func_cache = OrderedDict()
+_func_cache_lock = threading.Lock()
+# The columns returned by Task.summaries
+SUMMARY_COLUMNS = ['idtask', 'func_name', 'description', 'queue', 'status',
+                   'owner', 'unique_key', 'priority', 'attempts', 'timeout',
+                   'creation_date', 'not_before', 'start_date', 'end_date',
+                   'pid', 'worker', 'lock_date', 'lease_expires']
 
 
 class Task(Base):
     _func_params = [
         ('_instance', None),
-        ('_func_name', None),
         ('_args', []),
         ('_kw', {}),
     ]
 
     __tablename__ = 'task'
+    __table_args__ = (
+        # Used to claim the tasks
+        Index('ix_task_status_pid_priority_idtask',
+              'status', 'pid', 'priority', 'idtask'),
+        # Used to serialize the tasks by unique_key
+        Index('ix_task_unique_key_status', 'unique_key', 'status'),
+        # Used to purge the old tasks
+        Index('ix_task_status_end_date', 'status', 'end_date'),
+        # Used to find the tasks by function
+        Index('ix_task_func_name', 'func_name'),
+        # Used to find the next delayed task
+        Index('ix_task_status_not_before', 'status', 'not_before'),
+        # Used to claim the tasks of the subscribed queues
+        Index('ix_task_queue_status_priority_idtask',
+              'queue', 'status', 'priority', 'idtask'),
+        # Used to reap the tasks of the dead workers
+        Index('ix_task_status_lease_expires', 'status', 'lease_expires'),
+    )
 
     idtask = Column(Integer, nullable=False, autoincrement=True,
                     primary_key=True)
-    func = Column(PickleType, nullable=False)
+    # The instance and the parameters of the function, only loaded when the
+    # function or its parameters are used
+    func = orm.deferred(Column(PayloadType, nullable=False))
+    func_name = Column(String(255), nullable=True)
     description = Column(UnicodeText, nullable=False)
     result = Column(UnicodeText, nullable=True)
+    # Where the large result is stored instead of the result column: 'db'
+    # (task_result table) or 'file:<name>' (file store)
+    result_ref = Column(String(255), nullable=True)
     status = Column(String, nullable=False, default=TASK_STATUS_WAITING)
     owner = Column(String, nullable=True)
     creation_date = Column(DateTime, nullable=False,
@@ -69,82 +204,234 @@ class Task(Base):
     end_date = Column(DateTime, nullable=True)
     pid = Column(Integer, nullable=True, default=None)
     lock_date = Column(DateTime, nullable=True)
+    # The worker which has claimed the task: host:pid:start time
+    worker = Column(String(255), nullable=True)
+    # The task in progress is reaped after this date if its worker doesn't
+    # renew the lease
+    lease_expires = Column(DateTime, nullable=True)
     unique_key = Column(String, nullable=True)
+    priority = Column(Integer, nullable=False, default=PRIORITY_DEFAULT,
+                      server_default=str(PRIORITY_DEFAULT))
+    queue = Column(String(255), nullable=False, default=QUEUE_DEFAULT,
+                   server_default=QUEUE_DEFAULT)
+    # The task is not run before this date
+    not_before = Column(DateTime, nullable=True)
+    # The task is interrupted after this number of seconds
+    timeout = Column(Float, nullable=True)
+    # The number of times the task has been run
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
 
     def __init__(self):
+        self._func_name = None
+        self._retry = None
         for p, d in self._func_params:
             setattr(self, p, None)
 
-    @orm.reconstructor
-    def init_on_load(self):
-        self.load_func()
+    def __getattr__(self, name):
+        # Decode the payload of the loaded tasks on first access
+        if name == '_func_name' and self.func_name is not None:
+            return self.func_name
+        if (name in ('_func_name', '_retry') or
+                name in dict(self._func_params)):
+            self.load_func()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    @classmethod
+    def get_with_payload(cls, idtask):
+        """Get the task with its payload loaded in the same query, used to
+        perform it
+        """
+        return cls.query.options(orm.undefer('func')).get(idtask)
+
+    @classmethod
+    def summaries(cls, **filters):
+        """Query the tasks without their payload, the rows are read-only
+        named tuples with the SUMMARY_COLUMNS. Useful to display the tasks.
+        """
+        query = DBSession.query(*[getattr(cls, name)
+                                  for name in SUMMARY_COLUMNS])
+        if filters:
+            query = query.filter_by(**filters)
+        return query.order_by(cls.idtask)
+
+    @staticmethod
+    def resolve_func(func):
+        """Get the instance, the function name and the default description
+        to store for the given func
+        """
+        instance = None
+        if inspect.ismethod(func):
+            instance = func.__self__
+            func_name = func.__name__
+        elif inspect.isfunction(func) or inspect.isbuiltin(func):
+            func_name = '%s.%s' % (func.__module__, func.__name__)
+        else:
+            func_name = func
+
+        if isinstance(func, basestring):
+            description = ('%s' % func)
+        elif func.__doc__:
+            description = func.__doc__.splitlines()[0]
+        else:
+            # TODO: create a nice fallback
+            description = ('%s' % func.__name__)
+        return instance, func_name, description
 
     @classmethod
     def create(cls, func, args=None, kw=None, description=None, owner=None,
-               unique_key=None):
+               unique_key=None, priority=None, run_after=None, retry=None,
+               timeout=None, queue=None):
+        """Create a task to run func(*args, **kw).
+
+        run_after delays the task: a UTC datetime, a timedelta or a number of
+        seconds.
+
+        retry is the RetryPolicy (or a dict of its parameters) used when the
+        task fails, by default the one set on the function by the retry
+        decorator.
+
+        timeout is the number of seconds after which the task is interrupted,
+        by default the one of the worker.
+
+        queue is the name of the queue of the task, only the workers
+        subscribed to it run the task (by default the workers run all the
+        queues).
+        """
+        _check_unique_key(unique_key)
         with transaction.manager:
             task = cls()
-            if inspect.ismethod(func):
-                task._instance = func.__self__
-                task._func_name = func.__name__
-            elif inspect.isfunction(func) or inspect.isbuiltin(func):
-                task._func_name = '%s.%s' % (func.__module__, func.__name__)
-            else:
-                task._func_name = func
+            task._instance, task._func_name, default_description = (
+                cls.resolve_func(func))
 
             task.description = description
-
             if description is None:
-                if isinstance(func, basestring):
-                    task.description = ('%s' % func)
-                elif func.__doc__:
-                    task.description = func.__doc__.splitlines()[0]
-                else:
-                    # TODO: create a nice fallback
-                    task.description = ('%s' % func.__name__)
+                task.description = default_description
 
             task._args = args
             task._kw = kw
             task.owner = owner
             task.unique_key = unique_key
+            if priority is not None:
+                task.priority = priority
+            task.not_before = get_not_before(run_after)
+            task._retry = _get_retry(retry)
+            task.timeout = timeout
+            task.queue = queue or QUEUE_DEFAULT
 
             task.func = task.dump_func()
+            task.func_name = task._func_name
             task.status = TASK_STATUS_WAITING
             DBSession.add(task)
+            wakeup.notify(DBSession)
             log.debug('Task created for %s' % func)
         return task
 
+    @classmethod
+    def iter_create_many(cls, specs, chunk_size=CREATE_CHUNK_SIZE):
+        """Create the tasks with multi-row INSERTs, one transaction by chunk.
+        Yield the number of tasks created for each chunk.
+
+        specs is an iterable (it can be a generator) of dict with the
+        parameters of Task.create or of tuple (func, args, kw, ...)
+        """
+        # (func, info) by id of func: the bound methods of equal instances
+        # are equal but they don't have the same instance. The func is kept
+        # so its id can't be reused, the cache is cleared after each chunk to
+        # not keep the funcs (and their instances) of the whole stream.
+        resolved = {}
+        rows = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                spec = dict(zip(CREATE_PARAMS, spec))
+            func = spec['func']
+            if id(func) not in resolved:
+                resolved[id(func)] = (func, cls.resolve_func(func))
+            instance, func_name, description = resolved[id(func)][1]
+            if spec.get('description') is not None:
+                description = spec['description']
+            payload = {
+                '_instance': instance,
+                '_args': spec.get('args'),
+                '_kw': spec.get('kw'),
+            }
+            if spec.get('retry') is not None:
+                payload['_retry'] = _get_retry(spec['retry'])
+            rows.append({
+                'func': payload,
+                'func_name': func_name,
+                'description': description,
+                'owner': spec.get('owner'),
+                'unique_key': _check_unique_key(spec.get('unique_key')),
+                'priority': (PRIORITY_DEFAULT if spec.get('priority') is None
+                             else spec['priority']),
+                'not_before': get_not_before(spec.get('run_after')),
+                'timeout': spec.get('timeout'),
+                'queue': spec.get('queue') or QUEUE_DEFAULT,
+                'status': TASK_STATUS_WAITING,
+            })
+            if len(rows) >= chunk_size:
+                yield cls._insert_many(rows)
+                rows = []
+                resolved.clear()
+        if rows:
+            yield cls._insert_many(rows)
+
+    @classmethod
+    def create_many(cls, specs, chunk_size=CREATE_CHUNK_SIZE):
+        """Create the tasks with multi-row INSERTs. Return the number of
+        created tasks.
+
+        See iter_create_many for the parameters.
+        """
+        return sum(cls.iter_create_many(specs, chunk_size))
+
+    @classmethod
+    def _insert_many(cls, rows):
+        with transaction.manager:
+            DBSession.execute(cls.__table__.insert(), rows)
+            # Not an ORM change, tell zope.sqlalchemy to commit it
+            mark_changed(DBSession())
+            wakeup.notify(DBSession)
+        log.debug('%i tasks created' % len(rows))
+        return len(rows)
+
     def dump_func(self):
         """Create dict to store in the DB as pickle
         """
         data = {}
         for param, d in self._func_params:
             data[param] = getattr(self, param)
+        if self._retry is not None:
+            data['_retry'] = self._retry
         return data
 
     def load_func(self):
         """Set the parameter to self from the dict stored in the DB
         """
         for param, d in self._func_params:
-            v = self.func[param]
+            v = self.func.get(param)
             if v is None:
                 v = d
             setattr(self, param, v)
+        # The function name is in the payload of the old tasks
+        self._func_name = self.func_name or self.func.get('_func_name')
+        self._retry = self.func.get('_retry')
 
     def get_func(self):
         """Get the function to be able to call it!
         """
         if self._instance:
             return getattr(self._instance, self._func_name)
+        return import_func(self._func_name)
 
-        module_name, attribute = self._func_name.rsplit('.', 1)
-        module = importlib.import_module(module_name)
-        return getattr(module, attribute)
-
-    def perform(self):
-        """Call the function with its parameters
+    def perform(self, timeout=None, timeout_mode=timelimit.SIGNAL):
+        """Call the function with its parameters. The task is interrupted
+        after its timeout or the given default timeout in seconds, see
+        timelimit for the modes.
         """
         idtask = self.idtask
+        func = None
         try:
             log.debug('Performing task %i: %s' % (idtask,
                                                   self.description))
@@ -157,16 +444,308 @@ class Task(Base):
             self._args = self._args or []
             self._kw = self._kw or {}
             self.start_date = datetime.datetime.utcnow()
-            self.result = func(*self._args, **self._kw)
-            self.status = TASK_STATUS_FINISHED
-            self.end_date = datetime.datetime.utcnow()
-            log.debug('The task %i is finished in %s' % (
-                idtask,
-                self.end_date - self.start_date)
-            )
+
+            def call():
+                result = func(*self._args, **self._kw)
+                if aio.iscoroutine(result):
+                    # A coroutine function run by a synchronous worker
+                    result = aio.run_coroutine(result)
+                return result
+            result = timelimit.call(call, self.timeout or timeout,
+                                    timeout_mode, reset_after_fork)
+            self.set_finished(result)
         except:
             log.exception('The task %i has failed' % idtask)
-            self.result = traceback.format_exc()
-            self.status = TASK_STATUS_FAILED
-            self.end_date = datetime.datetime.utcnow()
-        return self.result
+            exception = sys.exc_info()[1]
+            # The traceback of the child process of the process mode
+            error = (getattr(exception, 'process_traceback', None) or
+                     traceback.format_exc())
+            self.set_failed(error, exception, func)
+            return self.result
+        # The large result is not in the result column
+        return result
+
+    def set_finished(self, result):
+        """Set the result of the task which has been run successfully, the
+        large results are stored out of the task table (see results)
+        """
+        self.store_result(result)
+        self.attempts = (self.attempts or 0) + 1
+        self.status = TASK_STATUS_FINISHED
+        self.lease_expires = None
+        self.end_date = datetime.datetime.utcnow()
+        self.unlock_key()
+        log.debug('The task %i is finished in %s' % (
+            self.idtask,
+            self.end_date - self.start_date)
+        )
+
+    def set_failed(self, error, exception=None, func=None):
+        """Set the traceback of the task which has failed. If the retry
+        policy allows it, the task is put back in the queue to be run again
+        after the backoff delay. The status of the interrupted tasks is
+        timedout.
+        """
+        self.result = error
+        self.result_ref = None
+        self.attempts = (self.attempts or 0) + 1
+        self.lease_expires = None
+        policy = None
+        if exception is not None:
+            policy = self.get_retry_policy(func)
+        if policy is not None and policy.should_retry(self.attempts,
+                                                      exception):
+            delay = policy.get_delay(self.attempts)
+            self.status = TASK_STATUS_WAITING
+            self.pid = None
+            self.worker = None
+            self.lock_date = None
+            self.not_before = (datetime.datetime.utcnow() +
+                               datetime.timedelta(seconds=delay))
+            self.unlock_key()
+            log.info('The task %i will be retried in %.1fs (attempt %i/%i)' % (
+                self.idtask, delay, self.attempts + 1, policy.max_attempts))
+            return
+        self.status = TASK_STATUS_FAILED
+        if isinstance(exception, timelimit.TaskTimeout):
+            self.status = TASK_STATUS_TIMED_OUT
+        self.end_date = datetime.datetime.utcnow()
+        self.unlock_key()
+
+    def store_result(self, result):
+        self.result = result
+        self.result_ref = None
+        if not results.is_large(result):
+            return
+        data, compressed = results.encode(result)
+        if results.settings['store'] == results.FILE:
+            name = results.save_file(self.idtask, data, compressed)
+            self.result_ref = '%s:%s' % (results.FILE, name)
+        else:
+            DBSession.merge(TaskResult(
+                idtask=self.idtask,
+                data=data,
+                compressed=compressed,
+                size=len(result),
+                creation_date=datetime.datetime.utcnow(),
+                expires=results.get_expires()))
+            self.result_ref = results.DB
+        self.result = None
+
+    def iter_result(self, chunk_size=results.CHUNK_SIZE):
+        """Yield the result by utf-8 encoded chunks, the large results are
+        not loaded in memory at once from the file store. Nothing is yielded
+        for an expired result.
+        """
+        if self.result_ref is None:
+            if self.result is not None:
+                result = self.result
+                if isinstance(result, unicode):
+                    result = result.encode('utf-8')
+                yield result
+            return
+        name = results.file_name(self.result_ref)
+        if name is not None:
+            chunks = results.iter_file(name, chunk_size)
+            compressed = name.endswith('.z')
+        else:
+            row = DBSession.query(TaskResult.data, TaskResult.compressed,
+                                  TaskResult.expires).filter_by(
+                idtask=self.idtask).first()
+            if row is None or (row.expires is not None and
+                               row.expires < datetime.datetime.utcnow()):
+                return
+            data = row.data
+            chunks = (data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size))
+            compressed = row.compressed
+        for chunk in results.iter_decode(chunks, compressed):
+            yield chunk
+
+    def get_result(self):
+        """Get the result of the task wherever it's stored, None if it has
+        expired
+        """
+        if self.result_ref is None:
+            return self.result
+        chunks = list(self.iter_result())
+        if not chunks:
+            return None
+        return ''.join(chunks).decode('utf-8')
+
+    def get_retry_policy(self, func=None):
+        """Get the RetryPolicy of the task: the one given to create or the
+        one of its function, None to never retry
+        """
+        if self._retry is not None:
+            return retry.RetryPolicy.from_dict(self._retry)
+        if func is None:
+            try:
+                func = self.get_func()
+            except Exception:
+                return None
+        return getattr(func, 'retry_policy', None)
+
+    def unlock_key(self):
+        """Release the unique_key locked when the task has been claimed, the
+        next task with the same key can be run.
+        """
+        if self.unique_key is None:
+            return
+        TaskKeyLock.query.filter_by(idtask=self.idtask).delete(
+            synchronize_session=False)
+
+
+class TaskResult(Base):
+    """The large results of the tasks, see results"""
+    __tablename__ = 'task_result'
+
+    idtask = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary, nullable=False)
+    compressed = Column(Boolean, nullable=False, default=False)
+    # The number of characters of the result
+    size = Column(Integer, nullable=False)
+    creation_date = Column(DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    # The result is deleted by results.purge after this date
+    expires = Column(DateTime, nullable=True, index=True)
+
+
+class TaskKeyLock(Base):
+    """The unique keys of the tasks in progress. The primary key prevents to
+    run two tasks with the same key at the same time.
+    """
+    __tablename__ = 'task_key_lock'
+
+    unique_key = Column(String(UNIQUE_KEY_MAX_LENGTH), primary_key=True)
+    idtask = Column(Integer, nullable=False, index=True)
+    lock_date = Column(DateTime, nullable=False)
+
+
+class TaskRateLimit(Base):
+    """The token buckets limiting the rate of the claimed tasks, shared by
+    all the workers, see ratelimit.
+    """
+    __tablename__ = 'task_rate_limit'
+
+    # The task column the limit applies to: func_name, queue or owner
+    scope = Column(String(32), primary_key=True)
+    # The value of the column, '*' for a limit applied to each value
+    name = Column(String(255), primary_key=True)
+    # The tokens added by second, NULL for the bucket of a value limited by
+    # the '*' limit of its scope
+    rate = Column(Float, nullable=True)
+    # The maximum number of tokens: the burst
+    capacity = Column(Float, nullable=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    # Incremented by each update, the tokens are taken only if the bucket
+    # hasn't been updated by another worker in the meantime
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
+
+def _get_retry(value):
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        value = retry.RetryPolicy(**value)
+    return value.to_dict()
+
+
+def _check_unique_key(unique_key):
+    if unique_key is not None and len(unique_key) > UNIQUE_KEY_MAX_LENGTH:
+        raise ValueError('The unique_key can\'t be longer than %i characters'
+                         % UNIQUE_KEY_MAX_LENGTH)
+    return unique_key
+
+
+def get_not_before(run_after):
+    """Get the date before which a task is not run from the run_after
+    parameter of Task.create
+    """
+    if run_after is None or isinstance(run_after, datetime.datetime):
+        return run_after
+    if not isinstance(run_after, datetime.timedelta):
+        run_after = datetime.timedelta(seconds=run_after)
+    return datetime.datetime.utcnow() + run_after
+
+
+def reset_after_fork():
+    """Forget the session, the transaction and the pooled connections
+    inherited from the parent process without closing them: they are still
+    used by the parent. The child gets its own connections.
+    """
+    DBSession.registry.clear()
+    manager = transaction.manager
+    if hasattr(manager, 'manager'):
+        manager.manager = transaction.TransactionManager()
+    else:
+        manager._txn = None
+    for bind in set([engine, DBSession.session_factory.kw.get('bind')]):
+        if getattr(bind, 'pool', None) is not None:
+            bind.pool = bind.pool.recreate()
+
+
+def import_func(func_name):
+    """Get the function from its dotted name. The functions are cached, the
+    least recently used are removed when there are more than FUNC_CACHE_SIZE.
+    """
+    with _func_cache_lock:
+        func = _func_cache.pop(func_name, None)
+        if func is not None:
+            _func_cache[func_name] = func
+            return func
+
+    module_name, attribute = func_name.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    func = getattr(module, attribute)
+    with _func_cache_lock:
+        _func_cache[func_name] = func
+        while len(_func_cache) > FUNC_CACHE_SIZE:
+            _func_cache.popitem(last=False)
+    return func
+
+
+def clear_func_cache(func_name=None):
+    """Remove the given function or all the functions from the cache, ex:
+    after reloading a module
+    """
+    with _func_cache_lock:
+        if func_name is None:
+            _func_cache.clear()
+        else:
+            _func_cache.pop(func_name, None)
+
+
+def preload(names):
+    """Import the given modules or functions (dotted names) to not do it
+    when running the first tasks
+    """
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            if '.' not in name:
+                raise
+            import_func(name)
+        log.debug('%s preloaded' % name)
+
+
+# The partial indexes are only created for the dialects supporting them
+PARTIAL_INDEX_DIALECTS = ('postgresql', 'sqlite')
+PARTIAL_INDEXES = {
+    'ix_task_waiting_priority': DDL(
+        "CREATE INDEX ix_task_waiting_priority ON task (priority, idtask) "
+        "WHERE status = '%s' AND pid IS NULL" % TASK_STATUS_WAITING),
+}
+# The indexes replaced by the ones above, dropped by migration.upgrade
+OBSOLETE_INDEXES = ['ix_task_waiting', 'ix_task_status_pid_idtask']
+for ddl in PARTIAL_INDEXES.values():
+    event.listen(Task.__table__, 'after_create',
+                 ddl.execute_if(dialect=PARTIAL_INDEX_DIALECTS))
+
+
+# The old tasks moved out of the task table by archive.purge
+task_archive = Table(
+    'task_archive', Base.metadata,
+    *[column.copy() for column in Task.__table__.columns])
@@ -0,0 +1,117 @@
+import os
+import errno
+import signal
+import time
+import logging
+from sqla_taskq import command
+
+
+log = logging.getLogger(__name__)
+
+# Wait before restarting a worker which has died just after its start
+RESTART_DELAY = 1
+
+
+def _exit_status(code):
+    """Get the exit status of the process for the code of SystemExit"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+
+class WorkerPool(object):
+    """Fork many workers running command.run and restart them when they die.
+    SIGTERM is forwarded to the workers which stop according to the kill
+    option.
+    """
+
+    def __init__(self, models, concurrency, **options):
+        self.models = models
+        self.concurrency = concurrency
+        self.options = options
+        self.running = True
+        # pid -> start time
+        self.children = {}
+
+    def _run_child(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if not self.running:
+            # SIGTERM received before resetting the handler
+            os._exit(0)
+        # Don't share the DB connections of the master
+        self.models.engine.dispose()
+        self.models.DBSession.remove()
+        status = 1
+        try:
+            command.run(self.models, **self.options)
+            status = 0
+        except SystemExit as e:
+            # Raised by sigterm_kill_handler to stop the worker
+            status = _exit_status(e.code)
+        except Exception:
+            log.exception('Worker %i has failed' % os.getpid())
+        finally:
+            os._exit(status)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self._run_child()  # pragma: no cover
+        self.children[pid] = time.time()
+        log.info('Worker %i started' % pid)
+        if not self.running:
+            # SIGTERM received while forking
+            os.kill(pid, signal.SIGTERM)
+        return pid
+
+    def stop_handler(self, signal_number, stack_frame):
+        self.running = False
+        log.info('Stopping the workers by signal %i' % signal_number)
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        previous_handler = signal.signal(signal.SIGTERM, self.stop_handler)
+        if self.options.get('preload'):
+            # Imported once, the workers inherit the modules
+            self.models.preload(self.options['preload'])
+        # Dispose the connections before forking
+        self.models.engine.dispose()
+        for i in range(self.concurrency):
+            self.spawn()
+
+        try:
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                start = self.children.pop(pid, None)
+                if start is None or not self.running:
+                    continue
+                log.warning('Worker %i died with status %i, restarting it' % (
+                    pid, status))
+                if time.time() - start < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                if self.running:
+                    self.spawn()
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        log.info('All the workers are stopped')
+
+
+def run(models, concurrency=1, **options):
+    """Run the worker in this process or in a pool of processes according to
+    concurrency
+    """
+    if concurrency > 1:
+        WorkerPool(models, concurrency, **options).run()
+    else:
+        command.run(models, **options)
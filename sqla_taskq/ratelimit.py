@@ -0,0 +1,237 @@
+import datetime
+import logging
+from sqlalchemy import select, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqla_taskq import claim
+from sqla_taskq.compat import total_seconds
+
+
+log = logging.getLogger(__name__)
+
+# The task columns a limit can apply to
+FUNC = 'func_name'
+QUEUE = 'queue'
+OWNER = 'owner'
+SCOPES = [FUNC, QUEUE, OWNER]
+
+# The name of a limit applied to each value of its scope separately, ex: each
+# owner has its own bucket. A limit of the value itself takes precedence.
+EACH = '*'
+
+# The number of times the tokens of a task are taken again when another
+# worker has updated one of its buckets in the meantime
+ACQUIRE_ATTEMPTS = 3
+
+
+def _check_scope(scope):
+    if scope not in SCOPES:
+        raise ValueError('Unknown rate limit scope %s, the available scopes '
+                         'are: %s' % (scope, ', '.join(SCOPES)))
+
+
+def set_limit(connection, models, scope, name, rate, capacity=None):
+    """Limit the tasks whose scope column is name (or any value for EACH) to
+    rate tasks by second with bursts of capacity tasks (by default the rate,
+    at least 1). The bucket is full when the limit is created.
+    """
+    _check_scope(scope)
+    if rate <= 0:
+        raise ValueError('The rate should be positive')
+    capacity = max(1, capacity or rate)
+    table = models.TaskRateLimit.__table__
+    where = and_(table.c.scope == scope, table.c.name == name)
+    values = {
+        'rate': rate,
+        'capacity': capacity,
+        'updated_at': datetime.datetime.utcnow(),
+    }
+    trans = connection.begin()
+    try:
+        tokens = connection.execute(
+            select([table.c.tokens]).where(where)).scalar()
+        if tokens is None:
+            connection.execute(table.insert().values(
+                scope=scope, name=name, tokens=capacity, version=0, **values))
+        else:
+            connection.execute(table.update().where(where).values(
+                tokens=min(tokens, capacity), version=table.c.version + 1,
+                **values))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+def delete_limit(connection, models, scope, name):
+    """Delete the limit and for EACH the buckets of the values"""
+    _check_scope(scope)
+    table = models.TaskRateLimit.__table__
+    where = and_(table.c.scope == scope, table.c.name == name)
+    if name == EACH:
+        where = or_(where, and_(table.c.scope == scope,
+                                table.c.rate.is_(None)))
+    connection.execute(
+        table.delete().where(where).execution_options(autocommit=True))
+
+
+class Bucket(object):
+
+    def __init__(self, row):
+        self.tokens = row.tokens
+        self.updated_at = row.updated_at
+        self.version = row.version
+
+    def available(self, rate, capacity, now):
+        """Get the number of tokens refilled at the given date"""
+        elapsed = max(0, total_seconds(now - self.updated_at))
+        return min(capacity, self.tokens + elapsed * rate)
+
+
+class RateLimits(object):
+    """The limits and the buckets stored in the task_rate_limit table when
+    they have been loaded. The tokens are always taken with an update
+    checking the version of the buckets.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        # (rate, capacity) by (scope, name)
+        self.limits = {}
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.limits)
+
+    def load(self, connection, keys=None):
+        table = self.models.TaskRateLimit.__table__
+        query = select([table])
+        if keys is not None:
+            for key in keys:
+                self.buckets.pop(key, None)
+            query = query.where(or_(*[
+                and_(table.c.scope == scope, table.c.name == name)
+                for scope, name in keys]))
+        for row in connection.execute(query):
+            key = (row.scope, row.name)
+            if row.rate is not None:
+                self.limits[key] = (row.rate, row.capacity)
+            self.buckets[key] = Bucket(row)
+
+    def get_limit(self, scope, name):
+        """Get the (rate, capacity) applied to the value of the scope"""
+        return self.limits.get((scope, name), self.limits.get((scope, EACH)))
+
+    def blocked(self, now=None):
+        """Get the values without token by scope, the tasks with these
+        values are not claimed.
+        """
+        now = now or datetime.datetime.utcnow()
+        blocked = {}
+        for (scope, name), bucket in self.buckets.items():
+            limit = self.get_limit(scope, name)
+            if name == EACH or limit is None:
+                continue
+            if bucket.available(limit[0], limit[1], now) < 1:
+                blocked.setdefault(scope, []).append(name)
+        return blocked
+
+    def _create_buckets(self, connection, keys, now):
+        table = self.models.TaskRateLimit.__table__
+        for scope, name in keys:
+            if (scope, name) in self.buckets:
+                continue
+            try:
+                connection.execute(table.insert().values(
+                    scope=scope, name=name, rate=None, capacity=None,
+                    tokens=self.get_limit(scope, name)[1], updated_at=now,
+                    version=0).execution_options(autocommit=True))
+            except IntegrityError:
+                # Created by another worker
+                pass
+
+    def _take(self, connection, keys, now):
+        """Take a token from each bucket, return None when a bucket has been
+        updated by another worker.
+        """
+        table = self.models.TaskRateLimit.__table__
+        tokens = {}
+        for key in keys:
+            rate, capacity = self.get_limit(*key)
+            tokens[key] = self.buckets[key].available(rate, capacity, now) - 1
+            if tokens[key] < 0:
+                return False
+        trans = claim._begin(connection,
+                             claim._write_begin_statement(connection))
+        try:
+            for key in keys:
+                scope, name = key
+                result = connection.execute(table.update().where(and_(
+                    table.c.scope == scope,
+                    table.c.name == name,
+                    table.c.version == self.buckets[key].version)).values(
+                        tokens=tokens[key], updated_at=now,
+                        version=table.c.version + 1))
+                if not result.rowcount:
+                    trans.rollback()
+                    return None
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        for key in keys:
+            bucket = self.buckets[key]
+            bucket.tokens = tokens[key]
+            bucket.updated_at = now
+            bucket.version += 1
+        return True
+
+    def acquire(self, connection, keys):
+        """Take a token from the buckets of the given keys, all or none.
+        Return False if a bucket is empty.
+        """
+        if not keys:
+            return True
+        for attempt in range(ACQUIRE_ATTEMPTS):
+            now = datetime.datetime.utcnow()
+            if any(key not in self.buckets for key in keys):
+                self._create_buckets(connection, keys, now)
+                self.load(connection, keys)
+            taken = self._take(connection, keys, now)
+            if taken is not None:
+                return taken
+            self.load(connection, keys)
+        return False
+
+    def get_keys(self, values):
+        """Get the buckets of a task from the values of its SCOPES columns"""
+        return [(scope, value) for scope, value in zip(SCOPES, values)
+                if value is not None and
+                self.get_limit(scope, value) is not None]
+
+    def acquire_tasks(self, connection, idtasks):
+        """Take the tokens of the claimed tasks. Return the tasks which have
+        got their tokens and the ones which would exceed a limit.
+        """
+        if not idtasks or not self.limits:
+            return idtasks, []
+        table = self.models.Task.__table__
+        rows = connection.execute(
+            select([table.c.idtask] + [table.c[scope] for scope in SCOPES])
+            .where(table.c.idtask.in_(idtasks))).fetchall()
+        values = dict((row[0], row[1:]) for row in rows)
+        granted = []
+        denied = []
+        for idtask in idtasks:
+            keys = self.get_keys(values.get(idtask, ()))
+            if self.acquire(connection, keys):
+                granted.append(idtask)
+            else:
+                denied.append(idtask)
+        return granted, denied
+
+
+def load(connection, models):
+    """Get the RateLimits with all the limits and buckets loaded"""
+    limits = RateLimits(models)
+    limits.load(connection)
+    return limits
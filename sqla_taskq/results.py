@@ -0,0 +1,180 @@
+import os
+import re
+import time
+import zlib
+import datetime
+import logging
+from sqlalchemy import select
+
+
+log = logging.getLogger(__name__)
+
+# The large results are stored in the task_result table
+DB = 'db'
+# The large results are stored in files in settings['path']
+FILE = 'file'
+STORES = [DB, FILE]
+
+# The size of the chunks read from the stores
+CHUNK_SIZE = 64 * 1024
+# The number of expired results deleted in one transaction
+PURGE_BATCH_SIZE = 1000
+# The names of the files written by save_file: the id of the task and .z when
+# the result is compressed. Only these files are purged.
+FILE_NAME_RE = re.compile(r'^\d+(\.z)?$')
+
+
+def _int_or_none(value):
+    if not value:
+        return None
+    return int(value)
+
+
+settings = {
+    # Where the large results are stored
+    'store': os.environ.get('SQLA_TASKQ_RESULT_STORE') or DB,
+    # The directory of the file store
+    'path': os.environ.get('SQLA_TASKQ_RESULT_PATH'),
+    # The results longer than this number of characters are stored out of the
+    # task table, None to store all the results in the task table
+    'inline_max': _int_or_none(os.environ.get('SQLA_TASKQ_RESULT_INLINE_MAX')),
+    # Compress the large results with zlib
+    'compress': True,
+    # The number of seconds the large results are kept, None to keep them
+    # forever
+    'ttl': None,
+}
+
+
+def configure(**kw):
+    """Change the settings used to store the new results, see settings for
+    the parameters. The stored results are always readable.
+    """
+    for key, value in kw.items():
+        if key not in settings:
+            raise TypeError('Unknown setting %s' % key)
+        if key == 'store' and value not in STORES:
+            raise ValueError('Unknown result store %s, the available stores '
+                             'are: %s' % (value, ', '.join(STORES)))
+        settings[key] = value
+    if settings['store'] == FILE and not settings['path']:
+        raise ValueError('The path is required by the file result store')
+
+
+def is_large(result):
+    """Tell if the result should be stored out of the task table"""
+    return (settings['inline_max'] is not None and
+            isinstance(result, basestring) and
+            len(result) > settings['inline_max'])
+
+
+def encode(result):
+    """Get the bytes to store and if they are compressed"""
+    if isinstance(result, unicode):
+        result = result.encode('utf-8')
+    if settings['compress']:
+        return zlib.compress(result), True
+    return result, False
+
+
+def iter_decode(chunks, compressed):
+    """Yield the utf-8 encoded chunks of the stored result"""
+    decompressor = zlib.decompressobj() if compressed else None
+    for chunk in chunks:
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def get_expires(now=None):
+    if settings['ttl'] is None:
+        return None
+    now = now or datetime.datetime.utcnow()
+    return now + datetime.timedelta(seconds=settings['ttl'])
+
+
+def file_name(ref):
+    """Get the name of the file of the given result_ref, None if the result
+    is not in the file store
+    """
+    if ref is None or not ref.startswith(FILE + ':'):
+        return None
+    return ref[len(FILE) + 1:]
+
+
+def _file_path(name):
+    return os.path.join(settings['path'], name)
+
+
+def save_file(idtask, data, compressed):
+    """Write the result in the file store. Return the name of the file."""
+    name = '%i%s' % (idtask, '.z' if compressed else '')
+    path = _file_path(name)
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    # The readers never see a partial file
+    os.rename(tmp, path)
+    return name
+
+
+def iter_file(name, chunk_size=CHUNK_SIZE):
+    """Yield the chunks of the stored file, nothing if it doesn't exist"""
+    try:
+        f = open(_file_path(name), 'rb')
+    except IOError:
+        log.warning('The result file %s doesn\'t exist' % name)
+        return
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def delete_file(name):
+    try:
+        os.remove(_file_path(name))
+    except OSError:
+        pass
+
+
+def purge(connection, models, now=None, batch_size=PURGE_BATCH_SIZE):
+    """Delete the expired results of the task_result table and the files of
+    the file store older than the ttl. Return the number of deleted results.
+    """
+    now = now or datetime.datetime.utcnow()
+    table = models.TaskResult.__table__
+    count = 0
+    while True:
+        idtasks = [row[0] for row in connection.execute(
+            select([table.c.idtask]).where(table.c.expires < now).limit(
+                batch_size))]
+        if not idtasks:
+            break
+        connection.execute(table.delete().where(
+            table.c.idtask.in_(idtasks)).execution_options(autocommit=True))
+        count += len(idtasks)
+        if len(idtasks) < batch_size:
+            break
+
+    path = settings['path']
+    if settings['ttl'] is not None and path and os.path.isdir(path):
+        before = time.time() - settings['ttl']
+        for name in os.listdir(path):
+            # The directory can contain other files
+            if not FILE_NAME_RE.match(name):
+                continue
+            try:
+                if os.path.getmtime(_file_path(name)) < before:
+                    delete_file(name)
+                    count += 1
+            except OSError:
+                pass
+    return count
@@ -0,0 +1,80 @@
+import random
+import importlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _import_class(name):
+    module_name, attribute = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+class RetryPolicy(object):
+    """When and how long after to run again a failed task.
+
+    The task is run at most max_attempts times. The delay before the attempt
+    n + 1 is backoff_base * 2 ** (n - 1) seconds limited to backoff_max,
+    with jitter it's a random delay between the half and this delay. Only
+    the errors which are instances of the given exceptions are retried.
+    """
+
+    def __init__(self, max_attempts=3, backoff_base=1, backoff_max=3600,
+                 jitter=True, exceptions=(Exception,)):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.exceptions = tuple(exceptions)
+
+    def to_dict(self):
+        """Get the policy to store in the task payload"""
+        return {
+            'max_attempts': self.max_attempts,
+            'backoff_base': self.backoff_base,
+            'backoff_max': self.backoff_max,
+            'jitter': self.jitter,
+            'exceptions': [_class_name(cls) for cls in self.exceptions],
+        }
+
+    @classmethod
+    def from_dict(cls, dic):
+        dic = dict(dic)
+        exceptions = []
+        for name in dic.pop('exceptions', []):
+            try:
+                exceptions.append(_import_class(name))
+            except (ImportError, AttributeError, ValueError):
+                log.error('Can\'t import the exception %s' % name)
+        return cls(exceptions=exceptions, **dic)
+
+    def should_retry(self, attempts, error):
+        """Tell if the task which has failed attempts times with the given
+        error should be run again
+        """
+        return (attempts < self.max_attempts and
+                isinstance(error, self.exceptions))
+
+    def get_delay(self, attempts):
+        """Get the delay in seconds before running again the task which has
+        failed attempts times
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        if self.jitter:
+            delay = random.uniform(delay / 2.0, delay)
+        return delay
+
+
+def retry(**kw):
+    """Decorator to set the retry policy of a function, see RetryPolicy for
+    the parameters. The policy given to Task.create has the priority.
+    """
+    def decorator(func):
+        func.retry_policy = RetryPolicy(**kw)
+        return func
+    return decorator
@@ -1,20 +1,26 @@
+import json
 from daemon import runner
 from sqla_taskq import command
+from sqla_taskq import pool
+from sqla_taskq import stats
 
 
 class TaskDaemonRunner(runner.DaemonRunner):
 
     def _status(self):
         pid = self.pidfile.read_pid()
+        dic = stats.get_stats(self.app.models)
+        if self.app.json:
+            dic['pid'] = pid
+            runner.emit_message(json.dumps(dic, sort_keys=True))
+            return
+
         message = []
         if pid:
             message += ['Daemon started with pid %s' % pid]
         else:
             message += ['Daemon not running']
-
-        tasks = self.app.models.Task.query.filter_by(
-            status=self.app.models.TASK_STATUS_WAITING).all()
-        message += ['Number of waiting tasks: %s' % len(tasks)]
+        message += stats.format_stats(dic)
         runner.emit_message('\n'.join(message))
 
     action_funcs = {
@@ -27,7 +33,7 @@ class TaskDaemonRunner(runner.DaemonRunner):
 
 class TaskRunner():
 
-    def __init__(self, models, timeout, kill):
+    def __init__(self, models, timeout, kill, json=False, **options):
         self.stdin_path = '/dev/null'
         self.stdout_path = '/dev/tty'
         self.stderr_path = '/dev/tty'
@@ -35,9 +41,12 @@ class TaskRunner():
         self.pidfile_timeout = timeout
         self.models = models
         self.kill = kill
+        # Display the status as JSON
+        self.json = json
+        self.options = options
 
     def run(self):
-        command.run(self.models, self.kill)
+        pool.run(self.models, kill=self.kill, **self.options)
 
 
 def main():
@@ -45,9 +54,11 @@ def main():
     # Import models here since we can have set the sqlalchemy url to use in the
     # environment
     from sqla_taskq import models
+    command.configure_engine(models, dic)
+    command.configure_results(dic)
     timeout = dic['timeout']
-    kill = dic['kill']
-    app = TaskRunner(models, timeout, kill)
+    app = TaskRunner(models, timeout, json=dic['json'],
+                     **command.get_run_options(dic))
     daemon_runner = TaskDaemonRunner(app)
     daemon_runner.do_action()
 
@@ -1,10 +1,13 @@
 from sqla_taskq import command
+from sqla_taskq import pool
 
 
 def main():
     dic = command.parse_options()
     from sqla_taskq import models
-    command.run(models, kill=dic['kill'])
+    command.configure_engine(models, dic)
+    command.configure_results(dic)
+    pool.run(models, **command.get_run_options(dic))
 
 if __name__ == '__main__':
     main()
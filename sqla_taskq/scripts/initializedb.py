@@ -1,8 +1,11 @@
 from sqla_taskq import models
+from sqla_taskq import migration
 
 
 def main():
-    models.Base.metadata.create_all(models.engine)
+    # Create the tables and add the missing columns and indexes to an existing
+    # database
+    migration.upgrade(models.engine, models)
 
 
 if __name__ == '__main__':
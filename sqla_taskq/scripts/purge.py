@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+from optparse import OptionParser
+from sqla_taskq import command
+from sqla_taskq import archive
+from sqla_taskq import results
+
+
+def parse_options(argv=sys.argv):
+    parser = OptionParser()
+    parser.add_option(
+        "-u", "--url", dest="sqla_url",
+        help="SqlAlchemy url to access the DB",
+        metavar="URL")
+    parser.add_option(
+        "-c", "--config-file", dest="config_filename",
+        help="Filename containing the retention policy and the logging config",
+        metavar="FILE")
+    parser.add_option(
+        "--finished", dest="finished",
+        help="Purge the finished tasks older than this number of days",
+        type="float", metavar="days")
+    parser.add_option(
+        "--failed", dest="failed",
+        help="Purge the failed tasks older than this number of days",
+        type="float", metavar="days")
+    parser.add_option(
+        "--timedout", dest="timedout",
+        help="Purge the timed out tasks older than this number of days",
+        type="float", metavar="days")
+    parser.add_option(
+        "--delete", dest="delete",
+        action="store_true", default=False,
+        help="Delete the tasks instead of moving them to task_archive")
+    parser.add_option(
+        "--batch-size", dest="batch_size",
+        help="The number of tasks moved in one transaction",
+        type="int", default=archive.BATCH_SIZE,
+        metavar="number")
+    parser.add_option(
+        "--interval", dest="interval",
+        help="Purge again every this number of seconds",
+        type="float", metavar="time")
+
+    (options, args) = parser.parse_args(argv)
+    dic = vars(options)
+
+    retention = {}
+    if options.config_filename:
+        config = command.parse_config_file(options.config_filename) or {}
+        retention.update(config.get('retention', {}))
+        dic['sqla_url'] = dic['sqla_url'] or config.get('sqla_url')
+        dic.update(command.get_engine_options(config))
+        dic.update([(k, config[k]) for k in command.RESULT_OPTIONS
+                    if k in config])
+    for status in ('finished', 'failed', 'timedout'):
+        if dic[status] is not None:
+            retention[status] = dic[status]
+    if not retention:
+        parser.error('No retention policy given')
+    dic['retention'] = retention
+
+    if dic.get('sqla_url'):
+        os.environ['SQLA_TASKQ_SQLALCHEMY_URL'] = dic['sqla_url']
+    return dic
+
+
+def main():
+    dic = parse_options()
+    from sqla_taskq import models
+    command.configure_engine(models, dic)
+    command.configure_results(dic)
+    while True:
+        result = archive.purge(models.engine, models, dic['retention'],
+                               dic['batch_size'], dic['delete'])
+        for status, stats in sorted(result.items()):
+            print '%s: %i rows, %i bytes' % (
+                status, stats['rows'], stats['bytes'])
+        with models.engine.connect() as connection:
+            print 'expired results: %i' % results.purge(connection, models)
+        if not dic['interval']:
+            break
+        time.sleep(dic['interval'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import datetime
+from sqlalchemy import func, or_
+from sqla_taskq.compat import total_seconds
+
+
+# The windows in minutes used to compute the number of completed tasks per
+# minute
+WINDOWS = (1, 5, 15)
+# The number of unique keys and owners returned
+TOP = 10
+
+
+def _top(query, column, limit):
+    count = func.count()
+    rows = query.with_entities(column, count).filter(
+        column.isnot(None)).group_by(column).order_by(
+        count.desc(), column).limit(limit)
+    return dict(rows)
+
+
+def get_stats(models, windows=WINDOWS, top=TOP, now=None):
+    """Get the statistics of the queue with aggregate queries, the tasks are
+    never loaded. Return a dict with:
+
+    * counts: the number of tasks by status
+    * queues, unique_keys, owners: the number of waiting and in progress
+      tasks for the top queues, unique keys and owners
+    * oldest_waiting_age: the age in second of the oldest waiting task
+      which is due, the delayed tasks and the retries are not late
+    * throughput: the number of tasks completed (finished, failed or
+      timed out) per minute by window in minute
+    """
+    now = now or datetime.datetime.utcnow()
+    Task = models.Task
+    session = models.DBSession
+    statuses = [models.TASK_STATUS_WAITING,
+                models.TASK_STATUS_IN_PROGRESS,
+                models.TASK_STATUS_FINISHED,
+                models.TASK_STATUS_FAILED,
+                models.TASK_STATUS_TIMED_OUT]
+    completed = [models.TASK_STATUS_FINISHED, models.TASK_STATUS_FAILED,
+                 models.TASK_STATUS_TIMED_OUT]
+
+    counts = dict.fromkeys(statuses, 0)
+    counts.update(session.query(Task.status, func.count()).group_by(
+        Task.status))
+
+    pending = session.query(Task).filter(Task.status.in_(
+        [models.TASK_STATUS_WAITING, models.TASK_STATUS_IN_PROGRESS]))
+
+    oldest_waiting_age = None
+    oldest = session.query(Task.creation_date).filter(
+        Task.status == models.TASK_STATUS_WAITING,
+        or_(Task.not_before.is_(None), Task.not_before <= now)).order_by(
+        Task.idtask).limit(1).scalar()
+    if oldest is not None:
+        oldest_waiting_age = max(total_seconds(now - oldest), 0)
+
+    throughput = {}
+    for minutes in windows:
+        since = now - datetime.timedelta(minutes=minutes)
+        count = session.query(func.count(Task.idtask)).filter(
+            Task.status.in_(completed), Task.end_date >= since).scalar()
+        throughput[minutes] = float(count) / minutes
+
+    return {
+        'counts': counts,
+        'queues': _top(pending, Task.queue, top),
+        'unique_keys': _top(pending, Task.unique_key, top),
+        'owners': _top(pending, Task.owner, top),
+        'oldest_waiting_age': oldest_waiting_age,
+        'throughput': throughput,
+    }
+
+
+def format_stats(stats):
+    """Get the lines to display the statistics"""
+    counts = stats['counts']
+    lines = []
+    for status in sorted(counts):
+        lines += ['Number of %s tasks: %s' % (status, counts[status])]
+    if stats['oldest_waiting_age'] is not None:
+        lines += ['Oldest waiting task: %is' % stats['oldest_waiting_age']]
+    lines += ['Completed tasks per minute: %s' % ', '.join([
+        '%.1f (%im)' % (value, minutes)
+        for minutes, value in sorted(stats['throughput'].items())])]
+    for name in ('queues', 'unique_keys', 'owners'):
+        if stats.get(name):
+            lines += ['Pending tasks by %s: %s' % (
+                name[:-1].replace('_', ' '), ', '.join([
+                    '%s=%s' % item
+                    for item in sorted(stats[name].items(),
+                                       key=lambda item: -item[1])]))]
+    return lines
@@ -0,0 +1,135 @@
+import sys
+import signal
+import pickle
+import threading
+import traceback
+import multiprocessing
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# The function is interrupted by SIGALRM, only possible in the main thread.
+# The code which doesn't return to the python interpreter (ex: a blocking C
+# call) can't be interrupted.
+SIGNAL = 'signal'
+# The function is run in a child process killed when the timeout is reached.
+# The parameters are inherited by fork but the result should be picklable.
+# The locks held by the other threads at the fork (ex: the logging lock) are
+# never released in the child.
+PROCESS = 'process'
+
+MODES = [SIGNAL, PROCESS]
+
+
+class TaskTimeout(BaseException):
+    """Raised when a task has run longer than its timeout. It's not an
+    Exception to not be caught by the task itself.
+    """
+
+
+class TaskProcessError(Exception):
+    """The task run in a child process has failed with an exception which
+    can't be pickled or the process has died, the message is the traceback
+    of the child process or its exit code.
+    """
+
+
+def can_use_signal():
+    return (hasattr(signal, 'setitimer') and
+            isinstance(threading.current_thread(), threading._MainThread))
+
+
+def call_with_alarm(func, timeout):
+    def handler(signal_number, stack_frame):
+        raise TaskTimeout('The task has run more than %ss' % timeout)
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _load_error(error, tb):
+    """Get the exception raised in the child process with its traceback in
+    process_traceback, a TaskProcessError if it can't be loaded.
+    """
+    if error is not None:
+        try:
+            error = pickle.loads(error)
+        except Exception:
+            error = None
+    if not isinstance(error, BaseException):
+        error = TaskProcessError(tb)
+    error.process_traceback = tb
+    return error
+
+
+def call_in_process(func, timeout, initializer=None):
+    """Run func() in a child process, initializer() is called first in the
+    child (ex: to not use the DB connections of the parent).
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        reader.close()
+        try:
+            if initializer is not None:
+                initializer()
+            result = (True, func(), None)
+        except BaseException:
+            tb = traceback.format_exc()
+            # The exception is raised in the parent if it can be pickled
+            error = sys.exc_info()[1]
+            try:
+                error = pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                error = None
+            result = (False, tb, error)
+        writer.send(result)
+
+    process = multiprocessing.Process(target=target)
+    process.daemon = True
+    process.start()
+    writer.close()
+    try:
+        if not reader.poll(timeout):
+            raise TaskTimeout('The task has run more than %ss, its process '
+                              'has been killed' % timeout)
+        try:
+            success, value, error = reader.recv()
+        except EOFError:
+            process.join()
+            raise TaskProcessError('The task process has exited with the '
+                                   'code %s' % process.exitcode)
+    except BaseException:
+        # The timeout or the worker is stopped (ex: SystemExit of the kill
+        # mode), don't wait for the task
+        process.terminate()
+        raise
+    finally:
+        reader.close()
+        process.join()
+    if not success:
+        raise _load_error(error, value)
+    return value
+
+
+def call(func, timeout=None, mode=SIGNAL, initializer=None):
+    """Call func() and interrupt it if it runs more than timeout seconds,
+    TaskTimeout is raised. The signal mode can only be used in the main
+    thread. initializer is called in the child process of the process mode.
+    """
+    if not timeout:
+        return func()
+    if mode not in MODES:
+        raise ValueError('Unknown timeout mode %s' % mode)
+    if mode == PROCESS:
+        return call_in_process(func, timeout, initializer)
+    if not can_use_signal():
+        raise ValueError('The signal timeout mode can only be used in the '
+                         'main thread, use the process mode')
+    return call_with_alarm(func, timeout)
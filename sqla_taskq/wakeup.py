@@ -0,0 +1,179 @@
+import os
+import errno
+import select
+import socket
+import tempfile
+import time
+import logging
+import transaction
+
+
+log = logging.getLogger(__name__)
+
+# The PostgreSQL channel used to notify the new tasks
+CHANNEL = 'sqla_taskq'
+
+
+def get_directory():
+    """The directory containing the sockets of the local workers
+    """
+    if os.environ.get('SQLA_TASKQ_WAKEUP_DIR'):
+        return os.environ['SQLA_TASKQ_WAKEUP_DIR']
+    return os.path.join(tempfile.gettempdir(), 'sqla_taskq')
+
+
+def _select(fileobj, timeout):
+    try:
+        readable, _, _ = select.select([fileobj], [], [], timeout)
+    except select.error:
+        # Interrupted by a signal
+        return False
+    return bool(readable)
+
+
+def wake_local_workers(directory=None):
+    """Wake up the workers waiting on this host. Return the number of woken
+    workers.
+    """
+    directory = directory or get_directory()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        # No worker has been started
+        return 0
+
+    count = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for name in names:
+            if not name.endswith('.sock'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                sock.sendto('1', path)
+                count += 1
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # The worker is dead, remove its socket
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                # EAGAIN: the worker has already some pending wakeups
+    finally:
+        sock.close()
+    return count
+
+
+def _after_commit(success, directory=None):
+    if success:
+        wake_local_workers(directory)
+
+
+def notify(session):
+    """Notify the workers a task has been created in the current transaction.
+    The workers are woken up when the transaction is committed.
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        # NOTIFY is transactional, it's sent on commit
+        session.execute('NOTIFY %s' % CHANNEL)
+        return
+    transaction.get().addAfterCommitHook(_after_commit)
+
+
+class SleepWaiter(object):
+    """Just sleep, used when no wakeup mechanism is available
+    """
+
+    def fileno(self):
+        return None
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class SocketWaiter(object):
+    """Wait on a unix socket, the processes creating tasks on this host send
+    a datagram to it.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or get_directory()
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        self.path = os.path.join(self.directory, '%i.sock' % os.getpid())
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def wait(self, timeout):
+        if not _select(self.socket, timeout):
+            return False
+        # Drain all the pending wakeups
+        try:
+            while True:
+                self.socket.recv(64)
+        except socket.error:
+            pass
+        return True
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class PostgresWaiter(object):
+    """LISTEN on the PostgreSQL channel, Task.create sends a NOTIFY.
+    """
+
+    def __init__(self, engine):
+        self.connection = engine.raw_connection()
+        self.dbapi_connection = self.connection.connection
+        # psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        self.dbapi_connection.set_isolation_level(0)
+        cursor = self.dbapi_connection.cursor()
+        cursor.execute('LISTEN %s' % CHANNEL)
+        cursor.close()
+
+    def fileno(self):
+        return self.dbapi_connection.fileno()
+
+    def wait(self, timeout):
+        conn = self.dbapi_connection
+        conn.poll()
+        if not conn.notifies and _select(conn, timeout):
+            conn.poll()
+        notified = bool(conn.notifies)
+        del conn.notifies[:]
+        return notified
+
+    def close(self):
+        # The connection is in autocommit, don't put it back in the pool
+        self.connection.invalidate()
+
+
+def get_waiter(engine):
+    """Get the way to wait for new tasks according to the engine
+    """
+    dialect = engine.dialect
+    if dialect.name == 'postgresql' and dialect.driver == 'psycopg2':
+        return PostgresWaiter(engine)
+    if hasattr(socket, 'AF_UNIX'):
+        return SocketWaiter()
+    return SleepWaiter()
@@ -0,0 +1,187 @@
+import unittest
+from mock import patch, Mock
+import os
+import shutil
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqla_taskq import aio
+from sqla_taskq import command
+from sqla_taskq import wakeup
+from sqla_taskq.aio import asyncio
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+@asyncio.coroutine
+def coro4test(value, delay=0):
+    yield asyncio.From(asyncio.sleep(delay))
+    raise asyncio.Return('coro4test %s' % value)
+
+
+@asyncio.coroutine
+def coro4testfailed():
+    yield asyncio.From(asyncio.sleep(0))
+    raise Exception('Failing coroutine')
+
+
+@asyncio.coroutine
+def coro4testcancelled():
+    yield asyncio.From(asyncio.sleep(0))
+    raise asyncio.CancelledError()
+
+
+def func4test(*args, **kw):
+    return 'func4test'
+
+
+class FakeWaiter(object):
+
+    def fileno(self):
+        return None
+
+    def wait(self, timeout):
+        return False
+
+
+class TestAio(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def test_iscoroutinefunction(self):
+        self.assertEqual(aio.iscoroutinefunction(coro4test), True)
+        self.assertEqual(aio.iscoroutinefunction(func4test), False)
+        self.assertEqual(aio.iscoroutine(coro4test(1)), True)
+        self.assertEqual(aio.iscoroutine(func4test()), False)
+
+    def test_perform(self):
+        # A coroutine task performed by a synchronous worker
+        task = Task.create(coro4test, [1])
+        DBSession.add(task)
+        res = task.perform()
+        self.assertEqual(res, 'coro4test 1')
+        self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+        task = Task.create(coro4testfailed)
+        DBSession.add(task)
+        res = task.perform()
+        self.assertTrue('Failing coroutine' in res)
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+
+    def test_worker(self):
+        for i in range(3):
+            Task.create(coro4test, [i], {'delay': 0.3})
+        Task.create(coro4testfailed)
+        Task.create(func4test)
+        Task.create('unexisting.func')
+
+        worker = aio.AsyncioWorker(models, 5)
+        waiter = FakeWaiter()
+        start = time.time()
+        self.assertEqual(worker.run_once(), True)
+        self.assertEqual(len(worker.running), 5)
+        self.assertEqual(command.claimed, set([1, 2, 3, 4, 5]))
+        # No free slot
+        self.assertEqual(worker.run_once(), False)
+        while worker.running:
+            worker.wait(waiter, 0.1)
+            worker.run_once()
+        # The leases of the saved tasks are not renewed anymore
+        self.assertEqual(command.claimed, set())
+        # The coroutines have been run concurrently
+        self.assertTrue(time.time() - start < 0.8)
+        self.assertEqual(worker.run_once(), False)
+        worker.close()
+
+        tasks = Task.query.order_by(Task.idtask).all()
+        for i in range(3):
+            self.assertEqual(tasks[i].status, models.TASK_STATUS_FINISHED)
+            self.assertEqual(tasks[i].result, 'coro4test %i' % i)
+            self.assertTrue(tasks[i].start_date)
+            self.assertTrue(tasks[i].end_date)
+        self.assertEqual(tasks[3].status, models.TASK_STATUS_FAILED)
+        self.assertTrue('Failing coroutine' in tasks[3].result)
+        self.assertEqual(tasks[4].status, models.TASK_STATUS_FINISHED)
+        self.assertEqual(tasks[4].result, 'func4test')
+        self.assertEqual(tasks[5].status, models.TASK_STATUS_FAILED)
+
+    def test_worker_timeout(self):
+        Task.create(coro4test, [1], {'delay': 5}, timeout=0.1)
+        Task.create(coro4test, [2], {'delay': 0.2})
+        # Cancelled by itself, with and without timeout
+        Task.create(coro4testcancelled)
+        Task.create(coro4testcancelled, timeout=5)
+
+        worker = aio.AsyncioWorker(models, 5)
+        waiter = FakeWaiter()
+        start = time.time()
+        self.assertEqual(worker.run_once(), True)
+        while worker.running:
+            worker.wait(waiter, 0.1)
+            worker.run_once()
+        self.assertTrue(time.time() - start < 1)
+        worker.close()
+
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertEqual(tasks[0].status, models.TASK_STATUS_TIMED_OUT)
+        self.assertTrue('The task has run more than 0.1s' in tasks[0].result)
+        self.assertTrue(tasks[0].end_date)
+        self.assertEqual(tasks[1].status, models.TASK_STATUS_FINISHED)
+        for task in tasks[2:]:
+            self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+            self.assertTrue('The task has been cancelled' in task.result)
+
+    def test_wait(self):
+        worker = aio.AsyncioWorker(models, 5)
+        self.assertEqual(worker.wait(FakeWaiter(), 0.01), False)
+
+        directory = tempfile.mkdtemp()
+        waiter = wakeup.SocketWaiter(directory)
+        self.assertEqual(worker.wait(waiter, 0.01), False)
+        wakeup.wake_local_workers(directory)
+        start = time.time()
+        self.assertEqual(worker.wait(waiter, 10), True)
+        self.assertTrue(time.time() - start < 1)
+        # The wakeup has been read
+        self.assertEqual(waiter.wait(0), False)
+        waiter.close()
+        shutil.rmtree(directory)
+        worker.close()
+
+    def test_run(self):
+        for i in range(3):
+            Task.create(coro4test, [i])
+
+        def f(*args, **kw):
+            command.loop = False
+            return False
+
+        waiter = Mock()
+        waiter.wait.return_value = False
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.aio.AsyncioWorker.wait', side_effect=f):
+                command.run(models, coroutines=10)
+        command.loop = True
+        for task in Task.query.all():
+            self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+        with patch('sqla_taskq.aio.asyncio', None):
+            self.assertRaises(ImportError, command.run, models, coroutines=2)
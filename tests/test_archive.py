@@ -0,0 +1,114 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+from sqlalchemy import create_engine, select
+from sqla_taskq import archive
+from sqla_taskq import results
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+def func4test(*args, **kw):
+    return 'func4test'
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(results.settings)
+        self.directory = tempfile.mkdtemp()
+        results.settings['path'] = self.directory
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        results.settings.update(self.settings)
+        shutil.rmtree(self.directory)
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def _create_tasks(self):
+        now = datetime.datetime.utcnow()
+        old = now - datetime.timedelta(days=10)
+        Task.create_many([(func4test,)] * 8)
+        with transaction.manager:
+            for task in Task.query.all():
+                if task.idtask <= 3:
+                    task.status = models.TASK_STATUS_FINISHED
+                    task.result = 'finished'
+                    task.end_date = old
+                elif task.idtask == 4:
+                    task.status = models.TASK_STATUS_FINISHED
+                    task.end_date = now
+                elif task.idtask <= 6:
+                    task.status = models.TASK_STATUS_FAILED
+                    task.end_date = old
+                if task.idtask == 6:
+                    task.result_ref = 'file:6'
+            # A large result
+            DBSession.add(models.TaskResult(idtask=5, data='failed',
+                                            size=6))
+
+    def _idtasks(self, table):
+        query = select([table.c.idtask]).order_by(table.c.idtask)
+        return [row[0] for row in models.engine.execute(query)]
+
+    def test_purge_status(self):
+        self._create_tasks()
+        results.save_file(6, 'failed', False)
+        connection = models.engine.connect()
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        stats = archive.purge_status(connection, models,
+                                     models.TASK_STATUS_FINISHED, before,
+                                     batch_size=2)
+        self.assertEqual(stats['rows'], 3)
+        self.assertTrue(stats['bytes'] > 0)
+        self.assertEqual(self._idtasks(Task.__table__), [4, 5, 6, 7, 8])
+        self.assertEqual(self._idtasks(models.task_archive), [1, 2, 3])
+        row = models.engine.execute(
+            models.task_archive.select().where(
+                models.task_archive.c.idtask == 1)).fetchone()
+        self.assertEqual(row['result'], 'finished')
+        self.assertEqual(row['status'], models.TASK_STATUS_FINISHED)
+
+        stats = archive.purge_status(connection, models,
+                                     models.TASK_STATUS_FAILED, before,
+                                     delete=True)
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(self._idtasks(Task.__table__), [4, 7, 8])
+        self.assertEqual(self._idtasks(models.task_archive), [1, 2, 3])
+        self.assertEqual(self._idtasks(models.TaskResult.__table__), [])
+        # The file of the large result is deleted too
+        self.assertEqual(os.listdir(self.directory), [])
+
+        stats = archive.purge_status(connection, models,
+                                     models.TASK_STATUS_FAILED, before)
+        self.assertEqual(stats, {'rows': 0, 'bytes': 0})
+        connection.close()
+
+    def test_purge(self):
+        self._create_tasks()
+        res = archive.purge(models.engine, models, {
+            models.TASK_STATUS_FINISHED: 1,
+            models.TASK_STATUS_FAILED: 30,
+        })
+        self.assertEqual(res[models.TASK_STATUS_FINISHED]['rows'], 3)
+        self.assertEqual(res[models.TASK_STATUS_FAILED]['rows'], 0)
+        self.assertEqual(self._idtasks(Task.__table__), [4, 5, 6, 7, 8])
+
+        self.assertRaises(ValueError, archive.purge, models.engine, models,
+                          {models.TASK_STATUS_WAITING: 1})
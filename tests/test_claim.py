@@ -0,0 +1,383 @@
+import unittest
+import datetime
+from mock import patch, Mock
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqla_taskq import claim
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+def func4test(*args, **kw):
+    return 'test'
+
+
+def _connection(name, version=None, sqlite_version=None):
+    connection = Mock()
+    connection.dialect.name = name
+    connection.dialect.server_version_info = version
+    connection.dialect._is_mariadb = False
+    connection.dialect.dbapi.sqlite_version_info = sqlite_version
+    return connection
+
+
+class TestGetClaimer(unittest.TestCase):
+
+    def test_get_claimer(self):
+        res = claim.get_claimer(_connection('postgresql', (9, 6)))
+        self.assertTrue(isinstance(res, claim.SkipLockedClaimer))
+
+        res = claim.get_claimer(_connection('postgresql', (9, 4)))
+        self.assertTrue(isinstance(res, claim.GenericClaimer))
+        self.assertEqual(res.begin_statement, None)
+
+        res = claim.get_claimer(_connection('mysql', (8, 0, 20)))
+        self.assertTrue(isinstance(res, claim.MySQLSkipLockedClaimer))
+
+        res = claim.get_claimer(_connection('mysql', (5, 7, 1)))
+        self.assertTrue(isinstance(res, claim.GenericClaimer))
+
+        connection = _connection('mysql', (10, 6, 4))
+        connection.dialect._is_mariadb = True
+        res = claim.get_claimer(connection)
+        self.assertTrue(isinstance(res, claim.MySQLSkipLockedClaimer))
+
+        connection = _connection('mysql', (10, 5, 4))
+        connection.dialect._is_mariadb = True
+        res = claim.get_claimer(connection)
+        self.assertTrue(isinstance(res, claim.GenericClaimer))
+
+        res = claim.get_claimer(
+            _connection('sqlite', sqlite_version=(3, 35, 0)))
+        self.assertTrue(isinstance(res, claim.SQLiteClaimer))
+        self.assertEqual(res.begin_statement, 'BEGIN IMMEDIATE')
+
+        res = claim.get_claimer(
+            _connection('sqlite', sqlite_version=(3, 34, 1)))
+        self.assertTrue(isinstance(res, claim.GenericClaimer))
+        self.assertEqual(res.begin_statement, 'BEGIN IMMEDIATE')
+
+        res = claim.get_claimer(_connection('mssql', (14,)))
+        self.assertTrue(isinstance(res, claim.GenericClaimer))
+
+
+class TestClaimer(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def _test_claim(self, claimer):
+        connection = models.engine.connect()
+        self.assertEqual(claimer.claim(connection, models), [])
+
+        Task.create(func4test)
+        idtasks = claimer.claim(connection, models)
+        self.assertEqual(idtasks, [1])
+        task = models.Task.query.get(1)
+        self.assertEqual(task.status, models.TASK_STATUS_IN_PROGRESS)
+        self.assertEqual(task.pid, os.getpid())
+        self.assertEqual(task.worker, claim.worker_id())
+        self.assertTrue(task.lock_date)
+        self.assertEqual(task.lease_expires,
+                         task.lock_date + datetime.timedelta(seconds=60))
+        self.assertEqual(claimer.claim(connection, models), [])
+
+        Task.create(func4test, unique_key='mykey')
+        Task.create(func4test, unique_key='mykey')
+        Task.create(func4test)
+        res = (claimer.claim(connection, models) +
+               claimer.claim(connection, models))
+        # 3 has the same key as 2 which is in progress
+        self.assertEqual(sorted(res), [2, 4])
+        self.assertEqual(claimer.claim(connection, models), [])
+        lock = models.TaskKeyLock.query.get('mykey')
+        self.assertEqual(lock.idtask, 2)
+
+        with transaction.manager:
+            task = models.Task.query.get(2)
+            task.start_date = task.lock_date
+            task.set_finished('test')
+        self.assertEqual(claimer.claim(connection, models), [3])
+        lock = models.TaskKeyLock.query.get('mykey')
+        self.assertEqual(lock.idtask, 3)
+        transaction.abort()
+
+        # The key is locked even if the task in progress has been purged
+        with transaction.manager:
+            models.DBSession.add(models.TaskKeyLock(
+                unique_key='lockedkey', idtask=100,
+                lock_date=datetime.datetime.utcnow()))
+        Task.create(func4test, unique_key='lockedkey')
+        self.assertEqual(claimer.claim(connection, models), [])
+        with transaction.manager:
+            models.TaskKeyLock.query.filter_by(idtask=100).delete()
+
+        # Claim many tasks at once, only one by unique key
+        for i in range(3):
+            Task.create(func4test)
+        Task.create(func4test, unique_key='otherkey')
+        Task.create(func4test, unique_key='otherkey')
+        idtasks = claimer.claim(connection, models, 10)
+        self.assertEqual(sorted(idtasks), [5, 6, 7, 8, 9])
+        connection.close()
+
+    def _test_priority(self, claimer):
+        connection = models.engine.connect()
+        Task.create(func4test)
+        Task.create(func4test, priority=10)
+        Task.create(func4test, priority=-1)
+        Task.create(func4test, priority=-1)
+        self.assertEqual(claimer.claim(connection, models), [3])
+        self.assertEqual(claimer.claim(connection, models), [4])
+        self.assertEqual(claimer.claim(connection, models), [1])
+        self.assertEqual(claimer.claim(connection, models), [2])
+        connection.close()
+
+    def test_priority(self):
+        self._test_priority(claim.GenericClaimer())
+        transaction.abort()
+        os.remove(DB_NAME)
+        Base.metadata.create_all(models.engine)
+        self._test_priority(claim.SQLiteClaimer())
+
+    def _test_delayed(self, claimer):
+        connection = models.engine.connect()
+        now = datetime.datetime.utcnow()
+        Task.create(func4test, run_after=now + datetime.timedelta(hours=1))
+        Task.create(func4test, run_after=now - datetime.timedelta(seconds=1))
+        Task.create(func4test, run_after=3600, unique_key='key')
+        Task.create(func4test, unique_key='key')
+        # 4 waits for 3 which has the same key
+        self.assertEqual(claimer.claim(connection, models, 10), [2])
+        due = claim.next_due(connection, models)
+        self.assertEqual(due, now + datetime.timedelta(hours=1))
+        # The delayed tasks of the other queues are ignored
+        Task.create(func4test, run_after=60, queue='emails')
+        self.assertEqual(claim.next_due(connection, models, ['other']), None)
+        due = claim.next_due(connection, models, ['emails', 'other'])
+        self.assertTrue(due < now + datetime.timedelta(minutes=2))
+        connection.close()
+
+    def test_delayed(self):
+        self._test_delayed(claim.GenericClaimer())
+        transaction.abort()
+        os.remove(DB_NAME)
+        Base.metadata.create_all(models.engine)
+        self._test_delayed(claim.SQLiteClaimer())
+
+    def _test_queues(self, claimer):
+        connection = models.engine.connect()
+        Task.create(func4test)
+        Task.create(func4test, queue='emails')
+        Task.create(func4test, queue='reports')
+        Task.create(func4test, queue='emails')
+        self.assertEqual(
+            claimer.claim(connection, models, 10, queues=['unexisting']), [])
+        self.assertEqual(
+            claimer.claim(connection, models, 10, queues=['emails']), [2, 4])
+        self.assertEqual(claim.count_claimed(connection, models),
+                         {'emails': 2})
+        self.assertEqual(
+            claimer.claim(connection, models, 10,
+                          queues=['default', 'reports']), [1, 3])
+        self.assertEqual(claim.count_claimed(connection, models),
+                         {'emails': 2, 'default': 1, 'reports': 1})
+        connection.close()
+
+    def test_queues(self):
+        self._test_queues(claim.GenericClaimer())
+        transaction.abort()
+        os.remove(DB_NAME)
+        Base.metadata.create_all(models.engine)
+        self._test_queues(claim.SQLiteClaimer())
+
+    def _test_blocked(self, claimer):
+        connection = models.engine.connect()
+        Task.create(func4test, owner='bob')
+        Task.create(func4test, owner='tom')
+        Task.create(func4test)
+        Task.create(func4test, queue='emails')
+        blocked = {'owner': ['bob', 'other'], 'queue': ['emails']}
+        self.assertEqual(
+            claimer.claim(connection, models, 10, blocked=blocked), [2, 3])
+        self.assertEqual(
+            claimer.claim(connection, models, 10, queues=['default'],
+                          blocked={'owner': []}), [1])
+        connection.close()
+
+    def test_blocked(self):
+        self._test_blocked(claim.GenericClaimer())
+        transaction.abort()
+        os.remove(DB_NAME)
+        Base.metadata.create_all(models.engine)
+        self._test_blocked(claim.SQLiteClaimer())
+
+    def test_age(self):
+        connection = models.engine.connect()
+        Task.create(func4test, priority=10)
+        Task.create(func4test, priority=10)
+        Task.create(func4test, priority=-5)
+        with transaction.manager:
+            task = Task.query.get(1)
+            task.creation_date -= datetime.timedelta(hours=2)
+            task = Task.query.get(3)
+            task.creation_date -= datetime.timedelta(hours=2)
+        self.assertEqual(claim.age(connection, models, 3600, -1), 1)
+        self.assertEqual(
+            [t.priority for t in Task.query.order_by(Task.idtask)],
+            [-1, 10, -5])
+        self.assertEqual(claim.age(connection, models, 3600, -1), 0)
+        connection.close()
+
+    def test_worker_id(self):
+        worker = claim.worker_id()
+        host, pid, start = worker.split(':')
+        self.assertEqual(int(pid), os.getpid())
+        self.assertEqual(claim.worker_id(), worker)
+
+    def test_renew(self):
+        connection = models.engine.connect()
+        Task.create(func4test)
+        Task.create(func4test)
+        claim.ReturningClaimer().claim(connection, models, 2, lease=10)
+        with transaction.manager:
+            task = Task.query.get(2)
+            task.worker = 'otherhost:1:20200101T000000'
+        now = datetime.datetime.utcnow()
+        self.assertEqual(claim.renew(connection, models, [], 100), 0)
+        self.assertEqual(claim.renew(connection, models, [1, 2], 100), 1)
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertTrue(tasks[0].lease_expires >=
+                        now + datetime.timedelta(seconds=100))
+        self.assertTrue(tasks[1].lease_expires <
+                        now + datetime.timedelta(seconds=11))
+        connection.close()
+
+    def test_reap(self):
+        connection = models.engine.connect()
+        self.assertEqual(claim.reap(connection, models), 0)
+        for i in range(3):
+            Task.create(func4test, unique_key='key%i' % i)
+        Task.create(func4test)
+        claim.ReturningClaimer().claim(connection, models, 4)
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        with transaction.manager:
+            tasks = Task.query.order_by(Task.idtask).all()
+            tasks[0].lease_expires = expired
+            tasks[1].lease_expires = expired
+            tasks[1].attempts = 2
+            tasks[3].lease_expires = expired
+        self.assertEqual(claim.reap(connection, models, batch_size=2), 2)
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertEqual(tasks[0].status, models.TASK_STATUS_WAITING)
+        self.assertEqual(tasks[0].pid, None)
+        self.assertEqual(tasks[0].worker, None)
+        self.assertEqual(tasks[0].lease_expires, None)
+        self.assertEqual(tasks[0].attempts, 1)
+        # Run 3 times
+        self.assertEqual(tasks[1].status, models.TASK_STATUS_FAILED)
+        self.assertEqual(tasks[1].attempts, 3)
+        self.assertTrue(tasks[1].end_date)
+        self.assertEqual(tasks[1].result,
+                         'The lease of the worker has expired')
+        self.assertEqual(tasks[2].status, models.TASK_STATUS_IN_PROGRESS)
+        self.assertEqual(tasks[3].status, models.TASK_STATUS_IN_PROGRESS)
+        locks = models.TaskKeyLock.query.all()
+        self.assertEqual([lock.idtask for lock in locks], [3])
+        transaction.abort()
+
+        self.assertEqual(claim.reap(connection, models), 1)
+        self.assertEqual(claim.reap(connection, models), 0)
+        # The reaped task can be claimed again
+        self.assertEqual(
+            claim.ReturningClaimer().claim(connection, models, 10), [1, 4])
+        connection.close()
+
+    def test_release(self):
+        connection = models.engine.connect()
+        self.assertEqual(claim.release(connection, models, []), 0)
+        for i in range(3):
+            Task.create(func4test, unique_key='key%i' % i)
+        idtasks = claim.ReturningClaimer().claim(connection, models, 3)
+        self.assertEqual(idtasks, [1, 2, 3])
+        res = claim.release(connection, models, [2, 3])
+        self.assertEqual(res, 2)
+        task = models.Task.query.get(2)
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertEqual(task.pid, None)
+        self.assertEqual(task.worker, None)
+        self.assertEqual(task.lock_date, None)
+        self.assertEqual(task.lease_expires, None)
+        task = models.Task.query.get(1)
+        self.assertEqual(task.status, models.TASK_STATUS_IN_PROGRESS)
+        locks = models.TaskKeyLock.query.all()
+        self.assertEqual([lock.idtask for lock in locks], [1])
+        connection.close()
+
+    def test_generic_claimer(self):
+        self._test_claim(claim.GenericClaimer())
+
+    def test_generic_claimer_sqlite(self):
+        self._test_claim(claim.GenericClaimer(claim.SQLITE_BEGIN))
+
+    def test_generic_claimer_error(self):
+        for i in range(3):
+            Task.create(func4test)
+        connection = models.engine.connect()
+        lock_keys = claim._lock_keys
+        calls = []
+
+        def f(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise OperationalError(None, None, 'database is locked')
+            return lock_keys(*args)
+        with patch('sqla_taskq.claim._lock_keys', side_effect=f):
+            # The task claimed before the error is returned
+            self.assertEqual(
+                claim.GenericClaimer().claim(connection, models, 3), [1])
+            self.assertRaises(OperationalError, claim.GenericClaimer().claim,
+                              connection, models, 3)
+        self.assertEqual(
+            claim.GenericClaimer().claim(connection, models, 3), [2, 3])
+        connection.close()
+
+    def test_returning_claimer(self):
+        self._test_claim(claim.ReturningClaimer())
+
+    def test_sqlite_claimer(self):
+        self._test_claim(claim.SQLiteClaimer())
+
+    def test_sqlite_claimer_locked(self):
+        Task.create(func4test)
+        engine = create_engine(DB_URL, connect_args={'timeout': 0})
+        connection = engine.connect()
+        other = engine.connect()
+        trans = other.begin()
+        other.execute(claim.SQLITE_BEGIN)
+        # The write lock is taken by the other connection
+        self.assertRaises(OperationalError, claim.SQLiteClaimer().claim,
+                          connection, models)
+        trans.rollback()
+        self.assertEqual(claim.SQLiteClaimer().claim(connection, models),
+                         [1])
+        connection.close()
+        other.close()
@@ -0,0 +1,71 @@
+import unittest
+import pickle
+from sqla_taskq import codec
+
+
+class Class4Test(object):
+    pass
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(codec.settings)
+
+    def tearDown(self):
+        codec.settings.update(self.settings)
+
+    def test_configure(self):
+        codec.configure(codec='json', compress_threshold=None)
+        self.assertEqual(codec.settings['codec'], 'json')
+        self.assertEqual(codec.settings['compress_threshold'], None)
+        try:
+            codec.configure(codec='unexisting')
+            assert(False)
+        except ValueError, e:
+            self.assertTrue('Unknown codec unexisting' in str(e))
+        try:
+            codec.configure(unexisting=1)
+            assert(False)
+        except TypeError, e:
+            self.assertEqual(str(e), 'Unknown setting unexisting')
+
+    def test_encode(self):
+        data = {'_instance': None, '_args': [1, 'a'], '_kw': {'b': 2}}
+        res = codec.encode(data)
+        self.assertEqual(res[:3], codec.MAGIC + b'p' + codec.NOT_COMPRESSED)
+        self.assertEqual(codec.decode(res), data)
+
+        codec.configure(codec='json')
+        res = codec.encode(data)
+        self.assertEqual(res[:3], codec.MAGIC + b'j' + codec.NOT_COMPRESSED)
+        self.assertEqual(codec.decode(res), data)
+
+        # The bound methods are pickled
+        data['_instance'] = Class4Test()
+        res = codec.encode(data)
+        self.assertEqual(res[:2], codec.MAGIC + b'p')
+        self.assertTrue(isinstance(codec.decode(res)['_instance'],
+                                   Class4Test))
+
+        codec.configure(fallback=None)
+        self.assertRaises(TypeError, codec.encode, data)
+
+    def test_encode_compressed(self):
+        codec.configure(codec='json', compress_threshold=100)
+        data = {'_args': ['a' * 1000]}
+        res = codec.encode(data)
+        self.assertEqual(res[:3], codec.MAGIC + b'j' + codec.COMPRESSED)
+        self.assertTrue(len(res) < 100)
+        self.assertEqual(codec.decode(res), data)
+
+    def test_decode(self):
+        # Stored by PickleType
+        data = {'_func_name': 'hello.world', '_args': [1]}
+        self.assertEqual(codec.decode(pickle.dumps(data, 2)), data)
+        self.assertEqual(codec.decode(pickle.dumps(data)), data)
+        try:
+            codec.decode(codec.MAGIC + b'x-')
+            assert(False)
+        except ValueError, e:
+            self.assertEqual(str(e), "The payload codec 'x' is not available")
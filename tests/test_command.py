@@ -1,10 +1,14 @@
 import unittest
+import datetime
+import time
 from mock import patch, Mock
 import os
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
 import ConfigParser
 from sqla_taskq import command
+from sqla_taskq import claim
+from sqla_taskq import ratelimit
 from sqla_taskq.models import (
     DBSession,
     Base,
@@ -13,6 +17,7 @@ from sqla_taskq.models import (
 import sqla_taskq.models as models
 import transaction
 import multiprocessing
+from concurrent import futures
 
 
 DB_NAME = 'test_sqla_taskq.db'
@@ -31,6 +36,11 @@ def func4test(*args, **kw):
     return 'test'
 
 
+def func4testslow(*args, **kw):
+    time.sleep(5)
+    return 'test'
+
+
 class TestSignal(unittest.TestCase):
 
     def test_sigterm_handler(self):
@@ -61,6 +71,8 @@ class TestCommand(unittest.TestCase):
 
     def tearDown(self):
         transaction.abort()
+        del command.prefetched[:]
+        command.claimed.clear()
         if os.path.exists(DB_NAME):
             os.remove(DB_NAME)
 
@@ -86,6 +98,89 @@ class TestCommand(unittest.TestCase):
         idtask = command._lock_task(connection, models)
         self.assertEqual(idtask, None)
 
+    def test__lock_tasks_queues(self):
+        for queue in ['reports', 'emails', 'reports', 'emails', 'reports',
+                      'other']:
+            Task.create(func4test, queue=queue)
+        connection = models.engine.connect()
+        command.subscriptions = [('emails', None), ('reports', 2)]
+        try:
+            # The first queue is served first
+            self.assertEqual(command._lock_tasks(connection, models, 3),
+                             [2, 4, 1])
+            # Only 2 reports in progress
+            self.assertEqual(command._lock_tasks(connection, models, 3), [3])
+            self.assertEqual(command._lock_tasks(connection, models, 3), [])
+            with transaction.manager:
+                task = Task.query.get(1)
+                task.start_date = task.lock_date
+                task.set_finished('test')
+            self.assertEqual(command._lock_tasks(connection, models, 3), [5])
+        finally:
+            command.subscriptions = []
+        connection.close()
+
+    def test__lock_tasks_queues_error(self):
+        for queue in ['a', 'b']:
+            Task.create(func4test, queue=queue)
+        connection = models.engine.connect()
+        command.subscriptions = [('a', None), ('b', None)]
+        claimer = claim.get_claimer(connection)
+        claimed = []
+
+        def f(*args, **kw):
+            if claimed:
+                raise OperationalError(None, None, 'database is locked')
+            claimed.extend(claimer.claim(*args, **kw))
+            return claimed[:]
+        try:
+            with patch('sqla_taskq.claim.get_claimer',
+                       return_value=Mock(claim=Mock(side_effect=f))):
+                # The task of the first queue is kept
+                self.assertEqual(command._lock_tasks(connection, models, 2),
+                                 [1])
+                self.assertRaises(OperationalError, command._lock_tasks,
+                                  connection, models, 2)
+        finally:
+            command.subscriptions = []
+        connection.close()
+
+    def test__lock_tasks_rate_limit(self):
+        for owner in ['bob', 'tom', 'bob', 'tom', 'bob']:
+            Task.create(func4test, owner=owner)
+        connection = models.engine.connect()
+        ratelimit.set_limit(connection, models, 'owner', '*', 0.001,
+                            capacity=2)
+        # 5 would exceed the limit of bob, it's put back in the queue
+        self.assertEqual(command._lock_tasks(connection, models, 5),
+                         [1, 2, 3, 4])
+        task = Task.query.get(5)
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertEqual(task.pid, None)
+        # The tasks of bob are skipped until the bucket is refilled
+        Task.create(func4test, owner='alice')
+        self.assertEqual(command._lock_tasks(connection, models, 5), [6])
+
+        # The claimed tasks are released if the tokens can't be taken
+        Task.create(func4test, owner='alice')
+        with patch('sqla_taskq.ratelimit.RateLimits.acquire_tasks',
+                   side_effect=OperationalError(None, None, 'locked')):
+            self.assertRaises(OperationalError, command._lock_tasks,
+                              connection, models, 5)
+        transaction.abort()
+        task = Task.query.get(7)
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertEqual(task.pid, None)
+        connection.close()
+
+    def test_parse_queues(self):
+        self.assertEqual(command.parse_queues(None), [])
+        self.assertEqual(
+            command.parse_queues(['emails', 'reports:2', ('other', 1)]),
+            [('emails', None), ('reports', 2), ('other', 1)])
+        self.assertRaises(ValueError, command.parse_queues, ['reports:a'])
+        self.assertRaises(ValueError, command.parse_queues, ['reports:0'])
+
     def test_lock_task(self):
         for i in range(4):
             Task.create(func2lock)
@@ -119,6 +214,90 @@ class TestCommand(unittest.TestCase):
         self.assertTrue(task.pid)
         self.assertEqual(task.result, 'test')
 
+    def test__run_prefetch(self):
+        for i in range(3):
+            Task.create(func4test)
+        res = command._run(models, prefetch=2)
+        self.assertEqual(res, True)
+        self.assertEqual(command.prefetched, [2])
+        task = Task.query.get(2)
+        self.assertEqual(task.status, models.TASK_STATUS_IN_PROGRESS)
+
+        res = command._run(models, prefetch=2)
+        self.assertEqual(res, True)
+        self.assertEqual(command.prefetched, [])
+        res = command._run(models, prefetch=2)
+        self.assertEqual(res, True)
+        self.assertEqual(command.prefetched, [])
+        res = command._run(models, prefetch=2)
+        self.assertEqual(res, False)
+        for task in Task.query.all():
+            self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+    def test_run_threads(self):
+        for i in range(3):
+            Task.create(func4test)
+        executor = futures.ThreadPoolExecutor(2)
+        running = set()
+        res = command._run_threads(models, executor, running, 2)
+        self.assertEqual(res, True)
+        self.assertEqual(len(running), 2)
+        # Wait the tasks to be finished
+        futures.wait(running)
+        res = command._run_threads(models, executor, running, 2)
+        self.assertEqual(res, True)
+        self.assertEqual(len(running), 1)
+        futures.wait(running)
+        res = command._run_threads(models, executor, running, 2)
+        self.assertEqual(res, False)
+        self.assertEqual(len(running), 0)
+        for task in Task.query.all():
+            self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+            self.assertEqual(task.result, 'test')
+
+        # All the threads are busy
+        running = set([Mock(done=Mock(return_value=False))] * 2)
+        with patch('concurrent.futures.wait') as m:
+            res = command._run_threads(models, executor, running, 1)
+            self.assertEqual(res, True)
+            self.assertEqual(m.call_count, 1)
+        executor.shutdown()
+
+    def test_run_with_threads(self):
+        for i in range(4):
+            Task.create(func4test)
+
+        def f(*args, **kw):
+            res = orig_run_threads(*args, **kw)
+            if not res:
+                command.loop = False
+            return res
+
+        orig_run_threads = command._run_threads
+        waiter = Mock()
+        waiter.wait.return_value = False
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.command._run_threads', side_effect=f):
+                command.run(models, threads=2)
+        command.loop = True
+        for task in Task.query.all():
+            self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+        with patch('sqla_taskq.command.futures', None):
+            self.assertRaises(ImportError, command.run, models, threads=2)
+
+    def test_release_tasks(self):
+        command.release_tasks(models)
+        for i in range(3):
+            Task.create(func4test)
+        command._run(models, prefetch=3)
+        self.assertEqual(command.prefetched, [2, 3])
+        command.release_tasks(models)
+        self.assertEqual(command.prefetched, [])
+        rows = models.Task.query.filter_by(
+            status=models.TASK_STATUS_WAITING, pid=None).all()
+        self.assertEqual([t.idtask for t in rows], [2, 3])
+
     def test_run(self):
         command.loop = False
         res = command.run(models)
@@ -136,6 +315,356 @@ class TestCommand(unittest.TestCase):
             self.assertEqual(res, None)
         command.loop = True
 
+        # The prefetched tasks are released when the process stops
+        Task.create(func4test)
+        command.prefetched.append(2)
+        with patch('sqla_taskq.command._run', side_effect=f):
+            command.run(models)
+        self.assertEqual(command.prefetched, [])
+        command.loop = True
+
+    def test_run_delayed(self):
+        Task.create(func4test, run_after=datetime.timedelta(minutes=10))
+        Task.create(func4test, run_after=0.3)
+        self.assertEqual(command.lock_task(models), None)
+        due = command.next_due_delay(models)
+        self.assertTrue(0 < due <= 0.3)
+
+        timeouts = []
+
+        def f(timeout):
+            timeouts.append(timeout)
+            if Task.query.get(2).status == models.TASK_STATUS_FINISHED:
+                command.loop = False
+            else:
+                time.sleep(timeout)
+            transaction.abort()
+            return False
+
+        waiter = Mock()
+        waiter.wait.side_effect = f
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            command.run(models, poll_min=5, poll_max=5)
+        command.loop = True
+        # The worker doesn't wait the poll delay
+        self.assertTrue(timeouts[0] <= 0.3)
+        self.assertEqual(Task.query.get(1).status, models.TASK_STATUS_WAITING)
+        self.assertTrue(command.next_due_delay(models) > 500)
+
+    def test_run_next_due(self):
+        Task.create(func4test, run_after=600, queue='emails')
+        waiter = Mock()
+        calls = []
+
+        def f(timeout):
+            calls.append(timeout)
+            if len(calls) == 5:
+                command.loop = False
+            return False
+        waiter.wait.side_effect = f
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.claim.next_due',
+                       wraps=claim.next_due) as m:
+                command.run(models, poll_max=60, queues=['reports'])
+        command.loop = True
+        command.subscriptions = []
+        # Queried once while the worker is idle, for its queues
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(m.call_args[0][2], ['reports'])
+
+    def test_run_aging(self):
+        waiter = Mock()
+
+        def f(*args, **kw):
+            command.loop = False
+            return False
+        waiter.wait.side_effect = f
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.claim.age', return_value=2) as m:
+                command.run(models, aging=3600, aging_priority=-1)
+                self.assertEqual(m.call_count, 1)
+                self.assertEqual(m.call_args[0][1:], (models, 3600, -1))
+        command.loop = True
+
+    def test_run_reaping(self):
+        waiter = Mock()
+
+        def f(*args, **kw):
+            command.loop = False
+            return False
+        waiter.wait.side_effect = f
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.claim.reap', return_value=2) as m:
+                command.run(models, lease=30, reap_attempts=5)
+                self.assertEqual(m.call_count, 1)
+                self.assertEqual(m.call_args[0][1:], (models, 5))
+        self.assertEqual(command.lease_duration, 30)
+        command.lease_duration = claim.LEASE_DURATION
+        command.loop = True
+
+    def test_run_timeout(self):
+        self.assertRaises(ValueError, command.run, models,
+                          timeout_mode='other')
+        # The signals can't interrupt the threads
+        self.assertRaises(ValueError, command.run, models, threads=2,
+                          task_timeout=10)
+        command.loop = False
+        command.run(models, task_timeout=10, timeout_mode='process')
+        self.assertEqual(command.default_timeout, 10)
+        self.assertEqual(command.default_timeout_mode, 'process')
+        command.run(models)
+        self.assertEqual(command.default_timeout, None)
+        self.assertEqual(command.default_timeout_mode, 'signal')
+        # The timeouts of the tasks run by threads are enforced by a process
+        command.run(models, threads=2)
+        self.assertEqual(command.default_timeout_mode, 'process')
+        command.loop = True
+
+        Task.create(func4testslow, timeout=0.1)
+        executor = futures.ThreadPoolExecutor(2)
+        start = time.time()
+        executor.submit(command._perform_in_thread, models, 1).result()
+        executor.shutdown()
+        self.assertTrue(time.time() - start < 2)
+        task = Task.query.get(1)
+        self.assertEqual(task.status, models.TASK_STATUS_TIMED_OUT)
+        transaction.abort()
+        command.default_timeout_mode = 'signal'
+
+        Task.create(func4test)
+        with patch('sqla_taskq.models.Task.perform') as m:
+            command.default_timeout = 5
+            command._perform(models, 2)
+            command.default_timeout = None
+            m.assert_called_once_with(5, 'signal')
+
+    def test_reap_tasks(self):
+        with patch('sqla_taskq.claim.reap',
+                   side_effect=[claim.REAP_BATCH_SIZE, 3]) as m:
+            res = command.reap_tasks(models, 2)
+            self.assertEqual(res, claim.REAP_BATCH_SIZE + 3)
+            self.assertEqual(m.call_count, 2)
+
+    def test_heartbeat(self):
+        Task.create(func4test)
+        self.assertEqual(command.lock_tasks(models), [1])
+        with transaction.manager:
+            task = Task.query.get(1)
+            task.lease_expires = datetime.datetime(2000, 1, 1)
+        start = datetime.datetime.utcnow()
+        heartbeat = command.Heartbeat(models, 0.03)
+        heartbeat.start()
+        time.sleep(0.1)
+        heartbeat.stop()
+        self.assertFalse(heartbeat.is_alive())
+        task = Task.query.get(1)
+        self.assertTrue(task.lease_expires > start)
+
+    def test_renew_leases(self):
+        self.assertEqual(command.renew_leases(models, 100), 0)
+        for i in range(3):
+            Task.create(func4test)
+        self.assertEqual(command.lock_tasks(models, 2), [1, 2])
+        self.assertEqual(command.claimed, set([1, 2]))
+        # Not tracked by the process, its lease expires
+        connection = models.engine.connect()
+        claim.ReturningClaimer().claim(connection, models, lease=10)
+        connection.close()
+        now = datetime.datetime.utcnow()
+        self.assertEqual(command.renew_leases(models, 100), 2)
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertTrue(tasks[1].lease_expires >=
+                        now + datetime.timedelta(seconds=100))
+        self.assertTrue(tasks[2].lease_expires <
+                        now + datetime.timedelta(seconds=11))
+        transaction.abort()
+
+        # The finished and released tasks are not renewed anymore
+        command._perform(models, 1)
+        command.prefetched.append(2)
+        command.release_tasks(models)
+        self.assertEqual(command.claimed, set())
+        self.assertEqual(command.renew_leases(models, 100), 0)
+
+    def test_heartbeat_wait_none(self):
+        heartbeat = command.Heartbeat(models, 0.03)
+        # Event.wait returns None in python 2.6
+        wait = heartbeat.stopped.wait
+        heartbeat.stopped.wait = lambda timeout: wait(timeout) and None
+        with patch('sqla_taskq.command.renew_leases') as m:
+            heartbeat.start()
+            time.sleep(0.1)
+            heartbeat.stopped.set()
+            heartbeat.join(1)
+        self.assertFalse(heartbeat.is_alive())
+        self.assertTrue(1 <= m.call_count < 10)
+
+    def test_run_backoff(self):
+        results = [True, False, False, False, True, False, False]
+
+        def f(*args, **kw):
+            res = results.pop(0)
+            if not results:
+                command.loop = False
+            return res
+
+        waiter = Mock()
+        waiter.wait.return_value = False
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.command._run', side_effect=f):
+                command.run(models, poll_min=0.5, poll_max=1.5,
+                            backoff_factor=2)
+        command.loop = True
+        delays = [c[0][0] for c in waiter.wait.call_args_list]
+        self.assertEqual(delays, [0.5, 1, 1.5, 0.5, 1])
+        self.assertEqual(waiter.close.call_count, 1)
+
+        # The delay is reset when the waiter is woken up
+        results = [False, False, False]
+        waiter = Mock()
+        waiter.wait.side_effect = [False, True, False]
+        with patch('sqla_taskq.wakeup.get_waiter', return_value=waiter):
+            with patch('sqla_taskq.command._run', side_effect=f):
+                command.run(models, poll_min=0.5, poll_max=1.5,
+                            backoff_factor=2)
+        command.loop = True
+        delays = [c[0][0] for c in waiter.wait.call_args_list]
+        self.assertEqual(delays, [0.5, 1, 0.5])
+
+    def test_get_engine_options(self):
+        dic = command.parse_options(['--pool-size', '2', '--pool-pre-ping',
+                                     '--sqlite-synchronous', 'normal'])
+        res = command.get_engine_options(dic)
+        expected = {
+            'pool_size': 2,
+            'pool_pre_ping': True,
+            'sqlite_synchronous': 'normal',
+        }
+        self.assertEqual(res, expected)
+
+        with patch.object(models, 'configure_engine') as m:
+            command.configure_engine(models, {'pool_size': None})
+            self.assertEqual(m.call_count, 0)
+            command.configure_engine(models, dic)
+            m.assert_called_with(**expected)
+
+    def test_get_result_options(self):
+        dic = command.parse_options(['--result-store', 'file',
+                                     '--result-path', '/tmp/results',
+                                     '--result-inline-max', '100'])
+        res = command.get_result_options(dic)
+        expected = {
+            'store': 'file',
+            'path': '/tmp/results',
+            'inline_max': 100,
+        }
+        self.assertEqual(res, expected)
+
+        with patch('sqla_taskq.results.configure') as m:
+            command.configure_results({'result_ttl': None})
+            self.assertEqual(m.call_count, 0)
+            command.configure_results(dic)
+            m.assert_called_with(**expected)
+
+    def test__with_retries(self):
+        metrics = dict(command.metrics)
+        func = Mock(side_effect=[OperationalError('', {}, None),
+                                 OperationalError('', {}, None),
+                                 [1]])
+        with patch('time.sleep') as m:
+            res = command._with_retries(func, models, 2)
+        self.assertEqual(res, [1])
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with(command.get_connection(models), models, 2)
+        delays = [c[0][0] for c in m.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= command.RETRY_BASE_DELAY)
+        self.assertTrue(0 <= delays[1] <= command.RETRY_BASE_DELAY * 2)
+        self.assertEqual(command.metrics['retries'], metrics['retries'] + 2)
+
+        func = Mock(side_effect=OperationalError('', {}, None))
+        with patch('time.sleep') as m:
+            res = command._with_retries(func, models)
+        self.assertEqual(res, None)
+        self.assertEqual(func.call_count, command.RETRY_ATTEMPTS)
+        self.assertEqual(m.call_count, command.RETRY_ATTEMPTS - 1)
+        self.assertEqual(command.metrics['failures'], metrics['failures'] + 1)
+        command.close_connection()
+
+    def test__with_retries_end_transaction(self):
+        connection = Mock(closed=False, invalidated=False)
+        connection.in_transaction.return_value = False
+        func = Mock(return_value=[1])
+        with patch('sqla_taskq.command.get_connection',
+                   return_value=connection):
+            self.assertEqual(command._with_retries(func, models), [1])
+            # The transaction opened by the SELECTs is ended
+            self.assertEqual(connection.connection.rollback.call_count, 1)
+
+            connection.in_transaction.return_value = True
+            self.assertEqual(command._with_retries(func, models), [1])
+            self.assertEqual(connection.connection.rollback.call_count, 1)
+
+            connection.in_transaction.return_value = False
+            connection.connection.rollback.side_effect = Exception('lost')
+            with patch('sqla_taskq.command.close_connection') as m:
+                self.assertEqual(command._with_retries(func, models), [1])
+            self.assertEqual(m.call_count, 1)
+
+    def test_get_connection(self):
+        connection = command.get_connection(models)
+        self.assertTrue(command.get_connection(models) is connection)
+        command._lock_tasks(connection, models)
+        self.assertTrue(command.get_connection(models) is connection)
+
+        # The engine has been changed
+        models.engine = create_engine(DB_URL)
+        other = command.get_connection(models)
+        self.assertTrue(other is not connection)
+        self.assertTrue(connection.closed)
+
+        command.close_connection()
+        self.assertTrue(other.closed)
+        self.assertTrue(command.get_connection(models) is not other)
+        command.close_connection()
+
+    def test__perform_connection(self):
+        Task.create(func4test)
+        connection = command.get_connection(models)
+        idtask = command._lock_task(connection, models)
+        bind = DBSession().bind
+        with patch.object(connection, 'begin', wraps=connection.begin) as m:
+            command._perform(models, idtask, connection)
+            # The task has been run in a transaction of the connection
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(DBSession().bind, bind)
+        task = Task.query.get(idtask)
+        self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+        command.close_connection()
+
+    def test_get_run_options(self):
+        dic = command.parse_options([], parse_timeout=True)
+        res = command.get_run_options(dic)
+        expected = {
+            'kill': False,
+            'prefetch': 1,
+            'concurrency': 1,
+            'threads': 1,
+            'coroutines': 0,
+            'poll_min': 0.1,
+            'poll_max': 5,
+            'backoff_factor': 2,
+            'preload': [],
+            'queues': [],
+            'lease': 60,
+            'reap_attempts': 3,
+            'task_timeout': None,
+            'timeout_mode': 'signal',
+            'aging': 0,
+            'aging_priority': 0,
+        }
+        self.assertEqual(res, expected)
+
     def test_parse_config_file(self):
         config = ConfigParser.RawConfigParser()
         with patch('ConfigParser.ConfigParser', return_value=config):
@@ -156,17 +685,81 @@ class TestCommand(unittest.TestCase):
             expected = {
                 'kill': False,
                 'timeout': 60,
+                'prefetch': 1,
+                'concurrency': 1,
+                'threads': 1,
+                'coroutines': 0,
+                'poll_min': 0.1,
+                'poll_max': 5,
+                'backoff_factor': 2,
+                'preload': [],
+                'queues': [],
+                'lease': 60,
+                'reap_attempts': 3,
+                'task_timeout': None,
+                'timeout_mode': 'signal',
+                'aging': 0,
+                'aging_priority': 0,
             }
             self.assertEqual(res, expected)
 
             config.set('sqla_taskq', 'kill', 'true')
             config.set('sqla_taskq', 'timeout', '5')
             config.set('sqla_taskq', 'sqla_url', '//my_url')
+            config.set('sqla_taskq', 'prefetch', '10')
+            config.set('sqla_taskq', 'concurrency', '4')
+            config.set('sqla_taskq', 'threads', '8')
+            config.set('sqla_taskq', 'coroutines', '100')
+            config.set('sqla_taskq', 'retention_finished', '7')
+            config.set('sqla_taskq', 'retention_failed', '30.5')
+            config.set('sqla_taskq', 'poll_min', '0.5')
+            config.set('sqla_taskq', 'poll_max', '30')
+            config.set('sqla_taskq', 'backoff_factor', '1.5')
+            config.set('sqla_taskq', 'preload', 'mymodule,\n  other.func')
+            config.set('sqla_taskq', 'queues', 'emails, reports:2')
+            config.set('sqla_taskq', 'aging', '3600')
+            config.set('sqla_taskq', 'aging_priority', '-10')
+            config.set('sqla_taskq', 'lease', '30')
+            config.set('sqla_taskq', 'reap_attempts', '5')
+            config.set('sqla_taskq', 'task_timeout', '300')
+            config.set('sqla_taskq', 'timeout_mode', 'process')
+            config.set('sqla_taskq', 'result_store', 'file')
+            config.set('sqla_taskq', 'result_path', '/tmp/results')
+            config.set('sqla_taskq', 'result_inline_max', '4096')
+            config.set('sqla_taskq', 'result_ttl', '86400')
+            config.set('sqla_taskq', 'pool_size', '3')
+            config.set('sqla_taskq', 'pool_pre_ping', 'true')
+            config.set('sqla_taskq', 'sqlite_journal_mode', 'wal')
+            config.set('sqla_taskq', 'sqlite_busy_timeout', '5000')
             res = command.parse_config_file('/fake')
             expected = {
                 'kill': True,
                 'timeout': 5,
                 'sqla_url': '//my_url',
+                'prefetch': 10,
+                'concurrency': 4,
+                'threads': 8,
+                'coroutines': 100,
+                'retention': {'finished': 7, 'failed': 30.5},
+                'poll_min': 0.5,
+                'poll_max': 30,
+                'backoff_factor': 1.5,
+                'preload': ['mymodule', 'other.func'],
+                'queues': ['emails', 'reports:2'],
+                'aging': 3600,
+                'aging_priority': -10,
+                'lease': 30,
+                'reap_attempts': 5,
+                'task_timeout': 300,
+                'timeout_mode': 'process',
+                'result_store': 'file',
+                'result_path': '/tmp/results',
+                'result_inline_max': 4096,
+                'result_ttl': 86400,
+                'pool_size': 3,
+                'pool_pre_ping': True,
+                'sqlite_journal_mode': 'wal',
+                'sqlite_busy_timeout': 5000,
             }
             self.assertEqual(res, expected)
 
@@ -176,6 +769,32 @@ class TestCommand(unittest.TestCase):
             'kill': False,
             'sqla_url': None,
             'config_filename': None,
+            'pool_size': None,
+            'pool_pre_ping': None,
+            'pool_recycle': None,
+            'sqlite_journal_mode': None,
+            'sqlite_busy_timeout': None,
+            'sqlite_synchronous': None,
+            'sqlite_tuned': None,
+            'result_store': None,
+            'result_path': None,
+            'result_inline_max': None,
+            'result_ttl': None,
+            'prefetch': 1,
+            'concurrency': 1,
+            'threads': 1,
+            'coroutines': 0,
+            'poll_min': 0.1,
+            'poll_max': 5,
+            'backoff_factor': 2,
+            'preload': [],
+            'queues': [],
+            'lease': 60,
+            'reap_attempts': 3,
+            'task_timeout': None,
+            'timeout_mode': 'signal',
+            'aging': 0,
+            'aging_priority': 0,
         }
         self.assertEqual(res, expected)
 
@@ -184,17 +803,80 @@ class TestCommand(unittest.TestCase):
             'kill': False,
             'sqla_url': None,
             'config_filename': None,
+            'pool_size': None,
+            'pool_pre_ping': None,
+            'pool_recycle': None,
+            'sqlite_journal_mode': None,
+            'sqlite_busy_timeout': None,
+            'sqlite_synchronous': None,
+            'sqlite_tuned': None,
+            'result_store': None,
+            'result_path': None,
+            'result_inline_max': None,
+            'result_ttl': None,
             'timeout': 60,
+            'json': False,
+            'prefetch': 1,
+            'concurrency': 1,
+            'threads': 1,
+            'coroutines': 0,
+            'poll_min': 0.1,
+            'poll_max': 5,
+            'backoff_factor': 2,
+            'preload': [],
+            'queues': [],
+            'lease': 60,
+            'reap_attempts': 3,
+            'task_timeout': None,
+            'timeout_mode': 'signal',
+            'aging': 0,
+            'aging_priority': 0,
         }
         self.assertEqual(res, expected)
 
-        options = ['-k', '-t', '90', '-u', 'sqlite://fake.db']
+        options = ['-k', '-t', '90', '-u', 'sqlite://fake.db', '-p', '10',
+                   '-n', '4', '--threads', '8',
+                   '--coroutines', '100',
+                   '--poll-min', '0.5', '--poll-max', '30',
+                   '--backoff-factor', '1.5', '--json',
+                   '--preload', 'mymodule, other.func',
+                   '--aging', '60', '--aging-priority', '-5',
+                   '--lease', '20', '--reap-attempts', '1',
+                   '--task-timeout', '120', '--timeout-mode', 'process',
+                   '--queues', 'emails,reports:2']
         res = command.parse_options(options, parse_timeout=True)
         expected = {
             'kill': True,
             'sqla_url': 'sqlite://fake.db',
             'config_filename': None,
+            'pool_size': None,
+            'pool_pre_ping': None,
+            'pool_recycle': None,
+            'sqlite_journal_mode': None,
+            'sqlite_busy_timeout': None,
+            'sqlite_synchronous': None,
+            'sqlite_tuned': None,
+            'result_store': None,
+            'result_path': None,
+            'result_inline_max': None,
+            'result_ttl': None,
             'timeout': 90,
+            'json': True,
+            'prefetch': 10,
+            'concurrency': 4,
+            'threads': 8,
+            'coroutines': 100,
+            'poll_min': 0.5,
+            'poll_max': 30,
+            'backoff_factor': 1.5,
+            'preload': ['mymodule', 'other.func'],
+            'queues': ['emails', 'reports:2'],
+            'aging': 60,
+            'aging_priority': -5,
+            'lease': 20,
+            'reap_attempts': 1,
+            'task_timeout': 120,
+            'timeout_mode': 'process',
         }
         self.assertEqual(res, expected)
 
@@ -206,7 +888,34 @@ class TestCommand(unittest.TestCase):
             'kill': True,
             'sqla_url': 'sqlite://fake.db',
             'config_filename': 'fake.ini',
+            'pool_size': None,
+            'pool_pre_ping': None,
+            'pool_recycle': None,
+            'sqlite_journal_mode': None,
+            'sqlite_busy_timeout': None,
+            'sqlite_synchronous': None,
+            'sqlite_tuned': None,
+            'result_store': None,
+            'result_path': None,
+            'result_inline_max': None,
+            'result_ttl': None,
             'timeout': 90,
+            'json': False,
+            'prefetch': 1,
+            'concurrency': 1,
+            'threads': 1,
+            'coroutines': 0,
+            'poll_min': 0.1,
+            'poll_max': 5,
+            'backoff_factor': 2,
+            'preload': [],
+            'queues': [],
+            'lease': 60,
+            'reap_attempts': 3,
+            'task_timeout': None,
+            'timeout_mode': 'signal',
+            'aging': 0,
+            'aging_priority': 0,
         }
         self.assertEqual(res, expected)
 
@@ -219,5 +928,20 @@ class TestCommand(unittest.TestCase):
             expected = {
                 'kill': False,
                 'timeout': 5,
+                'prefetch': 1,
+                'concurrency': 1,
+                'threads': 1,
+                'coroutines': 0,
+                'poll_min': 0.1,
+                'poll_max': 5,
+                'backoff_factor': 2,
+                'preload': [],
+                'queues': [],
+                'lease': 60,
+                'reap_attempts': 3,
+                'task_timeout': None,
+                'timeout_mode': 'signal',
+                'aging': 0,
+                'aging_priority': 0,
             }
             self.assertEqual(res, expected)
@@ -0,0 +1,20 @@
+import unittest
+import datetime
+from sqla_taskq import compat
+
+
+class TestCompat(unittest.TestCase):
+
+    def test_total_seconds(self):
+        for delta, expected in [
+                (datetime.timedelta(days=2, seconds=3, microseconds=4),
+                 172803.000004),
+                (datetime.timedelta(seconds=-1.5), -1.5),
+                (datetime.timedelta(0), 0)]:
+            self.assertAlmostEqual(compat.total_seconds(delta), expected)
+
+    def test_ordered_dict(self):
+        dic = compat.OrderedDict()
+        dic['b'] = 1
+        dic['a'] = 2
+        self.assertEqual(dic.keys(), ['b', 'a'])
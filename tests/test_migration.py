@@ -0,0 +1,102 @@
+import unittest
+import os
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqla_taskq import migration
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(DB_URL)
+
+    def tearDown(self):
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def _indexes(self):
+        inspector = sqlalchemy.inspect(self.engine)
+        return sorted([i['name'] for i in inspector.get_indexes('task')])
+
+    def test_create_all(self):
+        models.Base.metadata.create_all(self.engine)
+        self.assertEqual(self._indexes(), [
+            'ix_task_func_name',
+            'ix_task_queue_status_priority_idtask',
+            'ix_task_status_end_date',
+            'ix_task_status_lease_expires',
+            'ix_task_status_not_before',
+            'ix_task_status_pid_priority_idtask',
+            'ix_task_unique_key_status',
+            'ix_task_waiting_priority',
+        ])
+
+    def test_upgrade(self):
+        # The task table of the first version
+        self.engine.execute("""
+        CREATE TABLE task (
+            idtask INTEGER NOT NULL PRIMARY KEY,
+            func BLOB NOT NULL,
+            description TEXT NOT NULL,
+            result TEXT,
+            status VARCHAR NOT NULL,
+            creation_date DATETIME NOT NULL,
+            start_date DATETIME,
+            end_date DATETIME,
+            pid INTEGER,
+            lock_date DATETIME,
+            unique_key VARCHAR
+        )""")
+        # The indexes of the previous versions
+        self.engine.execute(
+            'CREATE INDEX ix_task_status_pid_idtask ON task '
+            '(status, pid, idtask)')
+        self.engine.execute(
+            "CREATE INDEX ix_task_waiting ON task (idtask) "
+            "WHERE status = 'waiting' AND pid IS NULL")
+        self.engine.execute("""
+        INSERT INTO task (func, description, status, creation_date,
+                          lock_date, unique_key)
+        VALUES ('', 'test', 'inprogress', '2020-01-01 00:00:00',
+                '2020-01-01 00:00:00', 'mykey')
+        """)
+        migration.upgrade(self.engine, models)
+        self.assertEqual(self._indexes(), [
+            'ix_task_func_name',
+            'ix_task_queue_status_priority_idtask',
+            'ix_task_status_end_date',
+            'ix_task_status_lease_expires',
+            'ix_task_status_not_before',
+            'ix_task_status_pid_priority_idtask',
+            'ix_task_unique_key_status',
+            'ix_task_waiting_priority',
+        ])
+        inspector = sqlalchemy.inspect(self.engine)
+        columns = [c['name'] for c in inspector.get_columns('task')]
+        self.assertTrue('owner' in columns)
+        self.assertTrue('func_name' in columns)
+        self.assertTrue('priority' in columns)
+        priority = self.engine.execute('SELECT priority FROM task').scalar()
+        self.assertEqual(priority, 0)
+        attempts = self.engine.execute('SELECT attempts FROM task').scalar()
+        self.assertEqual(attempts, 0)
+        queue = self.engine.execute('SELECT queue FROM task').scalar()
+        self.assertEqual(queue, 'default')
+        self.assertTrue('task_archive' in inspector.get_table_names())
+        self.assertTrue('task_result' in inspector.get_table_names())
+        self.assertTrue('task_rate_limit' in inspector.get_table_names())
+        # The key of the task in progress is locked
+        locks = self.engine.execute(
+            'SELECT unique_key, idtask FROM task_key_lock').fetchall()
+        self.assertEqual([tuple(lock) for lock in locks], [('mykey', 1)])
+
+        # Nothing to do
+        migration.upgrade(self.engine, models)
+        self.assertEqual(len(self._indexes()), 8)
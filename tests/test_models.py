@@ -1,7 +1,13 @@
 import unittest
+import datetime
+import time
+from mock import patch
 from sqlalchemy import create_engine
 import transaction
 import os
+import shutil
+import tempfile
+import weakref
 
 from sqla_taskq.models import (
     DBSession,
@@ -9,6 +15,9 @@ from sqla_taskq.models import (
     Task,
 )
 import sqla_taskq.models as models
+from sqla_taskq import codec
+from sqla_taskq import retry
+from sqla_taskq import results
 
 DB_NAME = 'test_sqla_taskq.db'
 DB_URL = 'sqlite:///%s' % DB_NAME
@@ -29,12 +38,41 @@ def func4testfailed(*args, **kw):
     raise Exception('Failing function')
 
 
+def func4testslow(*args, **kw):
+    time.sleep(5)
+
+
+def func4testdb(*args, **kw):
+    return id(DBSession()), Task.query.count()
+
+
+@retry.retry(max_attempts=2, exceptions=[ValueError])
+def func4testretry(*args, **kw):
+    raise ValueError('Retried function')
+
+
 class Class4Test(object):
 
     def run(self):
         return 'Class4Test.run is called'
 
 
+class Equal4Test(object):
+    """All the instances are equal"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Equal4Test)
+
+    def __hash__(self):
+        return 0
+
+    def run(self):
+        return self.value
+
+
 class TestTask(unittest.TestCase):
 
     def setUp(self):
@@ -54,7 +92,7 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, None)
         self.assertEqual(task._instance, None)
 
-        # init_on_load is called when we load from DB
+        # The payload is decoded on first access when we load from DB
         Task.create(func4test)
         task = Task.query.one()
         self.assertEqual(task._args, [])
@@ -62,12 +100,110 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, {})
         self.assertEqual(task._instance, None)
 
+    def test_lazy_payload(self):
+        Task.create(func4test, [1])
+        # The payload can't be decoded
+        DBSession.execute(
+            "UPDATE task SET func = X'0078', func_name = NULL")
+        task = Task.query.one()
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertTrue('func' not in task.__dict__)
+        self.assertRaises(ValueError, getattr, task, '_args')
+        transaction.abort()
+
+        Task.create(func4test, [1])
+        task = Task.query.filter_by(idtask=2).one()
+        # The function name doesn't need the payload
+        self.assertEqual(task._func_name, 'tests.test_models.func4test')
+        self.assertTrue('func' not in task.__dict__)
+        self.assertEqual(task._args, [1])
+        self.assertEqual(task._kw, {})
+        self.assertRaises(AttributeError, getattr, task, '_unexisting')
+        transaction.abort()
+
+        task = Task.get_with_payload(2)
+        self.assertTrue('func' in task.__dict__)
+
+    def test_summaries(self):
+        Task.create(func4test, owner='me')
+        Task.create(func4testdoc)
+        rows = Task.summaries().all()
+        self.assertEqual([row.idtask for row in rows], [1, 2])
+        self.assertEqual(rows[0].func_name, 'tests.test_models.func4test')
+        self.assertEqual(rows[0].status, models.TASK_STATUS_WAITING)
+        self.assertEqual(rows[0].owner, 'me')
+        self.assertEqual(rows[1].description, 'Display the function name')
+        self.assertEqual(rows[1].keys(), models.SUMMARY_COLUMNS)
+
+        rows = Task.summaries(owner='me').all()
+        self.assertEqual([row.idtask for row in rows], [1])
+
+    def test_get_func(self):
+        models.clear_func_cache()
+        task = Task()
+        task._func_name = 'tests.test_models.func4test'
+        self.assertEqual(task.get_func(), func4test)
+        self.assertEqual(models._func_cache.keys(),
+                         ['tests.test_models.func4test'])
+        with patch('importlib.import_module') as m:
+            self.assertEqual(task.get_func(), func4test)
+            self.assertEqual(m.call_count, 0)
+
+        task._func_name = 'os.path.join'
+        with patch('sqla_taskq.models.FUNC_CACHE_SIZE', 1):
+            self.assertEqual(task.get_func(), os.path.join)
+        self.assertEqual(models._func_cache.keys(), ['os.path.join'])
+
+        models.clear_func_cache('os.path.join')
+        self.assertEqual(models._func_cache.keys(), [])
+
+    def test_preload(self):
+        models.clear_func_cache()
+        models.preload(['json', 'tests.test_models.func4test'])
+        self.assertEqual(models._func_cache.keys(),
+                         ['tests.test_models.func4test'])
+        self.assertRaises(ImportError, models.preload, ['unexisting'])
+        self.assertRaises(AttributeError, models.preload,
+                          ['tests.test_models.unexisting'])
+
+    def test_configure_engine(self):
+        engine = models.engine
+        try:
+            res = models.configure_engine(
+                DB_URL, pool_pre_ping=True, pool_size=5,
+                sqlite_journal_mode='wal', sqlite_busy_timeout=1234)
+            self.assertTrue(models.engine is res)
+            self.assertTrue(DBSession().bind is res)
+            self.assertEqual(res.pool._pre_ping, True)
+            connection = res.connect()
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(), 1234)
+            connection.close()
+            res = models.configure_engine(DB_URL, sqlite_tuned=True,
+                                          sqlite_synchronous='full')
+            connection = res.connect()
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(), 5000)
+            # FULL
+            self.assertEqual(
+                connection.execute('PRAGMA synchronous').scalar(), 2)
+            connection.close()
+            self.assertRaises(ValueError, models.configure_engine,
+                              DB_URL, sqlite_synchronous='off; DROP')
+        finally:
+            models.engine = engine
+            DBSession.remove()
+            DBSession.configure(bind=engine)
+
     def test_dump_func(self):
         task = Task()
         dic = task.dump_func()
         expected = {
             '_args': None,
-            '_func_name': None,
             '_kw': None,
             '_instance': None
         }
@@ -78,7 +214,6 @@ class TestTask(unittest.TestCase):
         dic = task.dump_func()
         expected = {
             '_args': None,
-            '_func_name': None,
             '_kw': None,
             '_instance': None
         }
@@ -89,12 +224,22 @@ class TestTask(unittest.TestCase):
             '_kw': '_kw',
             '_instance': '_instance'
         }
+        # The payload of the old tasks contains the function name
         task.load_func()
         self.assertEqual(task._args, '_args')
         self.assertEqual(task._kw, '_kw')
         self.assertEqual(task._func_name, '_func_name')
         self.assertEqual(task._instance, '_instance')
 
+        task.func = {
+            '_args': '_args',
+            '_kw': '_kw',
+            '_instance': '_instance'
+        }
+        task.func_name = 'func_name'
+        task.load_func()
+        self.assertEqual(task._func_name, 'func_name')
+
     def test_create(self):
         expected = {
             '_args': None,
@@ -108,6 +253,7 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, expected['_kw'])
         self.assertEqual(task._instance, expected['_instance'])
         DBSession.add(task)
+        self.assertEqual(task.func_name, expected.pop('_func_name'))
         self.assertEqual(task.func, expected)
         self.assertEqual(task.description, 'func4test')
         self.assertTrue(task.creation_date)
@@ -125,8 +271,29 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, expected['_kw'])
         self.assertEqual(task._instance, expected['_instance'])
         DBSession.add(task)
+        self.assertEqual(task.func_name, expected.pop('_func_name'))
         self.assertEqual(task.func, expected)
         self.assertEqual(task.description, 'Hello world')
+        self.assertEqual(task.priority, models.PRIORITY_DEFAULT)
+
+        task = Task.create(func4test, priority=5)
+        DBSession.add(task)
+        self.assertEqual(task.priority, 5)
+        self.assertEqual(task.not_before, None)
+
+        date = datetime.datetime(2030, 1, 1)
+        task = Task.create(func4test, run_after=date)
+        DBSession.add(task)
+        self.assertEqual(task.not_before, date)
+        now = datetime.datetime.utcnow()
+        task = Task.create(func4test, run_after=60)
+        DBSession.add(task)
+        self.assertTrue(
+            task.not_before >= now + datetime.timedelta(seconds=60))
+        self.assertTrue(task.not_before < now + datetime.timedelta(seconds=70))
+        task = Task.create(func4test, run_after=datetime.timedelta(hours=1))
+        DBSession.add(task)
+        self.assertTrue(task.not_before >= now + datetime.timedelta(hours=1))
 
         # Test with docstring
         expected = {
@@ -141,6 +308,7 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, expected['_kw'])
         self.assertEqual(task._instance, expected['_instance'])
         DBSession.add(task)
+        self.assertEqual(task.func_name, expected.pop('_func_name'))
         self.assertEqual(task.func, expected)
         self.assertEqual(task.description, 'Display the function name')
 
@@ -157,6 +325,7 @@ class TestTask(unittest.TestCase):
         self.assertEqual(task._kw, expected['_kw'])
         self.assertTrue(task._instance)
         DBSession.add(task)
+        self.assertEqual(task.func_name, expected.pop('_func_name'))
         for k, v in expected.iteritems():
             self.assertEqual(task.func[k], v)
         self.assertTrue(task.func['_instance'])
@@ -165,12 +334,117 @@ class TestTask(unittest.TestCase):
         task = Task.create('hello.world')
         self.assertEqual(task._args, None)
         self.assertEqual(task._func_name, 'hello.world')
-        self.assertEqual(task._kw, expected['_kw'])
+        self.assertEqual(task._kw, None)
         self.assertEqual(task._instance, None)
         DBSession.add(task)
         self.assertEqual(task.func['_instance'], None)
         self.assertEqual(task.description, 'hello.world')
 
+    def test_create_queue(self):
+        Task.create(func4test)
+        Task.create(func4test, queue='emails')
+        Task.create_many([{'func': func4test, 'queue': 'reports'},
+                          {'func': func4test}])
+        self.assertEqual(
+            [row.queue for row in Task.summaries()],
+            ['default', 'emails', 'reports', 'default'])
+
+    def test_create_unique_key_too_long(self):
+        key = 'k' * (models.UNIQUE_KEY_MAX_LENGTH + 1)
+        self.assertRaises(ValueError, Task.create, func4test, unique_key=key)
+        self.assertRaises(ValueError, Task.create_many,
+                          [{'func': func4test, 'unique_key': key}])
+        self.assertEqual(Task.query.count(), 0)
+        Task.create(func4test, unique_key=key[1:])
+
+    def test_create_many(self):
+        o = Class4Test()
+        specs = [
+            {'func': func4test, 'args': [1], 'kw': {'a': 1}},
+            {'func': func4testdoc, 'owner': 'me', 'unique_key': 'key',
+             'priority': -1},
+            {'func': o.run, 'description': 'Hello world'},
+            ('hello.world', [2]),
+        ]
+        res = Task.create_many(specs)
+        self.assertEqual(res, 4)
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertEqual(len(tasks), 4)
+
+        self.assertEqual(tasks[0]._func_name, 'tests.test_models.func4test')
+        self.assertEqual(tasks[0].func_name, 'tests.test_models.func4test')
+        self.assertEqual(tasks[0]._args, [1])
+        self.assertEqual(tasks[0]._kw, {'a': 1})
+        self.assertEqual(tasks[0].description, 'func4test')
+        self.assertEqual(tasks[0].status, models.TASK_STATUS_WAITING)
+        self.assertTrue(tasks[0].creation_date)
+        self.assertEqual(tasks[0].pid, None)
+
+        self.assertEqual(tasks[0].priority, models.PRIORITY_DEFAULT)
+
+        self.assertEqual(tasks[1].description, 'Display the function name')
+        self.assertEqual(tasks[1].priority, -1)
+        self.assertEqual(tasks[1].owner, 'me')
+        self.assertEqual(tasks[1].unique_key, 'key')
+
+        self.assertEqual(tasks[2]._func_name, 'run')
+        self.assertTrue(tasks[2]._instance)
+        self.assertEqual(tasks[2].description, 'Hello world')
+        self.assertEqual(tasks[2].perform(), 'Class4Test.run is called')
+
+        self.assertEqual(tasks[3]._func_name, 'hello.world')
+        self.assertEqual(tasks[3]._args, [2])
+        self.assertEqual(tasks[3].description, 'hello.world')
+
+    def test_create_json(self):
+        settings = dict(codec.settings)
+        codec.configure(codec='json')
+        try:
+            Task.create(func4test, [1], {'a': 1})
+        finally:
+            codec.settings.update(settings)
+        task = Task.query.one()
+        self.assertEqual(task._func_name, 'tests.test_models.func4test')
+        self.assertEqual(task.perform(), "func4test (1,) {u'a': 1}")
+
+    def test_iter_create_many(self):
+        specs = ((func4test, [i]) for i in range(5))
+        res = list(Task.iter_create_many(specs, chunk_size=2))
+        self.assertEqual(res, [2, 2, 1])
+        tasks = Task.query.order_by(Task.idtask).all()
+        self.assertEqual([t._args for t in tasks],
+                         [[0], [1], [2], [3], [4]])
+
+        self.assertEqual(Task.create_many([]), 0)
+
+        # The function is resolved once
+        with patch.object(Task, 'resolve_func',
+                          wraps=Task.resolve_func) as m:
+            res = Task.create_many([(func4test,), (func4test,),
+                                    (func4testdoc,)])
+            self.assertEqual(res, 3)
+            self.assertEqual(m.call_count, 2)
+
+        # The bound methods of equal instances are equal
+        first, second = Equal4Test(1), Equal4Test(2)
+        self.assertEqual(first.run, second.run)
+        self.assertEqual(Task.create_many([(first.run,), (second.run,)]), 2)
+        tasks = Task.query.order_by(Task.idtask.desc()).limit(2).all()
+        self.assertEqual([t.perform() for t in tasks], [2, 1])
+
+        # The funcs of the inserted chunks are not kept
+        refs = []
+
+        def methods():
+            for i in range(4):
+                obj = Equal4Test(i)
+                refs.append(weakref.ref(obj))
+                yield (obj.run,)
+        created = Task.iter_create_many(methods(), chunk_size=2)
+        self.assertEqual(next(created), 2)
+        self.assertEqual(next(created), 2)
+        self.assertEqual([ref() for ref in refs[:2]], [None, None])
+
     def test_perform(self):
         task = Task.create(func4test)
         DBSession.add(task)
@@ -204,3 +478,151 @@ class TestTask(unittest.TestCase):
         res = task.perform()
         self.assertTrue('Failing function' in res)
         self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+        self.assertEqual(task.attempts, 1)
+
+    def test_store_result(self):
+        settings = dict(results.settings)
+        directory = tempfile.mkdtemp()
+        try:
+            task = Task.create(func4test, ['a' * 100])
+            DBSession.add(task)
+            res = task.perform()
+            self.assertTrue(len(res) > 100)
+            self.assertEqual(task.result, res)
+            self.assertEqual(task.result_ref, None)
+            self.assertEqual(task.get_result(), res)
+            self.assertEqual(list(task.iter_result()), [res])
+
+            # The large results are stored in the task_result table
+            results.configure(inline_max=50, ttl=3600)
+            task = Task.create(func4test, ['a' * 100])
+            DBSession.add(task)
+            self.assertEqual(task.perform(), res)
+            self.assertEqual(task.result, None)
+            self.assertEqual(task.result_ref, 'db')
+            self.assertEqual(task.get_result(), res)
+            self.assertEqual(''.join(task.iter_result(10)), res)
+            row = models.TaskResult.query.get(task.idtask)
+            self.assertEqual(row.compressed, True)
+            self.assertEqual(row.size, len(res))
+            self.assertTrue(row.expires > datetime.datetime.utcnow())
+            row.expires = datetime.datetime(2000, 1, 1)
+            self.assertEqual(task.get_result(), None)
+
+            # In the file store
+            results.configure(store='file', path=directory)
+            task = Task.create(func4test, ['a' * 100])
+            DBSession.add(task)
+            self.assertEqual(task.perform(), res)
+            self.assertEqual(task.result_ref, 'file:%i.z' % task.idtask)
+            self.assertEqual(task.get_result(), res)
+            self.assertEqual(''.join(task.iter_result(10)), res)
+
+            # The errors are stored in the task table
+            task = Task.create(func4testfailed, ['a' * 100])
+            DBSession.add(task)
+            task.perform()
+            self.assertEqual(task.result_ref, None)
+            self.assertTrue('Failing function' in task.get_result())
+        finally:
+            results.settings.update(settings)
+            shutil.rmtree(directory)
+
+    def test_perform_timeout(self):
+        task = Task.create(func4testslow, timeout=0.1, unique_key='key')
+        DBSession.add(task)
+        self.assertEqual(task.timeout, 0.1)
+        start = time.time()
+        res = task.perform()
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue('TaskTimeout: The task has run more than 0.1s' in res)
+        self.assertEqual(task.status, models.TASK_STATUS_TIMED_OUT)
+        self.assertTrue(task.end_date)
+
+        # The default timeout of the worker
+        task = Task.create(func4testslow)
+        DBSession.add(task)
+        task.perform(0.1, 'process')
+        self.assertEqual(task.status, models.TASK_STATUS_TIMED_OUT)
+
+        task = Task.create(func4test, timeout=1)
+        DBSession.add(task)
+        self.assertEqual(task.perform(0.1, 'process'), 'func4test () {}')
+        self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+        # The child process uses its own session and connection
+        task = Task.create(func4testdb)
+        DBSession.add(task)
+        session, count = task.perform(1, 'process')
+        self.assertNotEqual(session, id(DBSession()))
+        self.assertEqual(count, 4)
+        self.assertEqual(task.status, models.TASK_STATUS_FINISHED)
+
+    def test_perform_retry(self):
+        # The policy of the function
+        task = Task.create(func4testretry, unique_key='key')
+        DBSession.add(task)
+        task.status = models.TASK_STATUS_IN_PROGRESS
+        task.pid = 1
+        DBSession.add(models.TaskKeyLock(unique_key='key', idtask=task.idtask,
+                                         lock_date=datetime.datetime.now()))
+        now = datetime.datetime.utcnow()
+        res = task.perform()
+        self.assertTrue('Retried function' in res)
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertEqual(task.attempts, 1)
+        self.assertEqual(task.pid, None)
+        self.assertEqual(task.end_date, None)
+        self.assertTrue(now + datetime.timedelta(seconds=0.5) <=
+                        task.not_before <=
+                        now + datetime.timedelta(seconds=2))
+        self.assertEqual(models.TaskKeyLock.query.count(), 0)
+
+        res = task.perform()
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+        self.assertEqual(task.attempts, 2)
+        self.assertTrue(task.end_date)
+
+        # The policy of the task has the priority
+        task = Task.create(func4testretry, retry={'max_attempts': 3,
+                                                  'jitter': False,
+                                                  'backoff_base': 10})
+        self.assertEqual(task._retry['exceptions'], ['exceptions.Exception'])
+        DBSession.add(task)
+        now = datetime.datetime.utcnow()
+        task.perform()
+        task.perform()
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertEqual(task.attempts, 2)
+        self.assertTrue(now + datetime.timedelta(seconds=20) <=
+                        task.not_before <=
+                        now + datetime.timedelta(seconds=21))
+        task.perform()
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+
+        # The exception is not retryable
+        task = Task.create(func4testfailed,
+                           retry=retry.RetryPolicy(exceptions=[ValueError]))
+        DBSession.add(task)
+        task.perform()
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+        self.assertEqual(task.attempts, 1)
+
+        # The process mode raises the exception of the child process
+        task = Task.create(func4testretry)
+        DBSession.add(task)
+        res = task.perform(1, 'process')
+        self.assertEqual(task.status, models.TASK_STATUS_WAITING)
+        self.assertTrue('in func4testretry' in res)
+        task = Task.create(func4testfailed,
+                           retry=retry.RetryPolicy(exceptions=[ValueError]))
+        DBSession.add(task)
+        task.perform(1, 'process')
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+
+        # No policy
+        task = Task.create(func4testfailed)
+        DBSession.add(task)
+        task.perform()
+        self.assertEqual(task.status, models.TASK_STATUS_FAILED)
+        self.assertEqual(task.get_retry_policy(), None)
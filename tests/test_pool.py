@@ -0,0 +1,89 @@
+import unittest
+from mock import patch
+import os
+import shutil
+import signal
+import tempfile
+import time
+from sqla_taskq import command
+from sqla_taskq import pool
+import sqla_taskq.models as models
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'pids')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        filename = self.filename
+
+        def fake_run(models, **options):
+            with open(filename, 'a') as f:
+                f.write('%i %s\n' % (os.getpid(), options['kill']))
+            with open(filename) as f:
+                if len(f.readlines()) >= 2:
+                    # Stop the pool
+                    os.kill(os.getppid(), signal.SIGTERM)
+            time.sleep(10)
+
+        with patch('sqla_taskq.command.run', side_effect=fake_run):
+            with patch('sqla_taskq.pool.RESTART_DELAY', 0):
+                workers = pool.WorkerPool(models, 2, kill=True)
+                # The first worker is dying, it will be restarted
+                pid = workers.spawn()
+                os.kill(pid, signal.SIGKILL)
+                workers.concurrency = 1
+                handler = signal.getsignal(signal.SIGTERM)
+                start = time.time()
+                workers.run()
+
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(workers.children, {})
+        self.assertEqual(workers.running, False)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+        with open(filename) as f:
+            lines = f.readlines()
+        pids = set([line.split()[0] for line in lines])
+        self.assertEqual(len(pids), len(lines))
+        for line in lines:
+            self.assertEqual(line.split()[1], 'True')
+
+    def test_run_child_failure(self):
+        def fake_run(models, **options):
+            raise Exception('Failing worker')
+
+        with patch('sqla_taskq.command.run', side_effect=fake_run):
+            workers = pool.WorkerPool(models, 1)
+            pid = workers.spawn()
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 1)
+
+    def test_run_child_killed(self):
+        def fake_run(models, **options):
+            command.sigterm_kill_handler(signal.SIGTERM, None)
+
+        with patch('sqla_taskq.command.run', side_effect=fake_run):
+            workers = pool.WorkerPool(models, 1)
+            pid = workers.spawn()
+            _, status = os.waitpid(pid, 0)
+            # Not a failure
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    def test_exit_status(self):
+        self.assertEqual(pool._exit_status(None), 0)
+        self.assertEqual(pool._exit_status(3), 3)
+        self.assertEqual(pool._exit_status('error'), 1)
+
+    def test_pool_run(self):
+        with patch('sqla_taskq.command.run') as m:
+            pool.run(models, kill=True)
+            m.assert_called_with(models, kill=True)
+
+        with patch('sqla_taskq.pool.WorkerPool.run') as m:
+            pool.run(models, concurrency=2, kill=True)
+            m.assert_called_with()
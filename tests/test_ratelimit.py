@@ -0,0 +1,152 @@
+import unittest
+import datetime
+import os
+from sqlalchemy import create_engine
+from sqla_taskq import ratelimit
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+    TaskRateLimit,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+def func4test(*args, **kw):
+    return 'test'
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        self.connection = engine.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def _bucket(self, scope, name):
+        transaction.abort()
+        return TaskRateLimit.query.get((scope, name))
+
+    def test_set_limit(self):
+        ratelimit.set_limit(self.connection, models, 'func_name', 'f', 50)
+        limit = self._bucket('func_name', 'f')
+        self.assertEqual(limit.rate, 50)
+        self.assertEqual(limit.capacity, 50)
+        self.assertEqual(limit.tokens, 50)
+        self.assertEqual(limit.version, 0)
+
+        # The tokens are limited by the new capacity
+        ratelimit.set_limit(self.connection, models, 'func_name', 'f', 0.5)
+        limit = self._bucket('func_name', 'f')
+        self.assertEqual(limit.rate, 0.5)
+        self.assertEqual(limit.capacity, 1)
+        self.assertEqual(limit.tokens, 1)
+        self.assertEqual(limit.version, 1)
+
+        try:
+            ratelimit.set_limit(self.connection, models, 'unexisting', 'f', 1)
+            assert(False)
+        except ValueError, e:
+            self.assertTrue('Unknown rate limit scope unexisting' in str(e))
+        try:
+            ratelimit.set_limit(self.connection, models, 'queue', 'q', 0)
+            assert(False)
+        except ValueError, e:
+            self.assertEqual(str(e), 'The rate should be positive')
+
+        ratelimit.delete_limit(self.connection, models, 'func_name', 'f')
+        self.assertEqual(self._bucket('func_name', 'f'), None)
+
+    def test_acquire(self):
+        ratelimit.set_limit(self.connection, models, 'queue', 'emails', 0.001,
+                            capacity=2)
+        limits = ratelimit.load(self.connection, models)
+        self.assertEqual(len(limits), 1)
+        self.assertEqual(limits.blocked(), {})
+        keys = [('queue', 'emails')]
+        self.assertEqual(limits.acquire(self.connection, keys), True)
+        self.assertEqual(limits.acquire(self.connection, keys), True)
+        self.assertEqual(limits.acquire(self.connection, keys), False)
+        self.assertEqual(limits.blocked(), {'queue': ['emails']})
+        limit = self._bucket('queue', 'emails')
+        self.assertTrue(0 <= limit.tokens < 1)
+        self.assertEqual(limit.version, 2)
+
+        # Refilled with the time
+        now = datetime.datetime.utcnow() + datetime.timedelta(seconds=1000)
+        self.assertEqual(limits.blocked(now), {})
+        self.assertEqual(limits.acquire(self.connection, []), True)
+
+    def test_acquire_updated(self):
+        ratelimit.set_limit(self.connection, models, 'queue', 'emails', 0.001,
+                            capacity=2)
+        limits = ratelimit.load(self.connection, models)
+        other = ratelimit.load(self.connection, models)
+        keys = [('queue', 'emails')]
+        self.assertEqual(other.acquire(self.connection, keys), True)
+        # The bucket is loaded again since the version has changed
+        self.assertEqual(limits.acquire(self.connection, keys), True)
+        self.assertEqual(limits.buckets[keys[0]].version, 2)
+        self.assertEqual(other.acquire(self.connection, keys), False)
+
+    def test_each(self):
+        ratelimit.set_limit(self.connection, models, 'owner', '*', 0.001)
+        ratelimit.set_limit(self.connection, models, 'owner', 'admin', 100)
+        limits = ratelimit.load(self.connection, models)
+        self.assertEqual(limits.get_limit('owner', 'bob'), (0.001, 1))
+        self.assertEqual(limits.get_limit('owner', 'admin'), (100, 100))
+        self.assertEqual(limits.get_limit('queue', 'default'), None)
+        self.assertEqual(limits.get_keys(('f', 'default', 'bob')),
+                         [('owner', 'bob')])
+        self.assertEqual(limits.get_keys(('f', 'default', None)), [])
+
+        keys = [('owner', 'bob')]
+        self.assertEqual(limits.acquire(self.connection, keys), True)
+        bucket = self._bucket('owner', 'bob')
+        self.assertEqual(bucket.rate, None)
+        self.assertEqual(bucket.tokens, 0)
+        self.assertEqual(limits.acquire(self.connection, keys), False)
+        self.assertEqual(limits.acquire(self.connection, [('owner', 'tom')]),
+                         True)
+        self.assertEqual(limits.blocked(), {'owner': ['bob', 'tom']})
+
+        # The buckets of the values are deleted with the limit
+        ratelimit.delete_limit(self.connection, models, 'owner', '*')
+        self.assertEqual(
+            [(b.scope, b.name) for b in TaskRateLimit.query.all()],
+            [('owner', 'admin')])
+
+    def test_acquire_tasks(self):
+        ratelimit.set_limit(self.connection, models, 'func_name',
+                            'tests.test_ratelimit.func4test', 0.001,
+                            capacity=2)
+        ratelimit.set_limit(self.connection, models, 'owner', '*', 0.001)
+        for owner in ['bob', 'tom', 'bob', None]:
+            Task.create(func4test, owner=owner)
+        limits = ratelimit.load(self.connection, models)
+        self.assertEqual(limits.acquire_tasks(self.connection, []), ([], []))
+        # 3 is denied by the owner bucket, 4 by the func bucket
+        self.assertEqual(
+            limits.acquire_tasks(self.connection, [1, 2, 3, 4]),
+            ([1, 2], [3, 4]))
+        # All the buckets of a task or none
+        self.assertEqual(self._bucket('owner', 'bob').tokens, 0)
+        self.assertTrue(
+            self._bucket('func_name', 'tests.test_ratelimit.func4test').tokens
+            < 1)
+
+        limits = ratelimit.RateLimits(models)
+        self.assertEqual(limits.acquire_tasks(self.connection, [3]), ([3], []))
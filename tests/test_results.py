@@ -0,0 +1,122 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from sqlalchemy import create_engine
+from sqla_taskq import results
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    TaskResult,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+class TestResults(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(results.settings)
+        self.directory = tempfile.mkdtemp()
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        results.settings.update(self.settings)
+        shutil.rmtree(self.directory)
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def test_configure(self):
+        results.configure(store='file', path=self.directory, inline_max=10)
+        self.assertEqual(results.settings['store'], 'file')
+        self.assertEqual(results.settings['inline_max'], 10)
+        try:
+            results.configure(store='unexisting')
+            assert(False)
+        except ValueError, e:
+            self.assertTrue('Unknown result store unexisting' in str(e))
+        try:
+            results.configure(unexisting=1)
+            assert(False)
+        except TypeError, e:
+            self.assertEqual(str(e), 'Unknown setting unexisting')
+        try:
+            results.configure(path=None)
+            assert(False)
+        except ValueError, e:
+            self.assertEqual(
+                str(e), 'The path is required by the file result store')
+
+    def test_is_large(self):
+        self.assertEqual(results.is_large('a' * 100), False)
+        results.configure(inline_max=10)
+        self.assertEqual(results.is_large('a' * 10), False)
+        self.assertEqual(results.is_large(u'a' * 11), True)
+        self.assertEqual(results.is_large(None), False)
+
+    def test_encode(self):
+        data, compressed = results.encode(u'\xe9' * 100)
+        self.assertEqual(compressed, True)
+        self.assertEqual(zlib.decompress(data), u'\xe9'.encode('utf-8') * 100)
+        chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+        self.assertEqual(''.join(results.iter_decode(chunks, True)),
+                         u'\xe9'.encode('utf-8') * 100)
+
+        results.configure(compress=False)
+        self.assertEqual(results.encode('abc'), ('abc', False))
+        self.assertEqual(list(results.iter_decode(['ab', 'c'], False)),
+                         ['ab', 'c'])
+
+    def test_file(self):
+        results.configure(store='file', path=self.directory)
+        name = results.save_file(1, 'abcdef', False)
+        self.assertEqual(name, '1')
+        self.assertEqual(os.listdir(self.directory), ['1'])
+        self.assertEqual(list(results.iter_file(name, 4)), ['abcd', 'ef'])
+        self.assertEqual(results.save_file(2, 'abc', True), '2.z')
+        results.delete_file('2.z')
+        results.delete_file('2.z')
+        self.assertEqual(list(results.iter_file('2.z')), [])
+        self.assertEqual(results.file_name('file:2.z'), '2.z')
+        self.assertEqual(results.file_name('db'), None)
+        self.assertEqual(results.file_name(None), None)
+
+    def test_purge(self):
+        now = datetime.datetime.utcnow()
+        with transaction.manager:
+            for idtask, expires in [(1, now - datetime.timedelta(hours=1)),
+                                    (2, now + datetime.timedelta(hours=1)),
+                                    (3, None)]:
+                DBSession.add(TaskResult(idtask=idtask, data='abc',
+                                         compressed=False, size=3,
+                                         expires=expires))
+        results.configure(path=self.directory, ttl=60)
+        results.save_file(4, 'abc', False)
+        results.save_file(5, 'abc', False)
+        # Not a result file
+        for name in ['other', '6.z.12.tmp', '7.txt']:
+            open(os.path.join(self.directory, name), 'w').close()
+        old = time.time() - 120
+        for name in os.listdir(self.directory):
+            if name != '5':
+                os.utime(os.path.join(self.directory, name), (old, old))
+
+        connection = models.engine.connect()
+        self.assertEqual(results.purge(connection, models, batch_size=1), 2)
+        self.assertEqual(
+            sorted([r.idtask for r in TaskResult.query.all()]), [2, 3])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['5', '6.z.12.tmp', '7.txt', 'other'])
+        self.assertEqual(results.purge(connection, models), 0)
+        connection.close()
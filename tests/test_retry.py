@@ -0,0 +1,51 @@
+import unittest
+from mock import patch
+from sqla_taskq import retry
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_should_retry(self):
+        policy = retry.RetryPolicy(max_attempts=3,
+                                   exceptions=[ValueError, KeyError])
+        self.assertTrue(policy.should_retry(1, ValueError()))
+        self.assertTrue(policy.should_retry(2, KeyError()))
+        self.assertFalse(policy.should_retry(3, ValueError()))
+        self.assertFalse(policy.should_retry(1, TypeError()))
+
+    def test_get_delay(self):
+        policy = retry.RetryPolicy(backoff_base=2, backoff_max=10,
+                                   jitter=False)
+        self.assertEqual([policy.get_delay(n) for n in range(1, 6)],
+                         [2, 4, 8, 10, 10])
+
+        policy.jitter = True
+        with patch('random.uniform', return_value=3) as m:
+            self.assertEqual(policy.get_delay(2), 3)
+            m.assert_called_once_with(2.0, 4)
+
+    def test_dict(self):
+        policy = retry.RetryPolicy(max_attempts=5, exceptions=[ValueError])
+        dic = policy.to_dict()
+        self.assertEqual(dic, {
+            'max_attempts': 5,
+            'backoff_base': 1,
+            'backoff_max': 3600,
+            'jitter': True,
+            'exceptions': ['exceptions.ValueError'],
+        })
+        other = retry.RetryPolicy.from_dict(dic)
+        self.assertEqual(other.to_dict(), dic)
+        self.assertEqual(other.exceptions, (ValueError,))
+
+        # The exceptions which can't be imported are ignored
+        dic['exceptions'] = ['unexisting.Error', 'exceptions.KeyError']
+        other = retry.RetryPolicy.from_dict(dic)
+        self.assertEqual(other.exceptions, (KeyError,))
+
+    def test_retry(self):
+        @retry.retry(max_attempts=4)
+        def func():
+            pass
+        self.assertEqual(func.retry_policy.max_attempts, 4)
+        self.assertEqual(func.retry_policy.exceptions, (Exception,))
@@ -0,0 +1,120 @@
+import unittest
+import datetime
+import os
+from sqlalchemy import create_engine
+from sqla_taskq import stats
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+)
+import sqla_taskq.models as models
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+def func4test(*args, **kw):
+    return 'func4test'
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine(DB_URL)
+        models.engine = engine
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        transaction.abort()
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def test_get_stats(self):
+        now = datetime.datetime.utcnow()
+        res = stats.get_stats(models, now=now)
+        self.assertEqual(res, {
+            'counts': {
+                'waiting': 0,
+                'inprogress': 0,
+                'finished': 0,
+                'failed': 0,
+                'timedout': 0,
+            },
+            'queues': {},
+            'unique_keys': {},
+            'owners': {},
+            'oldest_waiting_age': None,
+            'throughput': {1: 0.0, 5: 0.0, 15: 0.0},
+        })
+
+        Task.create_many([
+            {'func': func4test, 'owner': 'me', 'unique_key': 'key'},
+            {'func': func4test, 'owner': 'me', 'unique_key': 'key'},
+            {'func': func4test, 'owner': 'other'},
+            {'func': func4test},
+            {'func': func4test},
+            {'func': func4test, 'owner': 'me', 'queue': 'emails'},
+        ])
+        with transaction.manager:
+            tasks = Task.query.order_by(Task.idtask).all()
+            tasks[0].creation_date = now - datetime.timedelta(minutes=30)
+            tasks[2].status = models.TASK_STATUS_IN_PROGRESS
+            for task, minutes in [(tasks[3], 3), (tasks[4], 10)]:
+                task.status = models.TASK_STATUS_FINISHED
+                task.end_date = now - datetime.timedelta(minutes=minutes)
+            tasks[5].status = models.TASK_STATUS_FAILED
+            tasks[5].end_date = now - datetime.timedelta(seconds=10)
+
+        res = stats.get_stats(models, now=now)
+        self.assertEqual(res['counts'], {
+            'waiting': 2,
+            'inprogress': 1,
+            'finished': 2,
+            'failed': 1,
+            'timedout': 0,
+        })
+        self.assertEqual(res['queues'], {'default': 3})
+        self.assertEqual(res['unique_keys'], {'key': 2})
+        self.assertEqual(res['owners'], {'me': 2, 'other': 1})
+        self.assertEqual(res['oldest_waiting_age'], 30 * 60)
+        self.assertEqual(res['throughput'], {1: 1.0, 5: 0.4, 15: 0.2})
+
+        res = stats.get_stats(models, windows=(60,), top=1, now=now)
+        self.assertEqual(res['owners'], {'me': 2})
+        self.assertEqual(res['throughput'], {60: 3 / 60.0})
+
+        # The tasks which are not due yet are not late
+        with transaction.manager:
+            task = Task.query.get(1)
+            task.not_before = now + datetime.timedelta(days=7)
+        res = stats.get_stats(models, now=now)
+        self.assertTrue(res['oldest_waiting_age'] < 60)
+
+    def test_format_stats(self):
+        res = stats.format_stats({
+            'counts': {
+                'waiting': 2,
+                'inprogress': 1,
+                'finished': 2,
+                'failed': 0,
+            },
+            'queues': {'default': 2, 'emails': 1},
+            'unique_keys': {},
+            'owners': {'me': 2, 'other': 1},
+            'oldest_waiting_age': 65.5,
+            'throughput': {1: 1.0, 5: 0.4},
+        })
+        self.assertEqual(res, [
+            'Number of failed tasks: 0',
+            'Number of finished tasks: 2',
+            'Number of inprogress tasks: 1',
+            'Number of waiting tasks: 2',
+            'Oldest waiting task: 65s',
+            'Completed tasks per minute: 1.0 (1m), 0.4 (5m)',
+            'Pending tasks by queue: default=2, emails=1',
+            'Pending tasks by owner: me=2, other=1',
+        ])
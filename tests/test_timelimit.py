@@ -0,0 +1,129 @@
+import unittest
+import os
+import time
+import signal
+import threading
+from sqla_taskq import timelimit
+
+
+def func4test():
+    return 'func4test'
+
+
+def func4testslow():
+    time.sleep(5)
+    return 'func4testslow'
+
+
+def func4testfailed():
+    raise ValueError('Failing function')
+
+
+class UnpicklableError(Exception):
+
+    def __init__(self, message):
+        super(UnpicklableError, self).__init__(message)
+        self.lock = threading.Lock()
+
+
+def func4testunpicklable():
+    raise UnpicklableError('lock')
+
+
+def func4testexit():
+    os._exit(3)
+
+
+class TestTimelimit(unittest.TestCase):
+
+    def test_call(self):
+        self.assertEqual(timelimit.call(func4test), 'func4test')
+        self.assertEqual(timelimit.call(func4test, 1), 'func4test')
+        self.assertRaises(ValueError, timelimit.call, func4test, 1, 'other')
+
+        start = time.time()
+        self.assertRaises(timelimit.TaskTimeout, timelimit.call,
+                          func4testslow, 0.1)
+        self.assertTrue(time.time() - start < 1)
+        self.assertRaises(ValueError, timelimit.call, func4testfailed, 1)
+
+    def test_call_in_thread(self):
+        # The signals can't be used, the process mode should be used
+        result = {}
+
+        def target():
+            try:
+                timelimit.call(func4test, 1)
+            except ValueError, e:
+                result['signal'] = e
+            start = time.time()
+            try:
+                timelimit.call(func4testslow, 0.1, timelimit.PROCESS)
+            except timelimit.TaskTimeout, e:
+                result['error'] = e
+            result['duration'] = time.time() - start
+            result['value'] = timelimit.call(func4test, 1, timelimit.PROCESS)
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        self.assertTrue('can only be used in the main thread'
+                        in str(result['signal']))
+        self.assertTrue(isinstance(result['error'], timelimit.TaskTimeout))
+        self.assertTrue(result['duration'] < 1)
+        self.assertEqual(result['value'], 'func4test')
+
+    def test_call_in_process(self):
+        self.assertEqual(timelimit.call_in_process(func4test, 1), 'func4test')
+        # The initializer is called in the child
+        pids = []
+        res = timelimit.call_in_process(lambda: pids, 1,
+                                        lambda: pids.append(os.getpid()))
+        self.assertEqual(len(res), 1)
+        self.assertNotEqual(res[0], os.getpid())
+        self.assertEqual(pids, [])
+
+        start = time.time()
+        try:
+            timelimit.call_in_process(func4testslow, 0.1)
+            assert(False)
+        except timelimit.TaskTimeout, e:
+            self.assertTrue('its process has been killed' in str(e))
+        self.assertTrue(time.time() - start < 1)
+
+        # The exception of the child is raised with its traceback
+        try:
+            timelimit.call_in_process(func4testfailed, 1)
+            assert(False)
+        except ValueError, e:
+            self.assertEqual(str(e), 'Failing function')
+            self.assertTrue('in func4testfailed' in e.process_traceback)
+
+        try:
+            timelimit.call_in_process(func4testunpicklable, 1)
+            assert(False)
+        except timelimit.TaskProcessError, e:
+            self.assertTrue('UnpicklableError: lock' in str(e))
+            self.assertEqual(e.process_traceback, str(e))
+
+        try:
+            timelimit.call_in_process(func4testexit, 1)
+            assert(False)
+        except timelimit.TaskProcessError, e:
+            self.assertEqual(str(e),
+                             'The task process has exited with the code 3')
+
+    def test_call_in_process_killed(self):
+        # The worker is killed while waiting for the task
+        def handler(signal_number, stack_frame):
+            raise SystemExit(0)
+        previous = signal.signal(signal.SIGALRM, handler)
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        start = time.time()
+        try:
+            self.assertRaises(SystemExit, timelimit.call_in_process,
+                              func4testslow, 10)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        # The process has been terminated
+        self.assertTrue(time.time() - start < 2)
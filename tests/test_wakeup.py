@@ -0,0 +1,134 @@
+import unittest
+from mock import patch, Mock
+import os
+import shutil
+import socket
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqla_taskq import wakeup
+from sqla_taskq.models import (
+    DBSession,
+    Base,
+    Task,
+)
+import transaction
+
+
+DB_NAME = 'test_sqla_taskq.db'
+DB_URL = 'sqlite:///%s' % DB_NAME
+
+
+def func4test(*args, **kw):
+    return 'test'
+
+
+class TestWakeup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_directory(self):
+        with patch.dict(os.environ, {'SQLA_TASKQ_WAKEUP_DIR': '/fake'}):
+            self.assertEqual(wakeup.get_directory(), '/fake')
+        with patch.dict(os.environ, {'SQLA_TASKQ_WAKEUP_DIR': ''}):
+            self.assertEqual(wakeup.get_directory(),
+                             os.path.join(tempfile.gettempdir(), 'sqla_taskq'))
+
+    def test_wake_local_workers(self):
+        res = wakeup.wake_local_workers(
+            os.path.join(self.directory, 'unexisting'))
+        self.assertEqual(res, 0)
+        res = wakeup.wake_local_workers(self.directory)
+        self.assertEqual(res, 0)
+
+        waiter = wakeup.SocketWaiter(self.directory)
+        self.assertEqual(waiter.wait(0), False)
+        self.assertEqual(waiter.fileno(), waiter.socket.fileno())
+        open(os.path.join(self.directory, 'README'), 'w').close()
+        res = wakeup.wake_local_workers(self.directory)
+        self.assertEqual(res, 1)
+        res = wakeup.wake_local_workers(self.directory)
+        self.assertEqual(res, 1)
+        start = time.time()
+        self.assertEqual(waiter.wait(10), True)
+        self.assertTrue(time.time() - start < 1)
+        # All the wakeups have been read
+        self.assertEqual(waiter.wait(0), False)
+
+        # Stale socket of a dead worker
+        path = os.path.join(self.directory, '1.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        res = wakeup.wake_local_workers(self.directory)
+        self.assertEqual(res, 1)
+        self.assertFalse(os.path.exists(path))
+
+        waiter.close()
+        self.assertFalse(os.path.exists(waiter.path))
+        res = wakeup.wake_local_workers(self.directory)
+        self.assertEqual(res, 0)
+
+    def test_sleep_waiter(self):
+        waiter = wakeup.SleepWaiter()
+        self.assertEqual(waiter.fileno(), None)
+        with patch('time.sleep') as m:
+            self.assertEqual(waiter.wait(2), False)
+            m.assert_called_with(2)
+        waiter.close()
+
+    def test_get_waiter(self):
+        engine = Mock()
+        engine.dialect.name = 'postgresql'
+        engine.dialect.driver = 'psycopg2'
+        with patch('sqla_taskq.wakeup.PostgresWaiter') as m:
+            wakeup.get_waiter(engine)
+            m.assert_called_with(engine)
+
+        engine.dialect.name = 'sqlite'
+        engine.dialect.driver = 'pysqlite'
+        with patch.dict(os.environ, {'SQLA_TASKQ_WAKEUP_DIR': self.directory}):
+            waiter = wakeup.get_waiter(engine)
+        self.assertTrue(isinstance(waiter, wakeup.SocketWaiter))
+        waiter.close()
+
+        with patch('sqla_taskq.wakeup.socket', spec=[]):
+            waiter = wakeup.get_waiter(engine)
+        self.assertTrue(isinstance(waiter, wakeup.SleepWaiter))
+
+
+class TestNotify(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        engine = create_engine(DB_URL)
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        transaction.abort()
+        shutil.rmtree(self.directory)
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+
+    def test_notify(self):
+        with patch.dict(os.environ, {'SQLA_TASKQ_WAKEUP_DIR': self.directory}):
+            waiter = wakeup.SocketWaiter()
+            Task.create(func4test)
+            self.assertEqual(waiter.wait(0), True)
+
+            # Nothing is sent if the transaction is aborted
+            transaction.begin()
+            wakeup.notify(DBSession)
+            transaction.abort()
+            self.assertEqual(waiter.wait(0), False)
+            waiter.close()
+
+        session = Mock()
+        session.get_bind.return_value.dialect.name = 'postgresql'
+        wakeup.notify(session)
+        session.execute.assert_called_with('NOTIFY sqla_taskq')